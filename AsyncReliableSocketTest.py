@@ -0,0 +1,63 @@
+import asyncio
+import contextlib
+import io
+import socket
+import unittest
+import util
+from async_reliable_socket import AsyncReliableSocket
+from reliable_socket import ReliableSocket
+
+
+class AsyncReliableSocketTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.receiver = await AsyncReliableSocket.create("127.0.0.1", 0, 8)
+        self.sender = await AsyncReliableSocket.create("127.0.0.1", 0, 8)
+
+    async def asyncTearDown(self):
+        self.receiver.close()
+        self.sender.close()
+
+    async def recvfrom(self):
+        return await asyncio.wait_for(self.receiver.recvfrom(), 5)
+
+    async def test_messages_are_received_as_sent(self):
+        address = self.receiver.getsockname()
+        message = "".join("line %d\n" % i for i in range(1000))
+        self.assertTrue(await self.sender.sendto(address, message))
+        self.assertEqual(await self.recvfrom(), (message, self.sender.getsockname()))
+        self.assertTrue(await self.sender.sendto_bytes(address, b"\x00\x01"))
+        received, _ = await asyncio.wait_for(self.receiver.recvfrom_bytes(), 5)
+        self.assertEqual(received, b"\x00\x01")
+
+    async def test_malformed_datagrams_are_ignored(self):
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        raw = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for datagram in (b"garbage", b"s:x:", b"s:1:" + b"\xff" * 8):
+            raw.sendto(datagram, self.receiver.getsockname())
+        raw.close()
+        with contextlib.redirect_stderr(io.StringIO()):
+            await asyncio.sleep(0.1)
+        self.assertEqual(errors, [])
+        self.assertTrue(await self.sender.sendto(self.receiver.getsockname(), "still here"))
+        self.assertEqual((await self.recvfrom())[0], "still here")
+
+    async def test_interoperates_with_reliable_socket(self):
+        threaded = ReliableSocket("127.0.0.1", 0, 8, binary=True, sack=True)
+        message = "x" * (3 * util.CHUNK_SIZE)
+        delivered = await asyncio.to_thread(threaded.sendto, self.receiver.getsockname(), message)
+        self.assertTrue(delivered)
+        self.assertEqual(await self.recvfrom(), (message, threaded.getsockname()))
+        self.assertTrue(await self.sender.sendto(threaded.getsockname(), message))
+        received = await asyncio.to_thread(threaded.recvfrom, timeout=5)
+        self.assertEqual(received, (message, self.sender.getsockname()))
+
+    def test_threaded_only_options_are_refused(self):
+        for option in ("streaming", "persistent", "batching", "reuse_port"):
+            with self.subTest(option=option):
+                with self.assertRaises(ValueError):
+                    AsyncReliableSocket(8, **{option: True})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from queue import Queue
+import util
+from reliable_socket import ReliableSocket
+from reliable_transport import ReliableMessageReceiver
+from TestSupport import RecordingSocket
+
+
+class BatchingTest(unittest.TestCase):
+    def test_batches_split_back_into_their_messages(self):
+        messages = ["hi", b"\x00:\xff", "", "héllo"]
+        self.assertEqual(util.split_batch(util.make_batch(messages)),
+                         [b"hi", b"\x00:\xff", b"", "héllo".encode()])
+
+    def test_receiver_completes_each_message_of_a_batch(self):
+        completed = Queue()
+        receiver = ReliableMessageReceiver(RecordingSocket(), ("127.0.0.1", 1), 7, completed)
+        receiver.on_packet_received(util.make_packet("start", 10, "codec=bin batch=1"))
+        receiver.on_packet_received(util.make_binary_packet("data", 11, util.make_batch(["a", "bc"])))
+        receiver.on_packet_received(util.make_binary_packet("end", 12))
+        self.assertEqual([completed.get_nowait(), completed.get_nowait()], [b"a", b"bc"])
+        self.assertTrue(completed.empty())
+
+    def test_small_messages_share_one_transmission(self):
+        receiver = ReliableSocket("127.0.0.1", 0, 4)
+        address = receiver.getsockname()
+        sender = ReliableSocket("127.0.0.1", 0, 4, batching=True, batch_delay=0.05)
+        futures = [sender.sendto_async(address, "message %d" % i) for i in range(5)]
+        self.assertEqual(len(set(map(id, futures))), 1)
+        self.assertTrue(futures[0].result(timeout=5))
+        self.assertEqual([receiver.recvfrom(timeout=5)[0] for _ in range(5)],
+                         ["message %d" % i for i in range(5)])
+
+    def test_long_messages_are_not_batched(self):
+        receiver = ReliableSocket("127.0.0.1", 0, 4)
+        address = receiver.getsockname()
+        sender = ReliableSocket("127.0.0.1", 0, 4, batching=True, batch_size=10)
+        futures = [sender.sendto_async(address, "x" * 10), sender.sendto_async(address, "y" * 10)]
+        self.assertIsNot(futures[0], futures[1])
+        self.assertTrue(all(future.result(timeout=5) for future in futures))
+        self.assertEqual(sorted(receiver.recvfrom(timeout=5)[0] for _ in range(2)),
+                         ["x" * 10, "y" * 10])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import time
+import unittest
+from queue import Queue
+import util
+from reliable_transport import ReliableMessageReceiver, ReliableMessageSender
+from TestSupport import RecordingSocket
+
+
+class BinaryFramingTest(unittest.TestCase):
+    def test_binary_packets_round_trip(self):
+        packet = util.make_binary_packet("data", 4242, b"\x00\xff|payload|")
+        self.assertTrue(util.is_binary_packet(packet))
+        pck_type, seqno, body = util.read_packet(packet)
+        self.assertEqual((pck_type, seqno, bytes(body)), ("data", 4242, b"\x00\xff|payload|"))
+
+    def test_corrupted_binary_packets_are_rejected(self):
+        packet = bytearray(util.make_binary_packet("data", 1, b"payload"))
+        packet[-6] ^= 0x01
+        self.assertIsNone(util.read_packet(bytes(packet)))
+        self.assertIsNone(util.read_packet(util.make_binary_packet("data", 1, b"x")[:-1]))
+
+    def test_text_packets_still_parse(self):
+        self.assertEqual(util.read_packet(util.make_packet("data", 5, "hello")), ("data", 5, "hello"))
+        self.assertEqual(util.read_packet(util.make_packet("data", 5, "hello").encode()),
+                         ("data", 5, "hello"))
+
+    def test_receiver_accepts_binary_framing(self):
+        sock = RecordingSocket()
+        completed = Queue()
+        receiver = ReliableMessageReceiver(sock, ("127.0.0.1", 1), 7, completed)
+        receiver.on_packet_received(util.make_packet("start", 10, "codec=bin"))
+        _, _, body = util.read_packet(sock.packets()[0])
+        self.assertEqual(util.parse_options(body), {"codec": "bin"})
+        receiver.on_packet_received(util.make_binary_packet("data", 11, b"\x00\x01"))
+        receiver.on_packet_received(util.make_binary_packet("end", 12))
+        self.assertTrue(all(util.is_binary_packet(packet) for packet in sock.packets()[1:]))
+        self.assertEqual(completed.get_nowait(), b"\x00\x01")
+
+    def test_sender_falls_back_to_text_when_binary_is_declined(self):
+        sock = RecordingSocket()
+        sender = ReliableMessageSender(sock, ("127.0.0.1", 1), 7, 4, binary=True)
+        chunks, offer, fallback = sender.split_message("hello")
+        self.assertEqual(offer["codec"], "bin")
+        sender.start_packet(offer)
+        sender.on_start_ack("")
+        self.assertTrue(sender.begin_message(chunks, offer, fallback))
+        sender.advance(time.monotonic())
+        pck_type, _, body = util.read_packet(sock.packets()[0])
+        self.assertEqual((pck_type, body), ("data", "hello"))
+
+    def test_bytes_are_not_sent_without_binary_framing(self):
+        sender = ReliableMessageSender(RecordingSocket(), ("127.0.0.1", 1), 7, 4, binary=True)
+        chunks, offer, fallback = sender.split_message(b"\x00\x01")
+        self.assertIsNone(fallback)
+        sender.start_packet(offer)
+        sender.on_start_ack("")
+        self.assertFalse(sender.begin_message(chunks, offer, fallback))
+
+
+if __name__ == "__main__":
+    unittest.main()
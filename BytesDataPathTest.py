@@ -0,0 +1,67 @@
+import socket
+import unittest
+from queue import Queue
+import util
+from reliable_socket import ReliableSocket
+from reliable_transport import ReliableMessageReceiver
+from TestSupport import RecordingSocket
+
+
+class BytesDataPathTest(unittest.TestCase):
+    def setUp(self):
+        self.sock = RecordingSocket()
+        self.completed = Queue()
+        self.receiver = ReliableMessageReceiver(self.sock, ("127.0.0.1", 1), 7, self.completed)
+
+    def start(self, options):
+        self.receiver.on_packet_received(util.make_packet("start", 100, options))
+
+    def data(self, seqno, chunk):
+        self.receiver.on_packet_received(util.make_binary_packet("data", seqno, chunk))
+
+    def end(self, seqno):
+        self.receiver.on_packet_received(util.make_binary_packet("end", seqno))
+
+    def test_announced_size_is_reassembled_as_bytes(self):
+        self.start("codec=bin size=6 chunk=4")
+        self.data(101, b"abcd")
+        self.data(102, b"ef")
+        self.end(103)
+        message = self.completed.get_nowait()
+        self.assertIsInstance(message, bytes)
+        self.assertEqual(message, b"abcdef")
+
+    def test_implausible_sizes_are_not_preallocated(self):
+        for options in ("size=100000000000 chunk=1400", "size=-1 chunk=1400",
+                        "size=ten chunk=1400", "size=6 chunk=0", "size=6 chunk=-4"):
+            with self.subTest(options=options):
+                self.start("codec=bin " + options)
+                self.assertIsNone(self.receiver.buffer)
+                self.data(101, b"abcd")
+                self.end(102)
+                self.assertEqual(self.completed.get_nowait(), b"abcd")
+
+    def test_chunks_beyond_the_announced_size_are_dropped(self):
+        self.start("codec=bin size=6 chunk=4")
+        self.data(101, b"abcd")
+        self.data(103, b"zzzz")
+        self.data(102, b"efgh")
+        self.data(102, b"ef")
+        self.end(104)
+        self.assertEqual(self.completed.get_nowait(), b"abcdef")
+
+    def test_malformed_datagram_does_not_stop_the_socket(self):
+        receiver = ReliableSocket("127.0.0.1", 0, 4)
+        address = receiver.getsockname()
+        sender = ReliableSocket("127.0.0.1", 0, 4, binary=True)
+        raw = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        raw.sendto(b"s:7:" + util.make_packet("start", 100, "codec=bin size=-5 chunk=1400")
+                   .encode(), address)
+        raw.sendto(b"no colons here", address)
+        raw.close()
+        self.assertTrue(sender.sendto(address, "still receiving"))
+        self.assertEqual(receiver.recvfrom(timeout=5)[0], "still receiving")
+
+
+if __name__ == "__main__":
+    unittest.main()
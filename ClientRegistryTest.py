@@ -0,0 +1,47 @@
+import unittest
+from server import ClientRegistry
+
+
+class ClientRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.clients = ClientRegistry()
+        self.alice = {"username": "alice", "address": ("127.0.0.1", 1), "worker": 0}
+        self.bob = {"username": "bob", "address": ("127.0.0.1", 2), "worker": 1}
+
+    def test_clients_are_found_by_username_and_address(self):
+        self.assertTrue(self.clients.add(self.alice))
+        self.assertTrue(self.clients.add(self.bob))
+        self.assertEqual(len(self.clients), 2)
+        self.assertIs(self.clients.find("bob"), self.bob)
+        self.assertEqual(self.clients.username_of(("127.0.0.1", 1)), "alice")
+        self.assertEqual(self.clients.usernames(), ["alice", "bob"])
+
+    def test_unknown_clients_are_not_found(self):
+        self.assertIsNone(self.clients.find("alice"))
+        self.assertEqual(self.clients.username_of(("127.0.0.1", 1)), "")
+
+    def test_duplicate_username_is_refused(self):
+        self.clients.add(self.alice)
+        impostor = {"username": "alice", "address": ("127.0.0.1", 3), "worker": 0}
+        self.assertFalse(self.clients.add(impostor))
+        self.assertIs(self.clients.find("alice"), self.alice)
+        self.assertEqual(self.clients.username_of(("127.0.0.1", 3)), "")
+        # Only the client registered under the username can leave with it.
+        self.assertFalse(self.clients.remove("alice", ("127.0.0.1", 3)))
+        self.assertEqual(len(self.clients), 1)
+
+    def test_removed_clients_are_forgotten(self):
+        self.clients.add(self.alice)
+        self.clients.add(self.bob)
+        self.assertTrue(self.clients.remove("alice", ("127.0.0.1", 1)))
+        self.assertFalse(self.clients.remove("alice", ("127.0.0.1", 1)))
+        self.assertIsNone(self.clients.find("alice"))
+        self.assertEqual(self.clients.username_of(("127.0.0.1", 1)), "")
+        self.assertEqual(self.clients.usernames(), ["bob"])
+        # The username is free again, and usernames keep the order of joining.
+        self.assertTrue(self.clients.add(self.alice))
+        self.assertEqual(self.clients.usernames(), ["bob", "alice"])
+
+
+if __name__ == "__main__":
+    unittest.main()
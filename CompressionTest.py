@@ -0,0 +1,91 @@
+import os
+import unittest
+import zlib
+from queue import Queue
+import util
+from reliable_socket import ReliableSocket
+from reliable_transport import ReliableMessageReceiver, ReliableMessageSender
+from TestSupport import RecordingSocket
+
+
+class CompressionTest(unittest.TestCase):
+    def test_compressible_messages_round_trip(self):
+        message = "the same line again\n" * 1000
+        compressed = util.compress(message)
+        self.assertLess(len(compressed), len(message) // 10)
+        self.assertEqual(util.decompress(compressed, len(message)), message.encode())
+
+    def test_messages_are_never_inflated_beyond_their_limit(self):
+        bomb = zlib.compress(bytes(10 ** 6))
+        with self.assertRaises(ValueError):
+            util.decompress(bomb, 1000)
+        decompressor = util.Decompressor(1000)
+        with self.assertRaises(ValueError):
+            decompressor.decompress(bomb[:len(bomb) // 2])
+        decompressor = util.Decompressor(10 ** 6)
+        restored = decompressor.decompress(bomb) + decompressor.flush()
+        self.assertEqual(len(restored), 10 ** 6)
+
+    def test_incompressible_messages_are_left_alone(self):
+        self.assertIsNone(util.compress(os.urandom(util.COMPRESS_THRESHOLD)))
+
+    def test_sender_offers_compression_above_the_threshold(self):
+        sender = ReliableMessageSender(None, ("127.0.0.1", 1), 7, 4, compress=True)
+        _, offer, _ = sender.split_message("a" * util.COMPRESS_THRESHOLD)
+        self.assertEqual(offer["comp"], "zlib")
+        self.assertLess(offer["size"], util.COMPRESS_THRESHOLD)
+        self.assertEqual(offer["orig"], util.COMPRESS_THRESHOLD)
+        _, offer, _ = sender.split_message("a" * (util.COMPRESS_THRESHOLD - 1))
+        self.assertNotIn("comp", offer)
+
+    def test_compression_is_accepted_only_if_enabled(self):
+        offer = "codec=bin size=20 chunk=8 comp=zlib orig=40"
+        for compress in (False, True):
+            with self.subTest(compress=compress):
+                sock = RecordingSocket()
+                completed = Queue()
+                receiver = ReliableMessageReceiver(sock, ("127.0.0.1", 1), 7, completed,
+                                                   compress=compress)
+                receiver.on_packet_received(util.make_packet("start", 10, offer))
+                self.assertEqual(sock.acks()[0][1].get("comp"), "zlib" if compress else None)
+                # A declined message is sent as it is, at its original size.
+                self.assertEqual(len(receiver.buffer), 40 if not compress else 20)
+
+    def test_bomb_is_not_inflated_beyond_its_announced_size(self):
+        bomb = zlib.compress(bytes(10 ** 6))
+        receiver = ReliableMessageReceiver(RecordingSocket(), ("127.0.0.1", 1), 7, Queue(),
+                                           compress=True)
+        receiver.on_packet_received(util.make_packet(
+            "start", 10, "codec=bin size=%d chunk=%d comp=zlib orig=1000" % (len(bomb), len(bomb))))
+        receiver.on_packet_received(util.make_binary_packet("data", 11, bomb))
+        with self.assertRaises(ValueError):
+            receiver.on_packet_received(util.make_binary_packet("end", 12))
+
+    def test_sender_restores_messages_the_receiver_will_not(self):
+        sock = RecordingSocket()
+        sender = ReliableMessageSender(sock, ("127.0.0.1", 1), 4, 64, compress=True)
+        message = b"the same line again\n" * 1000
+        chunks, offer, fallback = sender.split_message(message)
+        sender.start_packet(offer)
+        sender.on_start_ack("codec=bin")
+        self.assertTrue(sender.begin_message(chunks, offer, fallback))
+        self.assertEqual(b"".join(bytes(chunk) for chunk in sender.chunks), message)
+
+    def test_compressed_messages_are_received_as_sent(self):
+        receiver = ReliableSocket("127.0.0.1", 0, 8, compress=True)
+        address = receiver.getsockname()
+        streaming = ReliableSocket("127.0.0.1", 0, 8, streaming=True, compress=True)
+        plain = ReliableSocket("127.0.0.1", 0, 8)
+        sender = ReliableSocket("127.0.0.1", 0, 8, compress=True)
+        message = "".join("line %d\n" % (i % 100) for i in range(20000))
+        self.assertTrue(sender.sendto(address, message))
+        self.assertEqual(receiver.recvfrom(timeout=5)[0], message)
+        self.assertTrue(sender.sendto(streaming.getsockname(), message))
+        stream, _ = streaming.recv_stream(timeout=5)
+        self.assertEqual(stream.read(timeout=5), message.encode())
+        self.assertTrue(sender.sendto(plain.getsockname(), message))
+        self.assertEqual(plain.recvfrom(timeout=5)[0], message)
+
+
+if __name__ == "__main__":
+    unittest.main()
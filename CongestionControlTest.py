@@ -0,0 +1,59 @@
+import unittest
+from unittest import mock
+import reliable_transport
+from reliable_transport import (CONGESTION_CONTROLS, CongestionControl, CubicCongestionControl,
+                                RenoCongestionControl)
+
+
+class CongestionControlTest(unittest.TestCase):
+    def test_fixed_window_never_changes(self):
+        congestion = CONGESTION_CONTROLS["fixed"](8)
+        self.assertIs(type(congestion), CongestionControl)
+        congestion.on_loss()
+        congestion.on_timeout()
+        self.assertEqual(congestion.window(), 8)
+
+    def test_reno_slow_start_then_additive_increase(self):
+        congestion = RenoCongestionControl(64, ssthresh=8)
+        self.assertEqual(congestion.window(), 1)
+        for _ in range(3):
+            congestion.on_ack(congestion.window())
+        self.assertEqual(congestion.window(), 8)
+        congestion.on_ack(congestion.window())
+        self.assertEqual(congestion.window(), 9)
+
+    def test_reno_halves_on_loss_and_restarts_on_timeout(self):
+        congestion = RenoCongestionControl(64, cwnd=20)
+        congestion.on_loss()
+        self.assertEqual((congestion.window(), congestion.ssthresh), (10, 10))
+        congestion.on_timeout()
+        self.assertEqual((congestion.window(), congestion.ssthresh), (1, 5))
+
+    def test_window_is_bounded_by_the_configured_size(self):
+        for name in ("reno", "cubic"):
+            with self.subTest(name=name):
+                congestion = CONGESTION_CONTROLS[name](4)
+                for _ in range(10):
+                    congestion.on_ack(4)
+                self.assertEqual(congestion.window(), 4)
+
+    def test_cubic_regains_its_window_faster_than_reno(self):
+        with mock.patch.object(reliable_transport.time, "monotonic", return_value=0.0) as now:
+            congestion = CubicCongestionControl(200, cwnd=100)
+            congestion.on_loss()
+            self.assertEqual(congestion.window(), 70)
+            congestion.on_ack(1)
+            k = (100 * (1 - congestion.beta) / congestion.scale) ** (1 / 3)
+            now.return_value = k
+            for _ in range(70):
+                congestion.on_ack(1)
+            self.assertGreater(congestion.cwnd, 80)  # Reno would be at 71.
+            self.assertLessEqual(congestion.cwnd, 100)
+            now.return_value = k + 10
+            for _ in range(100):
+                congestion.on_ack(1)
+            self.assertGreater(congestion.cwnd, 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import socket
+import time
+import unittest
+import util
+from reliable_socket import ConnectionTable, ReliableSocket
+
+
+class ConnectionTableTest(unittest.TestCase):
+    def test_full_table_evicts_time_wait_entries_only(self):
+        table = ConnectionTable(capacity=2)
+        self.assertTrue(table.add("a", 1))
+        self.assertTrue(table.add("b", 2))
+        self.assertFalse(table.add("c", 3))
+        table.finish("a")
+        self.assertTrue(table.add("c", 3))
+        self.assertIsNone(table.get("a"))
+        self.assertEqual((table.get("b"), table.get("c")), (2, 3))
+
+    def test_time_wait_entries_expire(self):
+        table = ConnectionTable(time_wait=0.05)
+        table.add("a", 1)
+        table.finish("a")
+        self.assertEqual(table.get("a"), 1)
+        time.sleep(0.06)
+        self.assertIsNone(table.get("a"))
+
+    def test_idle_entries_are_handed_to_on_evict(self):
+        evicted = []
+        table = ConnectionTable(idle_timeout=0.05, on_evict=evicted.append)
+        table.add("a", 1)
+        table.add("b", 2)
+        time.sleep(0.03)
+        table.get("b")
+        time.sleep(0.03)
+        table.expire()
+        self.assertEqual(evicted, [1])
+        self.assertEqual(table.get("b"), 2)
+
+    def test_flood_of_starts_leaves_transfers_in_progress_alone(self):
+        receiver = ReliableSocket("127.0.0.1", 0, 4, max_connections=4)
+        address = receiver.getsockname()
+        raw = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        raw.sendto(b"s:1:" + util.make_packet("start", 10).encode(), address)
+        raw.sendto(b"s:1:" + util.make_packet("data", 11, "kept").encode(), address)
+        for msg_id in range(2, 50):
+            raw.sendto(b"s:%d:" % msg_id + util.make_packet("start", 10).encode(), address)
+        raw.sendto(b"s:1:" + util.make_packet("end", 12).encode(), address)
+        raw.close()
+        self.assertEqual(receiver.recvfrom(timeout=5)[0], "kept")
+
+    def test_sends_fail_while_the_senders_table_is_full(self):
+        receiver = ReliableSocket("127.0.0.1", 0, 4)
+        sender = ReliableSocket("127.0.0.1", 0, 4, max_connections=1, persistent=True)
+        # The open connection keeps the only sender busy.
+        self.assertTrue(sender.sendto(receiver.getsockname(), "kept open"))
+        self.assertFalse(sender.sendto(("127.0.0.1", 9), "refused"))
+
+
+if __name__ == "__main__":
+    unittest.main()
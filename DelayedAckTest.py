@@ -0,0 +1,82 @@
+import unittest
+from queue import Queue
+import util
+from reliable_transport import ReliableMessageReceiver
+from TestSupport import RecordingSocket
+
+
+class Timer:
+    def __init__(self, callback):
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Timers:
+    """
+    Stands in for loop.call_later, running callbacks only when told to.
+    """
+    def __init__(self):
+        self.pending = []
+
+    def schedule(self, delay, callback):
+        timer = Timer(callback)
+        self.pending.append(timer)
+        return timer
+
+    def fire(self):
+        pending, self.pending = self.pending, []
+        for timer in pending:
+            if not timer.cancelled:
+                timer.callback()
+
+
+class DelayedAckTest(unittest.TestCase):
+    def setUp(self):
+        self.sock = RecordingSocket()
+        self.timers = Timers()
+        self.receiver = ReliableMessageReceiver(self.sock, ("127.0.0.1", 1), 7, Queue(),
+                                                ack_every=3, schedule=self.timers.schedule)
+        self.packet("start", 10)
+        self.sock.acks()
+
+    def packet(self, pck_type, seqno, msg="x"):
+        self.receiver.on_packet_received(util.make_packet(pck_type, seqno, msg))
+
+    def acks(self):
+        return [seqno for seqno, _ in self.sock.acks()]
+
+    def test_in_order_packets_share_an_ack(self):
+        for seqno in (11, 12, 13):
+            self.packet("data", seqno)
+        self.assertEqual(self.acks(), [14])
+        self.assertEqual(self.receiver.ack_counters.saved, 2)
+
+    def test_timer_flushes_a_delayed_ack(self):
+        self.packet("data", 11)
+        self.assertEqual(self.acks(), [])
+        self.timers.fire()
+        self.assertEqual(self.acks(), [12])
+        self.assertEqual(self.receiver.ack_counters.saved, 0)
+
+    def test_gaps_and_duplicates_are_acked_right_away(self):
+        self.packet("data", 12)
+        self.assertEqual(self.acks(), [11])
+        self.packet("data", 11)
+        self.assertEqual(self.acks(), [13])
+        self.packet("data", 11)
+        self.assertEqual(self.acks(), [13])
+        self.packet("end", 13)
+        self.assertEqual(self.acks(), [14])
+
+    def test_without_a_scheduler_every_packet_is_acked(self):
+        receiver = ReliableMessageReceiver(self.sock, ("127.0.0.1", 1), 8, Queue(), ack_every=3)
+        receiver.on_packet_received(util.make_packet("start", 10))
+        receiver.on_packet_received(util.make_packet("data", 11, "x"))
+        self.assertEqual(self.acks(), [11, 12])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+import threading
+import time
+import unittest
+from queue import Queue
+import util
+from reliable_socket import ReceiveBudget, ReliableSocket
+from reliable_transport import ReliableMessageReceiver, ReliableMessageSender
+from TestSupport import RecordingSocket
+
+
+class FlowControlTest(unittest.TestCase):
+    def setUp(self):
+        self.sock = RecordingSocket()
+        self.completed = Queue()
+        self.budget = ReceiveBudget(cap=10, minimum=10)
+        self.receiver = ReliableMessageReceiver(self.sock, ("127.0.0.1", 1), 7, self.completed,
+                                                receive_budget=self.budget)
+
+    def packet(self, pck_type, seqno, msg=""):
+        self.receiver.on_packet_received(util.make_packet(pck_type, seqno, msg))
+
+    def test_budget_applies_the_limit_only_to_unread_messages(self):
+        budget = ReceiveBudget(cap=100, minimum=20, tune_interval=0.05)
+        budget.reserve(30)
+        self.assertEqual(budget.free(), 70)
+        budget.release(30)
+        budget.hold(15)
+        self.assertEqual(budget.free(), 5)
+        time.sleep(0.06)
+        budget.drain(15)
+        self.assertEqual(budget.free(), 100)
+        budget.hold(1)
+        self.assertGreater(budget.limit, 20)
+
+    def test_reassembly_is_charged_and_advertised(self):
+        self.packet("start", 10, "rwnd=1")
+        self.assertEqual(self.sock.acks(), [(11, {"rwnd": "1", "win": "10"})])
+        self.packet("data", 12, "def")
+        self.packet("data", 11, "abc")
+        self.assertEqual(self.budget.held, 6)
+        self.assertEqual(self.sock.acks()[-1], (13, {"win": "4"}))
+        self.packet("end", 13)
+        self.assertEqual(self.completed.get_nowait(), "abcdef")
+        self.assertEqual(self.budget.held, 0)
+
+    def test_data_beyond_the_window_is_dropped(self):
+        self.packet("start", 10, "rwnd=1")
+        self.budget.hold(8)
+        self.packet("data", 11, "abc")
+        self.assertEqual(self.sock.acks()[-1], (11, {"win": "2"}))
+        self.budget.drain(8)
+        self.packet("data", 11, "abc")
+        self.assertEqual(self.sock.acks()[-1], (12, {"win": "7"}))
+
+    def test_start_larger_than_the_window_is_refused(self):
+        self.packet("start", 10, "codec=bin rwnd=1 size=11 chunk=4")
+        self.assertEqual(self.sock.acks(), [])
+        self.packet("start", 10, "codec=bin size=11 chunk=4")
+        self.assertEqual(len(self.sock.acks()), 1)
+
+    def test_text_offers_announce_their_encoded_size(self):
+        sender = ReliableMessageSender(RecordingSocket(), ("127.0.0.1", 1), 7, 4, flow_control=True)
+        _, offer, _ = sender.split_message("h\u00e9llo")
+        self.assertEqual(offer, {"size": 6})
+        sender.flow_control = False
+        self.assertEqual(sender.split_message("hello")[1], {})
+
+    def test_announced_size_is_reserved_up_front(self):
+        self.packet("start", 10, "rwnd=1 size=8")
+        self.assertEqual(self.budget.held, 8)
+        self.assertEqual(self.sock.acks(), [(11, {"rwnd": "1", "win": "10"})])
+        # Other messages take the rest; the room reserved keeps the window open.
+        self.budget.hold(2)
+        self.packet("data", 11, "abcd")
+        self.assertEqual(self.sock.acks()[-1], (12, {"win": "4"}))
+        self.packet("data", 12, "efghi")
+        self.assertEqual(self.sock.acks()[-1], (12, {"win": "4"}))
+        self.packet("data", 12, "efgh")
+        self.packet("end", 13)
+        self.assertEqual(self.completed.get_nowait(), "abcdefgh")
+        self.assertEqual(self.budget.held, 2)
+
+    def test_start_waits_while_the_window_is_taken(self):
+        self.budget.hold(10)
+        self.packet("start", 10, "rwnd=1 size=4")
+        self.assertEqual(self.sock.acks(), [])
+        self.budget.drain(10)
+        self.packet("start", 10, "rwnd=1 size=4")
+        self.assertEqual(len(self.sock.acks()), 1)
+
+    def test_probing_a_window_that_never_opens_is_abandoned(self):
+        sock = RecordingSocket()
+        sender = ReliableMessageSender(sock, ("127.0.0.1", 1), 7, 4)
+        sender.start_packet({})
+        sender.on_start_ack("rwnd=1 win=0")
+        sender.begin_message(iter(["chunk"] * 4), {})
+        now = time.monotonic()
+        for _ in range(util.NUM_OF_STALLED_TIME_OUTS + 2):
+            if sender.advance(now) is None:
+                break
+            # The receiver answers every probe, and its window stays closed.
+            sender.on_acks([util.make_packet("ack", sender.window.base, "win=0")])
+            now += util.MAX_TIME_OUT + 0.1
+        self.assertTrue(sender.abandoned)
+        self.assertEqual(len(sock.sent), util.NUM_OF_STALLED_TIME_OUTS + 1)
+
+    def test_abandoned_chunks_are_released(self):
+        self.packet("start", 10, "rwnd=1")
+        self.packet("data", 11, "ab")
+        self.packet("data", 13, "cd")
+        self.assertEqual(self.budget.held, 4)
+        self.receiver.abandon()
+        self.assertEqual(self.budget.held, 0)
+
+    def test_text_larger_than_the_window_fails(self):
+        receiver = ReliableSocket("127.0.0.1", 0, 32, receive_window=10000)
+        address = receiver.getsockname()
+        sender = ReliableSocket("127.0.0.1", 0, 32, flow_control=True)
+        began = time.monotonic()
+        self.assertFalse(sender.sendto(address, "x" * 20000))
+        self.assertLess(time.monotonic() - began, 10)
+        self.assertTrue(sender.sendto(address, "y" * 5000))
+        self.assertEqual(receiver.recvfrom(timeout=5)[0], "y" * 5000)
+
+    def test_slow_reader_holds_its_sender_back(self):
+        window = 100000
+        receiver = ReliableSocket("127.0.0.1", 0, 32, receive_window=window)
+        address = receiver.getsockname()
+        sender = ReliableSocket("127.0.0.1", 0, 32, binary=True, sack=True, flow_control=True)
+        messages = [bytes([i]) * 20000 for i in range(20)]
+        results = []
+        threading.Thread(target=lambda: results.extend(
+            sender.sendto_bytes(address, message) for message in messages), daemon=True).start()
+        peak = 0
+        for message in messages:
+            time.sleep(0.02)
+            peak = max(peak, receiver.buffered())
+            self.assertEqual(receiver.recvfrom_bytes(timeout=10)[0], message)
+        self.assertLessEqual(peak, window + 20000)
+        deadline = time.monotonic() + 5
+        while len(results) < len(messages) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(all(results) and len(results) == len(messages))
+
+
+if __name__ == "__main__":
+    unittest.main()
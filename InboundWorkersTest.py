@@ -0,0 +1,66 @@
+import contextlib
+import io
+import unittest
+from queue import Queue
+from threading import Event, Thread
+from server import InboundWorkers
+
+
+class InboundWorkersTest(unittest.TestCase):
+    def setUp(self):
+        self.handled = Queue()
+
+    def collect(self, count):
+        return [self.handled.get(timeout=5) for _ in range(count)]
+
+    def test_commands_of_an_address_are_handled_in_order(self):
+        workers = InboundWorkers(lambda message, address: self.handled.put((address, message)),
+                                 workers=4, backlog=8)
+        addresses = [("127.0.0.1", port) for port in range(5000, 5006)]
+        for i in range(50):
+            for address in addresses:
+                workers.submit(i, address)
+        handled = self.collect(50 * len(addresses))
+        for address in addresses:
+            with self.subTest(address=address):
+                self.assertEqual([message for sender, message in handled if sender == address],
+                                 list(range(50)))
+
+    def test_submit_waits_once_the_backlog_is_full(self):
+        started, release = Event(), Event()
+
+        def handle(message, address):
+            started.set()
+            release.wait(5)
+            self.handled.put(message)
+
+        workers = InboundWorkers(handle, workers=1, backlog=2)
+        workers.submit("taken", "a")
+        self.assertTrue(started.wait(5))
+        workers.submit("queued", "a")
+        workers.submit("queued again", "a")
+        submitter = Thread(target=workers.submit, args=("waits", "a"), daemon=True)
+        submitter.start()
+        submitter.join(0.2)
+        self.assertTrue(submitter.is_alive())
+        self.assertEqual(workers.depth(), 2)
+        release.set()
+        submitter.join(5)
+        self.assertFalse(submitter.is_alive())
+        self.assertEqual(self.collect(4), ["taken", "queued", "queued again", "waits"])
+
+    def test_failing_command_does_not_stop_the_worker(self):
+        def handle(message, address):
+            if message == "malformed":
+                raise ValueError(message)
+            self.handled.put(message)
+
+        workers = InboundWorkers(handle, workers=1, backlog=2)
+        with contextlib.redirect_stderr(io.StringIO()):
+            workers.submit("malformed", "a")
+            workers.submit("join", "a")
+            self.assertEqual(self.collect(1), ["join"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+Microbenchmark of the integrity checks of packets.
+
+Measures what each check costs per packet, on the sending side (framing the
+packet) and on the receiving side (validating it), across payload sizes. The
+text framing used by default is measured alongside for comparison.
+
+Usage:
+    python IntegrityBenchmark.py [--sizes 64 1400 65000] [--time 0.2]
+"""
+import argparse
+import os
+import timeit
+import util
+
+
+def measure(statement, budget):
+    """
+    Returns the seconds statement takes per run, repeating it for about
+    budget seconds and keeping the fastest of three rounds.
+    """
+    timer = timeit.Timer(statement)
+    runs, elapsed = timer.autorange()
+    runs = max(1, int(runs * budget / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat=3, number=runs)) / runs
+
+
+def benchmark_binary(integrity, payload, budget):
+    packet = util.make_binary_packet("data", 1234, payload, integrity)
+    send = measure(lambda: util.make_binary_frame("data", 1234, payload, integrity), budget)
+    receive = measure(lambda: util.read_packet(packet, integrity), budget)
+    return send, receive
+
+
+def benchmark_text(payload, budget):
+    message = payload.decode("latin-1")
+    packet = util.make_packet("data", 1234, message)
+    encoded = packet.encode("utf-8")
+    send = measure(lambda: util.make_packet("data", 1234, message).encode("utf-8"), budget)
+    receive = measure(lambda: util.read_packet(encoded), budget)
+    return send, receive
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark packet integrity checks.")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[64, 512, util.CHUNK_SIZE, 8192, 65000],
+                        help="Payload sizes in bytes")
+    parser.add_argument("--time", type=float, default=0.2,
+                        help="Seconds to spend on each measurement")
+    args = parser.parse_args()
+
+    print("%-9s %8s %12s %12s %10s" % ("check", "payload", "send ns", "receive ns", "MB/s"))
+    for size in args.sizes:
+        payload = os.urandom(min(size, util.MAX_DATAGRAM_SIZE - util.BINARY_OVERHEAD - 8))
+        results = [(name, benchmark_binary(name, payload, args.time))
+                   for name in util.INTEGRITY_CHECKS]
+        # Text packets only carry what fits in the harness' 1500 bytes.
+        if size <= util.CHUNK_SIZE:
+            results.append(("text", benchmark_text(payload, args.time)))
+        for name, (send, receive) in results:
+            rate = len(payload) / (send + receive) / 1e6
+            print("%-9s %8d %12.0f %12.0f %10.0f" % (name, len(payload), send * 1e9,
+                                                     receive * 1e9, rate))
+
+
+if __name__ == "__main__":
+    main()
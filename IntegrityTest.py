@@ -0,0 +1,88 @@
+import time
+import unittest
+from queue import Queue
+import util
+from reliable_socket import ReliableSocket
+from reliable_transport import ReliableMessageReceiver, ReliableMessageSender
+from TestSupport import RecordingSocket
+
+
+class IntegrityTest(unittest.TestCase):
+    def setUp(self):
+        self.sock = RecordingSocket()
+        self.completed = Queue()
+        self.receiver = ReliableMessageReceiver(self.sock, ("127.0.0.1", 1), 7, self.completed)
+
+    def start(self, offer):
+        self.receiver.on_packet_received(util.make_packet("start", 10, offer))
+        return self.sock.acks()[0][1]
+
+    def data(self, seqno, msg, integrity):
+        """
+        Returns the seqno of the ACK a data packet drew, or None if it drew none.
+        """
+        self.receiver.on_packet_received(util.make_binary_packet("data", seqno, msg, integrity))
+        acks = self.sock.acks()
+        return acks[-1][0] if acks else None
+
+    def test_checks_detect_a_corrupted_body(self):
+        for integrity in ("crc32", "adler32"):
+            with self.subTest(integrity=integrity):
+                packet = bytearray(util.make_binary_packet("data", 5, b"payload", integrity))
+                self.assertEqual(util.read_packet(bytes(packet), integrity)[2], b"payload")
+                packet[util.BINARY_PREFIX.size] ^= 1
+                self.assertIsNone(util.read_packet(bytes(packet), integrity))
+
+    def test_receiver_agrees_to_the_check_offered(self):
+        for integrity in ("adler32", "none"):
+            with self.subTest(integrity=integrity):
+                self.setUp()
+                self.assertEqual(self.start("codec=bin sum=%s" % integrity).get("sum"), integrity)
+                self.assertEqual(self.data(11, b"ab", integrity), 12)
+                # crc32 is always accepted as well.
+                self.assertEqual(self.data(12, b"cd", "crc32"), 13)
+                self.receiver.on_packet_received(util.make_binary_packet("end", 13))
+                self.assertEqual(self.completed.get_nowait(), b"abcd")
+
+    def test_trailers_not_agreed_to_are_rejected(self):
+        # Such packets are dropped unacknowledged, as corrupted ones are.
+        self.assertNotIn("sum", self.start("codec=bin"))
+        for integrity in ("adler32", "none"):
+            self.assertIsNone(self.data(11, b"ab", integrity))
+        self.setUp()
+        self.assertEqual(self.start("codec=bin sum=adler32").get("sum"), "adler32")
+        self.assertIsNone(self.data(11, b"ab", "none"))
+        self.assertEqual(self.data(11, b"ab", "adler32"), 12)
+
+    def test_unknown_checks_fall_back_to_crc32(self):
+        self.assertNotIn("sum", self.start("codec=bin sum=md5"))
+        self.assertEqual(self.data(11, b"ab", "crc32"), 12)
+
+    def test_sender_uses_the_check_only_if_agreed(self):
+        for accepted, used in (("codec=bin sum=adler32", "adler32"), ("codec=bin", "crc32")):
+            with self.subTest(accepted=accepted):
+                sock = RecordingSocket()
+                sender = ReliableMessageSender(sock, ("127.0.0.1", 1), 7, 4, binary=True,
+                                               integrity="adler32")
+                chunks, offer, fallback = sender.split_message(b"payload")
+                packet, _ = sender.start_packet(offer)
+                self.assertEqual(util.parse_options(util.parse_packet(packet)[2])["sum"], "adler32")
+                sender.on_start_ack(accepted)
+                sender.begin_message(chunks, offer, fallback)
+                sender.advance(time.monotonic())
+                data = sock.packets()[0]
+                self.assertEqual(util.INTEGRITY_NAMES[data[0] >> 4], used)
+                self.assertIsNotNone(util.read_packet(data, used))
+
+    def test_messages_are_received_as_sent(self):
+        receiver = ReliableSocket("127.0.0.1", 0, 8)
+        for integrity in ("adler32", "none"):
+            with self.subTest(integrity=integrity):
+                sender = ReliableSocket("127.0.0.1", 0, 8, binary=True, integrity=integrity)
+                message = "x" * (3 * util.CHUNK_SIZE)
+                self.assertTrue(sender.sendto(receiver.getsockname(), message))
+                self.assertEqual(receiver.recvfrom(timeout=5)[0], message)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import socket
+import threading
+import unittest
+from queue import Empty
+from unittest import mock
+import util
+from reliable_socket import MessageStream, ReliableSocket
+
+
+class MessageStreamTest(unittest.TestCase):
+    def test_chunks_are_read_as_they_arrive(self):
+        stream = MessageStream()
+        stream.feed("abc")
+        stream.feed(b"def")
+        self.assertEqual(stream.read(4), b"abcd")
+        threading.Timer(0.05, stream.close).start()
+        self.assertEqual(stream.read(), b"ef")
+        self.assertEqual(stream.read(), b"")
+
+    def test_read_timeout_keeps_what_arrived(self):
+        stream = MessageStream()
+        stream.feed(b"abc")
+        with self.assertRaises(Empty):
+            stream.read(10, timeout=0.05)
+        stream.feed(b"def")
+        stream.close()
+        self.assertEqual(stream.read(), b"abcdef")
+
+    def test_abort_fails_readers_after_the_chunks_fed(self):
+        stream = MessageStream()
+        stream.feed(b"abc")
+        stream.abort(ConnectionAbortedError("gone"))
+        self.assertEqual(stream.read(3), b"abc")
+        with self.assertRaises(ConnectionAbortedError):
+            stream.read()
+        with self.assertRaises(ConnectionAbortedError):
+            list(stream)
+
+    @mock.patch.object(util, "RECEIVE_IDLE_TIME_OUT", 0.2)
+    def test_abandoned_receiver_aborts_its_stream(self):
+        sock = ReliableSocket("127.0.0.1", 0, 4, streaming=True)
+        address = sock.getsockname()
+        raw = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        raw.sendto(b"s:1:" + util.make_packet("start", 10).encode(), address)
+        raw.sendto(b"s:1:" + util.make_packet("data", 11, "partial").encode(), address)
+        raw.close()
+        stream, _ = sock.recv_stream(timeout=5)
+        self.assertEqual(stream.read(7, timeout=5), b"partial")
+        with self.assertRaises(ConnectionAbortedError):
+            stream.read(timeout=5)
+
+
+if __name__ == "__main__":
+    unittest.main()
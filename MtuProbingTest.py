@@ -0,0 +1,56 @@
+import unittest
+from queue import Queue
+import util
+from reliable_socket import ReliableSocket
+from reliable_transport import ReliableMessageReceiver, ReliableMessageSender
+from TestSupport import RecordingSocket
+
+
+class MtuProbingTest(unittest.TestCase):
+    def test_chunks_leave_room_for_the_longest_header(self):
+        self.assertEqual(util.chunk_size_for(util.MAX_PACKET_SIZE), util.CHUNK_SIZE)
+        longest = "s:%d:" % util.MSG_ID_RANGE[-1] + util.make_packet(
+            "data", 2 ** 32 - 1, "x" * util.CHUNK_SIZE)
+        self.assertLessEqual(len(longest), util.MAX_PACKET_SIZE)
+
+    def test_text_chunks_are_counted_in_bytes(self):
+        chunks = list(util.iter_text_chunks("aé" * 10, 4))
+        self.assertEqual("".join(chunks), "aé" * 10)
+        self.assertTrue(all(len(chunk.encode()) <= 4 for chunk in chunks))
+
+    def test_probes_fill_their_datagram(self):
+        for size in util.PROBE_SIZES:
+            datagram = b"s:%d:" % util.MSG_ID_RANGE[-1] + b"".join(util.make_probe(size))
+            self.assertEqual(len(datagram), size)
+
+    def test_receiver_echoes_probes_without_padding(self):
+        sock = RecordingSocket()
+        receiver = ReliableMessageReceiver(sock, ("127.0.0.1", 1), 7, Queue())
+        receiver.on_packet_received(b"".join(util.make_probe(4096)))
+        _, _, echo = util.parse_datagram(sock.sent[0])
+        self.assertEqual(util.read_packet(echo)[:2], ("probe", 4096))
+        self.assertLess(len(sock.sent[0]), 100)
+
+    def test_sender_raises_its_path_mtu_to_echoed_probes(self):
+        sender = ReliableMessageSender(RecordingSocket(), ("127.0.0.1", 1), 7, 4, probe_mtu=True)
+        sender.send_probes()
+        self.assertEqual(len(sender.sock.sent), len(util.PROBE_SIZES))
+        sender.on_probe_echo(8192)
+        sender.on_probe_echo(1234)
+        self.assertEqual(sender.path_mtu, 8192)
+
+    def test_later_messages_use_the_probed_size(self):
+        receiver = ReliableSocket("127.0.0.1", 0, 8)
+        address = receiver.getsockname()
+        sender = ReliableSocket("127.0.0.1", 0, 8, binary=True, probe_mtu=True)
+        self.assertEqual(sender.path_mtu(address), util.MAX_PACKET_SIZE)
+        self.assertTrue(sender.sendto(address, "probe the path"))
+        self.assertEqual(receiver.recvfrom(timeout=5)[0], "probe the path")
+        self.assertGreater(sender.path_mtu(address), util.MAX_PACKET_SIZE)
+        message = "x" * 100000
+        self.assertTrue(sender.sendto(address, message))
+        self.assertEqual(receiver.recvfrom(timeout=5)[0], message)
+
+
+if __name__ == "__main__":
+    unittest.main()
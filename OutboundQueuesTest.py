@@ -0,0 +1,79 @@
+import unittest
+from concurrent.futures import Future
+from server import OutboundQueues
+
+
+class RecordingSocket:
+    """
+    Stands in for a ReliableSocket, keeping every transmission started on it
+    until the test completes it.
+    """
+    def __init__(self):
+        self.started = []
+
+    def sendto_many_async(self, addresses, message):
+        deliveries = {address: Future() for address in addresses}
+        for address, delivery in deliveries.items():
+            self.started.append((address, message, delivery))
+        return deliveries
+
+    def complete(self):
+        """
+        Acknowledges the oldest transmission, and returns its address and message.
+        """
+        address, message, delivery = self.started.pop(0)
+        delivery.set_result(True)
+        return address, message
+
+
+class OutboundQueuesTest(unittest.TestCase):
+    def setUp(self):
+        self.sock = RecordingSocket()
+        self.queues = OutboundQueues(self.sock, max_in_flight=1, quantum=100)
+
+    def drain(self):
+        sent = []
+        while self.sock.started:
+            sent.append(self.sock.complete())
+        return sent
+
+    def test_messages_are_charged_their_encoded_size(self):
+        self.queues.put(["busy"], "holds the only transmission slot")
+        for _ in range(2):
+            self.queues.put(["wide"], "é" * 100)
+            self.queues.put(["ascii"], "e" * 100)
+        order = [address for address, _ in self.drain()]
+        self.assertEqual(order, ["busy", "ascii", "wide", "ascii", "wide"])
+
+    def test_quanta_for_large_messages_are_credited_at_once(self):
+        self.queues.put(["busy"], "holds the only transmission slot")
+        self.queues.put(["large"], "e" * 1000)
+        self.queues.put(["small"], "e" * 250)
+        self.assertEqual(self.sock.complete()[0], "busy")
+        self.assertEqual([address for address, _, _ in self.sock.started], ["small"])
+        self.assertEqual(self.queues.deficits["large"], 400)
+        self.assertEqual([address for address, _ in self.drain()], ["small", "large"])
+
+    def test_message_many_quanta_large_is_sent_without_a_pass_per_quantum(self):
+        queues = OutboundQueues(self.sock, max_in_flight=1, quantum=1)
+        queues.put(["a"], "e" * 10 ** 7)
+        self.assertEqual(len(self.sock.started), 1)
+
+    def test_messages_to_a_client_keep_their_order(self):
+        for i in range(3):
+            self.queues.put(["a", "b"], str(i))
+        sent = self.drain()
+        self.assertEqual([message for address, message in sent if address == "a"], ["0", "1", "2"])
+        self.assertEqual(self.queues.depth(), 0)
+
+    def test_discarded_client_is_skipped(self):
+        self.queues.put(["a"], "first")
+        self.queues.put(["b"], "lost")
+        self.queues.put(["b"], "lost again")
+        self.queues.discard("b")
+        self.queues.put(["a"], "second")
+        self.assertEqual(self.drain(), [("a", "first"), ("a", "second")])
+
+
+if __name__ == "__main__":
+    unittest.main()
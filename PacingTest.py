@@ -0,0 +1,41 @@
+import time
+import unittest
+from reliable_socket import ReliableSocket
+from reliable_transport import Pacer
+
+
+class PacingTest(unittest.TestCase):
+    def test_fixed_rate_bucket(self):
+        pacer = Pacer(rate=1000.0, burst=0.01)
+        pacer.refill(0.0, 0, None)
+        self.assertEqual(pacer.tokens, 10.0)
+        pacer.consume(30)
+        self.assertFalse(pacer.ready())
+        self.assertAlmostEqual(pacer.delay(), 0.02)
+        pacer.refill(0.025, 0, None)
+        self.assertTrue(pacer.ready())
+        pacer.refill(10.0, 0, None)
+        self.assertEqual(pacer.tokens, 10.0)
+
+    def test_window_rate_follows_the_rtt(self):
+        pacer = Pacer(gain=1.0)
+        pacer.refill(0.0, 10000, None)
+        self.assertTrue(pacer.ready())
+        pacer.consume(10 ** 6)
+        self.assertTrue(pacer.ready())
+        pacer.refill(0.0, 10000, 0.1)
+        self.assertEqual(pacer.current_rate, 100000.0)
+
+    def test_paced_sender_holds_its_rate(self):
+        receiver = ReliableSocket("127.0.0.1", 0, 64)
+        address = receiver.getsockname()
+        sender = ReliableSocket("127.0.0.1", 0, 64, binary=True, pacing_rate=4000000)
+        message = bytes(100000)
+        start = time.monotonic()
+        self.assertTrue(sender.sendto_bytes(address, message))
+        self.assertGreater(time.monotonic() - start, 0.15)
+        self.assertEqual(receiver.recvfrom_bytes(timeout=5)[0], message)
+
+
+if __name__ == "__main__":
+    unittest.main()
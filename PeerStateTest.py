@@ -0,0 +1,97 @@
+import time
+import unittest
+from unittest import mock
+import util
+from reliable_socket import Peer, PeerTable, ReliableSocket
+from reliable_transport import ReliableMessageSender, RenoCongestionControl, RttEstimator
+from TestSupport import RecordingSocket
+
+
+class PeerStateTest(unittest.TestCase):
+    def test_estimator_follows_rfc_6298(self):
+        rtt = RttEstimator(min_rto=0.01)
+        self.assertEqual(rtt.rto, util.TIME_OUT)
+        rtt.on_sample(0.1)
+        self.assertAlmostEqual(rtt.rto, 0.1 + 4 * 0.05)
+        rtt.on_sample(0.1)
+        self.assertAlmostEqual(rtt.rto, 0.1 + 4 * 0.0375)
+        rtt.on_timeout()
+        self.assertAlmostEqual(rtt.rto, 2 * (0.1 + 4 * 0.0375))
+
+    def test_estimator_is_clamped(self):
+        rtt = RttEstimator()
+        rtt.on_sample(0.0001)
+        self.assertEqual(rtt.rto, util.MIN_TIME_OUT)
+        for _ in range(20):
+            rtt.on_timeout()
+        self.assertEqual(rtt.rto, util.MAX_TIME_OUT)
+
+    def test_retransmitted_packets_are_not_sampled(self):
+        for retransmit in (False, True):
+            with self.subTest(retransmit=retransmit):
+                sock = RecordingSocket()
+                sender = ReliableMessageSender(sock, ("127.0.0.1", 1), 7, 4)
+                sender.start_packet({})
+                sender.on_start_ack("")
+                sender.begin_message(iter(["chunk"]), {})
+                now = time.monotonic()
+                sender.advance(now)
+                if retransmit:
+                    sender.advance(now + util.TIME_OUT + 0.1)
+                self.assertEqual(len(sock.sent), 2 if retransmit else 1)
+                sender.on_acks([util.make_packet("ack", sender.start_seq_num + 2)])
+                self.assertEqual(sender.rtt.srtt is None, retransmit)
+
+    def test_fast_retransmit_is_not_sampled(self):
+        sock = RecordingSocket()
+        sender = ReliableMessageSender(sock, ("127.0.0.1", 1), 7, 8)
+        sender.start_packet({})
+        sender.on_start_ack("")
+        sender.begin_message(iter(["chunk"] * 8), {})
+        sender.advance(time.monotonic())
+        self.assertEqual(len(sock.sent), 8)
+        # The window base is lost: the other packets draw duplicate ACKs.
+        base = sender.window.base
+        sender.on_acks([util.make_packet("ack", base)] * 3)
+        self.assertEqual(len(sock.sent), 9)
+        # The recovery takes a while; only the retransmitted base was
+        # resent, so the newest packet acknowledged went out exactly once.
+        for seq in range(base, base + 8):
+            sender.window.get(seq).timestamp -= 2.0
+        sender.on_acks([util.make_packet("ack", base + 8)])
+        self.assertEqual(sender.window.base, base + 8)
+        self.assertIsNone(sender.rtt.srtt)
+
+    def test_peer_seeds_the_next_congestion_control(self):
+        peer = Peer()
+        congestion = RenoCongestionControl(32)
+        congestion.cwnd = 10
+        congestion.on_loss()
+        peer.ssthresh = congestion.ssthresh
+        self.assertEqual(peer.seed(RenoCongestionControl(32)).ssthresh, 5)
+
+    def test_peer_table_forgets_the_least_recently_used(self):
+        peers = PeerTable(capacity=2)
+        first = peers.open(("a", 1))
+        peers.open(("b", 1))
+        self.assertIs(peers.open(("a", 1)), first)
+        peers.open(("c", 1))
+        self.assertIsNone(peers.get(("b", 1)))
+        self.assertIs(peers.get(("a", 1)), first)
+
+    def test_messages_to_a_peer_share_one_estimate(self):
+        receiver = ReliableSocket("127.0.0.1", 0, 4)
+        address = receiver.getsockname()
+        sender = ReliableSocket("127.0.0.1", 0, 4)
+        self.assertEqual(sender.rto(address), util.TIME_OUT)
+        with mock.patch.object(RttEstimator, "on_sample", autospec=True,
+                               side_effect=RttEstimator.on_sample) as on_sample:
+            self.assertTrue(sender.sendto(address, "first"))
+            self.assertTrue(sender.sendto(address, "second"))
+        estimators = {id(call.args[0]): call.args[0] for call in on_sample.call_args_list}
+        self.assertEqual(len(estimators), 1)
+        self.assertEqual(sender.rto(address), estimators.popitem()[1].rto)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import io
+import unittest
+import util
+from reliable_socket import ReliableSocket
+from reliable_transport import ReliableMessageSender
+
+
+class PersistentConnectionTest(unittest.TestCase):
+    def test_idle_timeout_must_stay_below_the_receive_idle_timeout(self):
+        for idle_timeout in (0, util.RECEIVE_IDLE_TIME_OUT, 2 * util.RECEIVE_IDLE_TIME_OUT):
+            with self.subTest(idle_timeout=idle_timeout):
+                with self.assertRaises(ValueError):
+                    ReliableSocket("127.0.0.1", 0, 8, persistent=True, idle_timeout=idle_timeout)
+
+    def test_connection_is_opened_with_binary_framing_offered(self):
+        sender = ReliableMessageSender(None, ("127.0.0.1", 1), 7, 4, persistent=True)
+        self.assertEqual(sender.split_message("hello")[1]["codec"], "bin")
+        sender.persistent = False
+        self.assertEqual(sender.split_message("hello")[1], {})
+
+    def test_bytes_follow_text_over_one_connection(self):
+        receiver = ReliableSocket("127.0.0.1", 0, 8)
+        address = receiver.getsockname()
+        sender = ReliableSocket("127.0.0.1", 0, 8, persistent=True)
+        self.assertTrue(sender.sendto(address, "hello"))
+        self.assertTrue(sender.sendto_bytes(address, b"\x00\x01"))
+        self.assertTrue(sender.send_stream(address, io.BytesIO(b"streamed" * 1000)))
+        self.assertEqual(receiver.recvfrom(timeout=5)[0], "hello")
+        self.assertEqual(receiver.recvfrom_bytes(timeout=5)[0], b"\x00\x01")
+        self.assertEqual(receiver.recvfrom_bytes(timeout=5)[0], b"streamed" * 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
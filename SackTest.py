@@ -0,0 +1,41 @@
+import time
+import unittest
+from queue import Queue
+import util
+from reliable_transport import ReliableMessageReceiver, ReliableMessageSender
+from TestSupport import RecordingSocket
+
+
+class SackTest(unittest.TestCase):
+    def test_blocks_collapse_ranges(self):
+        self.assertEqual(util.make_sack_blocks({12, 5, 6, 7, 9, 11}), "5-7,9-9,11-12")
+        self.assertEqual(util.make_sack_blocks(range(1, 20, 2)),
+                         ",".join("%d-%d" % (n, n) for n in (1, 3, 5, 7)))
+        self.assertEqual(util.parse_sack_blocks("5-7,9-9,junk,11-12"), [(5, 7), (9, 9), (11, 12)])
+
+    def test_receiver_reports_held_packets(self):
+        sock = RecordingSocket()
+        receiver = ReliableMessageReceiver(sock, ("127.0.0.1", 1), 7, Queue())
+        receiver.on_packet_received(util.make_packet("start", 10, "sack=1"))
+        for seqno in (11, 13, 14, 16):
+            receiver.on_packet_received(util.make_packet("data", seqno, "x"))
+        _, seqno, body = sock.read()[-1]
+        self.assertEqual((seqno, util.parse_options(body)), (12, {"sack": "13-14,16-16"}))
+
+    def test_sender_never_retransmits_held_packets(self):
+        sock = RecordingSocket()
+        sender = ReliableMessageSender(sock, ("127.0.0.1", 1), 7, 4, sack=True)
+        sender.start_packet({})
+        sender.on_start_ack("sack=1")
+        sender.begin_message(iter("abcd"), {})
+        now = time.monotonic()
+        sender.advance(now)
+        first = sender.start_seq_num + 1
+        self.assertEqual([packet[2] for packet in sock.read()], list("abcd"))
+        sender.on_acks([util.make_packet("ack", first, "sack=%d-%d" % (first + 2, first + 3))])
+        sender.advance(now + util.TIME_OUT + 0.1)
+        self.assertEqual([packet[2] for packet in sock.read()], ["a", "b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
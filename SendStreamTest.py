@@ -0,0 +1,46 @@
+import io
+import unittest
+import util
+from reliable_socket import ReliableSocket
+
+
+class SendStreamTest(unittest.TestCase):
+    def test_pieces_are_rechunked_whatever_their_size(self):
+        pieces = [b"abc", b"defgh", b"", b"i", b"jklmnopq", b"r"]
+        self.assertEqual(list(util.iter_chunks(pieces, 4)),
+                         [b"abcd", b"efgh", b"ijkl", b"mnop", b"qr"])
+        self.assertEqual(list(util.iter_chunks([], 4)), [])
+
+    def test_str_pieces_are_encoded(self):
+        chunks = list(util.iter_chunks(["hé", "llo", b"!"], 3))
+        self.assertEqual(chunks, [b"h\xc3\xa9", b"llo", b"!"])
+        # A character may straddle two chunks; the bytes join back whole.
+        chunks = list(util.iter_chunks(["é" * 5], 3))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 3, 1])
+        self.assertEqual(b"".join(chunks).decode("utf-8"), "é" * 5)
+
+    def test_file_objects_are_read_as_chunks_are_taken(self):
+        source = io.BytesIO(bytes(range(10)))
+        chunks = util.iter_chunks(source, 4)
+        self.assertEqual(source.tell(), 0)
+        self.assertEqual(next(chunks), bytes(range(4)))
+        self.assertEqual(source.tell(), 4)
+        self.assertEqual(list(chunks), [bytes(range(4, 8)), bytes(range(8, 10))])
+        text = io.StringIO("café " * 3)
+        self.assertEqual(b"".join(util.iter_chunks(text, 4)), ("café " * 3).encode("utf-8"))
+
+    def test_streams_are_received_as_one_message(self):
+        receiver = ReliableSocket("127.0.0.1", 0, 8)
+        sender = ReliableSocket("127.0.0.1", 0, 8)
+        address = receiver.getsockname()
+        pieces = [b"x" * 1000, "y" * 2500, b"z" * 7, b"w" * util.CHUNK_SIZE]
+        self.assertTrue(sender.send_stream(address, iter(pieces)))
+        expected = b"".join(piece if isinstance(piece, bytes) else piece.encode() for piece in pieces)
+        self.assertEqual(receiver.recvfrom_bytes(timeout=5)[0], expected)
+        data = bytes(range(256)) * 100
+        self.assertTrue(sender.send_stream(address, io.BytesIO(data)))
+        self.assertEqual(receiver.recvfrom_bytes(timeout=5)[0], data)
+
+
+if __name__ == "__main__":
+    unittest.main()
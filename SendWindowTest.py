@@ -0,0 +1,63 @@
+import unittest
+from reliable_transport import SendWindow
+
+
+class SendWindowTest(unittest.TestCase):
+    def test_packets_are_found_by_sequence_number(self):
+        window = SendWindow(4, 100)
+        for seq in range(100, 104):
+            window.push("p%d" % seq)
+        self.assertEqual(len(window), 4)
+        self.assertEqual(window.get(102).packet, "p102")
+        self.assertIsNone(window.get(99))
+        self.assertIsNone(window.get(104))
+
+    def test_slots_are_reused_across_the_capacity(self):
+        window = SendWindow(4, 100)
+        slots = [window.push(seq) for seq in range(100, 104)]
+        # Slide the window by hand as cumulative ACKs do, many times round.
+        for seq in range(104, 140):
+            self.assertTrue(window.forget(window.base))
+            window.base += 1
+            self.assertIs(window.push(seq), slots[seq % 4])
+            self.assertEqual(len(window), 4)
+        for seq in range(136, 140):
+            self.assertEqual(window.get(seq).packet, seq)
+        self.assertIsNone(window.get(135))
+
+    def test_forgotten_slots_stay_empty_until_reused(self):
+        window = SendWindow(4, 100)
+        for seq in range(100, 104):
+            window.push(seq)
+        # A selective ACK drops packets above the base.
+        window.get(102).retransmitted = True
+        self.assertTrue(window.forget(102))
+        self.assertFalse(window.forget(102))
+        self.assertIsNone(window.get(102))
+        self.assertEqual(len(window), 3)
+        # The base slides past the hole without counting it twice.
+        for seq in range(100, 103):
+            window.forget(seq)
+        window.base = 103
+        self.assertEqual(len(window), 1)
+        self.assertEqual(window.get(103).packet, 103)
+        # Its slot comes back for the packet capacity numbers later.
+        window.push(104)
+        window.push(105)
+        window.push(106)
+        self.assertEqual(window.get(106).packet, 106)
+        self.assertFalse(window.get(106).retransmitted)
+
+    def test_retransmissions_are_remembered_after_a_selective_ack(self):
+        window = SendWindow(4, 100)
+        for seq in range(100, 102):
+            window.push(seq)
+        window.get(100).retransmitted = True
+        window.forget(100)
+        self.assertTrue(window.was_retransmitted(100))
+        self.assertFalse(window.was_retransmitted(101))
+        self.assertFalse(window.was_retransmitted(102))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import multiprocessing
+import time
+import unittest
+from queue import Queue
+import util
+from server import Server
+
+
+class RecordingOutbound:
+    """
+    Stands in for OutboundQueues, keeping every message queued on it.
+    """
+    def __init__(self):
+        self.queued = Queue()
+
+    def put(self, addresses, message):
+        self.queued.put((list(addresses), message))
+
+    def discard(self, address):
+        pass
+
+    def get(self):
+        return self.queued.get(timeout=5)
+
+
+class ServerRoutingTest(unittest.TestCase):
+    def setUp(self):
+        # Two workers of one server, as start_workers runs them, in one process
+        self.inboxes = [Queue(), Queue()]
+        client_count = multiprocessing.Value("i", 0)
+        self.workers = [Server("127.0.0.1", 0, 3, worker, self.inboxes, client_count)
+                        for worker in range(2)]
+        for server in self.workers:
+            server.outbound = RecordingOutbound()
+        self.alice = {"username": "alice", "address": ("127.0.0.1", 1), "worker": 0}
+        self.bob = {"username": "bob", "address": ("127.0.0.1", 2), "worker": 1}
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_deliver_keeps_own_clients_and_forwards_the_others(self):
+        server = Server("127.0.0.1", 0, 3, 0, [Queue(), Queue()])
+        deliveries = []
+        server.deliver(self.alice, "hi", deliveries)
+        server.deliver(self.bob, "hi", deliveries)
+        self.assertEqual(deliveries, [self.alice["address"]])
+        self.assertEqual(server.inboxes[1].get_nowait(), ("forward", self.bob["address"], "hi"))
+        self.assertTrue(server.inboxes[0].empty())
+
+    def test_inbox_applies_joins_leaves_and_forwards(self):
+        server = self.workers[0]
+        self.inboxes[0].put(("join", self.bob))
+        self.wait_for(lambda: server.clients.find("bob") == self.bob)
+        self.inboxes[0].put(("forward", self.alice["address"], "hello"))
+        self.assertEqual(server.outbound.get(), ([self.alice["address"]], "hello"))
+        self.inboxes[0].put(("leave", self.bob))
+        self.wait_for(lambda: server.clients.find("bob") is None)
+
+    def test_messages_reach_the_clients_of_other_workers(self):
+        first, second = self.workers
+        first.handle("join alice", self.alice["address"])
+        second.handle("join bob", self.bob["address"])
+        for server in self.workers:
+            self.wait_for(lambda: sorted(server.clients.usernames()) == ["alice", "bob"])
+        first.handle("send_message 2 bob alice hi there", self.alice["address"])
+        # alice is sent the message by her own worker, bob by his.
+        expected = util.make_message("forward_message", 4, "1 alice hi there")
+        self.assertEqual(first.outbound.get(), ([self.alice["address"]], expected))
+        self.assertEqual(second.outbound.get(), ([self.bob["address"]], expected))
+        second.handle("disconnect bob", self.bob["address"])
+        self.wait_for(lambda: first.clients.find("bob") is None)
+        self.assertEqual(first.client_count.value, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
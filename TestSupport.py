@@ -0,0 +1,33 @@
+import util
+
+
+class RecordingSocket:
+    """
+    Stands in for a UDP socket, keeping every datagram sent on it.
+    """
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append(bytes(data))
+
+    def packets(self):
+        """
+        Returns the packets sent, without their `<sender_type>:<msg_id>:` prefix.
+        """
+        return [bytes(util.parse_datagram(datagram)[2]) for datagram in self.sent]
+
+    def read(self):
+        """
+        Returns the (type, seqno, body) of every packet sent, and forgets them.
+        """
+        packets = [util.read_packet(packet) for packet in self.packets()]
+        self.sent = []
+        return packets
+
+    def acks(self):
+        """
+        Returns the (seqno, options) of every ACK sent, and forgets them.
+        """
+        return [(seqno, util.parse_options(body))
+                for pck_type, seqno, body in self.read() if pck_type == "ack"]
@@ -0,0 +1,70 @@
+import unittest
+import util
+from reliable_transport import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel()
+        self.now = self.wheel.cursor * self.wheel.tick
+        self.revolution = self.wheel.size * self.wheel.tick
+
+    def test_only_passed_deadlines_expire(self):
+        self.wheel.schedule(1, self.now + 0.010)
+        self.wheel.schedule(2, self.now + 0.005)
+        self.wheel.schedule(3, self.now + 0.200)
+        self.assertEqual(self.wheel.expired(self.now + 0.001), [])
+        self.assertEqual(sorted(self.wheel.expired(self.now + 0.010)), [1, 2])
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(self.wheel.expired(self.now + 0.300), [3])
+
+    def test_deadlines_wait_for_their_revolution(self):
+        # The longest RTO spans several revolutions of the wheel.
+        self.assertGreater(util.MAX_TIME_OUT, 3 * self.revolution)
+        self.wheel.schedule(1, self.now + util.MAX_TIME_OUT)
+        self.wheel.schedule(2, self.now + 0.010)
+        self.wheel.schedule(3, self.now + 0.010 + self.revolution)
+        self.assertEqual(self.wheel.expired(self.now + 0.011), [2])
+        # Walk the wheel round several times, as a sender waiting for ACKs does.
+        expired_at = {}
+        for step in range(1, int(util.MAX_TIME_OUT / 0.05) + 1):
+            now = self.now + step * 0.05
+            for key in self.wheel.expired(now):
+                expired_at[key] = now
+        self.assertEqual(sorted(expired_at), [1, 3])
+        self.assertAlmostEqual(expired_at[3], self.now + 0.05 * 21)
+        self.assertAlmostEqual(expired_at[1], self.now + util.MAX_TIME_OUT)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_a_late_call_catches_up_with_every_revolution(self):
+        for key, delay in enumerate((0.1, 1.5, 2.5, 4.0)):
+            self.wheel.schedule(key, self.now + delay)
+        self.assertEqual(sorted(self.wheel.expired(self.now + 10)), [0, 1, 2, 3])
+
+    def test_cancelled_deadlines_never_expire(self):
+        self.wheel.schedule(1, self.now + 0.010)
+        self.wheel.schedule(2, self.now + 0.020)
+        self.wheel.cancel(1)
+        self.wheel.cancel(1)
+        self.assertEqual(len(self.wheel), 1)
+        # Scheduling again moves the deadline instead of adding one.
+        self.wheel.schedule(2, self.now + 2.0)
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(self.wheel.expired(self.now + 1.0), [])
+        self.assertEqual(self.wheel.expired(self.now + 2.0), [2])
+
+    def test_next_timeout_across_revolutions(self):
+        self.assertIsNone(self.wheel.next_timeout(self.now))
+        self.wheel.schedule(1, self.now + util.MAX_TIME_OUT)
+        # Beyond this revolution: wake up once it is over to look again.
+        self.assertAlmostEqual(self.wheel.next_timeout(self.now), self.revolution)
+        later = self.now + util.MAX_TIME_OUT - 0.5
+        self.assertEqual(self.wheel.expired(later), [])
+        self.assertAlmostEqual(self.wheel.next_timeout(later), 0.5)
+        self.wheel.schedule(2, self.now + 0.020)
+        self.wheel.schedule(3, later - 1)
+        self.assertEqual(self.wheel.next_timeout(later), 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,404 @@
+import asyncio
+import socket
+import time
+import traceback
+from dataclasses import replace
+from itertools import count
+from random import randrange
+from typing import List, Tuple, Union
+import util
+from reliable_socket import (CompletedMessages, ConnectionTable, PeerTable, ReceiveBudget,
+                             SocketOptions)
+from reliable_transport import (ReliableMessageSender, ReliableMessageReceiver,
+                                AckCounters, Pacer, CONGESTION_CONTROLS)
+
+Address = Tuple[str, int]
+MsgID = int
+
+
+class AsyncMessageSender:
+    """
+    Drives a ReliableMessageSender from the event loop.
+
+    The sender's non-blocking steps are used as is; ACKs are collected as they
+    are received, and waiting for them is bounded by a loop timer set at the
+    earliest retransmission deadline instead of a blocking queue timeout.
+    """
+
+    def __init__(self, sender: ReliableMessageSender, loop: asyncio.AbstractEventLoop):
+        self.sender = sender
+        self.__loop = loop
+        self.__acks: List[Union[str, bytes]] = []
+        self.__waiter: asyncio.Future = None
+
+    def on_packet_received(self, packet: Union[str, bytes]):
+        """
+        Collects an ACK and wakes up the transmission waiting for it.
+        """
+        self.__acks.append(packet)
+        self.__wake_up()
+
+    async def send_message(self, message: Union[str, bytes]) -> bool:
+        """
+        Reliably sends a message, as ReliableMessageSender.send_message does.
+        """
+        sender = self.sender
+        chunks, offer, fallback = sender.split_message(message)
+
+        if not sender.connected:
+            sender.send_probes()
+            start_ack = await self.__send_reliably(*sender.start_packet(offer), sender.send)
+            if start_ack is None:
+                return False  # Failed to send start packet reliably
+            sender.on_start_ack(start_ack)
+        if not sender.begin_message(chunks, offer, fallback):
+            return False
+
+        # ACKs collected during the handshake are stale by now.
+        self.__acks.clear()
+        while True:
+            timeout = sender.advance(time.monotonic())
+            if timeout is None:
+                break  # Every chunk was sent and acknowledged, or abandoned.
+            sender.on_acks(await self.__wait_for_acks(timeout))
+
+        if sender.abandoned:
+            return False  # The receiver stopped acknowledging anything.
+        return sender.connected or await self.close()
+
+    async def close(self) -> bool:
+        """
+        Reliably sends the end packet. Returns whether it was acknowledged.
+        """
+        end_ack = await self.__send_reliably(*self.sender.end_packet(), self.sender.send_packet)
+        return end_ack is not None
+
+    async def __send_reliably(self, packet, ack_seq_num: int, send):
+        """
+        Sends a start or end packet until it is acknowledged with ack_seq_num,
+        giving up after util.NUM_OF_RETRANSMISSIONS timeouts.
+        Returns the body of the ACK, or None if it never arrived.
+        """
+        rtt = self.sender.rtt
+        for attempt in range(util.NUM_OF_RETRANSMISSIONS):
+            send(packet)
+            sent_at = time.monotonic()
+            deadline = sent_at + rtt.rto
+            while time.monotonic() < deadline:
+                for ack in await self.__wait_for_acks(deadline - time.monotonic()):
+                    ack = util.read_packet(ack)
+                    if ack is not None and ack[0] == "probe":
+                        self.sender.on_probe_echo(ack[1])
+                    if ack is not None and ack[0] == "ack" and ack[1] == ack_seq_num:
+                        if attempt == 0:
+                            rtt.on_sample(time.monotonic() - sent_at)
+                        return ack[2]
+            rtt.on_timeout()
+        return None
+
+    async def __wait_for_acks(self, timeout: float) -> list:
+        """
+        Returns the ACKs collected so far, waiting at most timeout seconds
+        for one if there are none.
+        """
+        if not self.__acks:
+            self.__waiter = self.__loop.create_future()
+            timer = self.__loop.call_later(max(timeout, 0), self.__wake_up)
+            try:
+                await self.__waiter
+            finally:
+                timer.cancel()
+                self.__waiter = None
+        acks, self.__acks = self.__acks, []
+        return acks
+
+    def __wake_up(self):
+        if self.__waiter is not None and not self.__waiter.done():
+            self.__waiter.set_result(None)
+
+
+class AsyncReliableSocket(asyncio.DatagramProtocol):
+    """
+    This is an asyncio socket that reliably transports messages.
+
+    Description:
+        This socket is the asyncio counterpart of ReliableSocket. It is a
+        DatagramProtocol: every packet is handled on the event loop as it is
+        received, and every transmission is a coroutine that drives a
+        ReliableMessageSender with loop timers, so no threads are used and one
+        process can hold thousands of concurrent transfers. Messages are
+        received by the same ReliableMessageReceiver as in ReliableSocket, and
+        both sockets interoperate.
+
+    APIs:
+        await AsyncReliableSocket.create(dest, port, window_size)
+            Creates a socket bound to (dest, port)
+        await AsyncReliableSocket.sendto(receiver_addr, message)
+            Sends a message to an address
+        await AsyncReliableSocket.sendto_bytes(receiver_addr, data)
+            Sends a bytes-like payload to an address without text encoding
+        await AsyncReliableSocket.recvfrom()
+            Receives a message sent to the socket
+        await AsyncReliableSocket.recvfrom_bytes()
+            Receives a message sent to the socket as bytes
+        AsyncReliableSocket.rto(receiver_addr)
+            Returns the current retransmission timeout towards an address
+        AsyncReliableSocket.path_mtu(receiver_addr)
+            Returns the largest datagram sent to an address
+        AsyncReliableSocket.ack_stats()
+            Returns how many ACKs the socket's receivers sent and saved
+        AsyncReliableSocket.getsockname()
+            Returns the address the socket is bound to
+        AsyncReliableSocket.close()
+            Closes the socket
+
+    Options are a SocketOptions, or keyword arguments that override it, and
+    work as in ReliableSocket; delayed ACKs are flushed by loop timers, and
+    pacing delays are waited out on loop timers too, so they are only as
+    precise as the loop's clock. Use asyncio.wait_for to bound how long
+    sendto and recvfrom may take. Senders and receivers have the same
+    lifecycle as in ReliableSocket, bounded by max_connections.
+    """
+    def __init__(self, window_size, options: SocketOptions = None, **overrides):
+        options = replace(options or SocketOptions(), **overrides)
+        if (options.streaming or options.persistent or options.batching
+                or options.reuse_port):
+            raise ValueError("streaming, persistent, batching and reuse_port "
+                             "are not supported by AsyncReliableSocket")
+        self.__window_size = window_size
+        self.__recv_buffer = options.recv_buffer
+        self.__binary = options.binary
+        self.__congestion_control = CONGESTION_CONTROLS[options.congestion_control]
+        self.__sack = options.sack
+        self.__compress = options.compress
+        self.__probe_mtu = options.probe_mtu
+        self.__integrity = options.integrity
+        self.__pacing = options.pacing or options.pacing_rate is not None
+        self.__pacing_rate = None if options.pacing_rate is None else options.pacing_rate / 8
+        self.__flow_control = options.flow_control
+        self.__budget = ReceiveBudget(options.receive_window)
+        self.__ack_every = options.ack_every
+        self.__ack_delay = options.ack_delay
+        self.__ack_counters = AckCounters()
+        self.__loop = asyncio.get_running_loop()
+        self.__transport: asyncio.DatagramTransport = None
+
+        self.__senders = ConnectionTable(options.max_connections)
+        self.__receivers = ConnectionTable(options.max_connections,
+                                           idle_timeout=util.RECEIVE_IDLE_TIME_OUT,
+                                           on_evict=ReliableMessageReceiver.abandon)
+        self.__msg_ids = count(randrange(len(util.MSG_ID_RANGE)))
+        self.__peers = PeerTable(options.max_connections)
+
+        self.__received_messages = asyncio.Queue()
+
+    @classmethod
+    async def create(cls, dest, port, window_size, options: SocketOptions = None,
+                     **overrides) -> "AsyncReliableSocket":
+        """
+        Creates a socket bound to (dest, port). The options are those of the
+        constructor.
+        """
+        loop = asyncio.get_running_loop()
+        sock = cls(window_size, options, **overrides)
+        await loop.create_datagram_endpoint(lambda: sock, local_addr=(dest, port))
+        return sock
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.__transport = transport
+        transport.get_extra_info("socket").setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, self.__recv_buffer)
+        self.__expiry = self.__loop.call_later(util.RECEIVE_IDLE_TIME_OUT / 2,
+                                               self.__expire_receivers)
+
+    def __expire_receivers(self):
+        """
+        Abandons idle receivers even while no packet arrives.
+        """
+        self.__receivers.expire()
+        self.__expiry = self.__loop.call_later(util.RECEIVE_IDLE_TIME_OUT / 2,
+                                               self.__expire_receivers)
+
+    def datagram_received(self, data: bytes, addr: Address):
+        """
+        Redirects a received packet to its reliable message sender/receiver.
+        Every datagram has its own buffer, so packets are never copied.
+        """
+        try:
+            sender_type, msg_id, packet = util.parse_datagram(data)
+
+            if sender_type == "r":
+                # this belongs to a sender
+                sender = self.__senders.get((addr, msg_id))
+                if sender is not None:
+                    sender.on_packet_received(packet)
+            else:
+                # this belongs to a receiver
+                self.__send_to_a_receiver(addr, msg_id, packet)
+        except Exception:
+            # A malformed packet must not stop the socket from receiving, nor
+            # reach the event loop's exception handler.
+            traceback.print_exc()
+
+    def __send_to_a_receiver(self, addr, msg_id: int, packet):
+        """
+        Redirects received packet to the corresponding message receiver.
+        If no such receiver is found, a new message receiver is initialized.
+        """
+        receiver = self.__receivers.get((addr, msg_id))
+        if receiver is None:
+            receiver = ReliableMessageReceiver(
+                self.__transport, addr, msg_id,
+                CompletedMessages(self.__on_message_completed, (addr, msg_id)),
+                ack_every=self.__ack_every, ack_delay=self.__ack_delay,
+                schedule=self.__loop.call_later, ack_counters=self.__ack_counters,
+                receive_budget=self.__budget, compress=self.__compress)
+            if not self.__receivers.add((addr, msg_id), receiver):
+                return  # No room for it: the sender retransmits its start.
+        receiver.on_packet_received(packet)
+
+    def __on_message_completed(self, key, received_msg):
+        """
+        Queues a message completed by a receiver, and moves the receiver to
+        TIME_WAIT once its transmission (or persistent connection) is over.
+        """
+        receiver = self.__receivers.get(key)
+        if received_msg is not None:
+            self.__budget.hold(len(received_msg))
+            self.__received_messages.put_nowait((received_msg, key[0]))
+        if received_msg is None or receiver is None or not receiver.connection:
+            self.__receivers.finish(key)
+
+    async def recvfrom(self) -> Tuple[str, Address]:
+        """
+        Returns a reliably received message on the socket, waiting for one if
+        necessary.
+
+        Returns:
+            Tuple[str, Address]:
+                A tuple of
+                    (i)  the received message, and
+                    (ii) the address from where the message is received from
+        """
+
+        message, addr = await self.__received_messages.get()
+        self.__budget.drain(len(message))
+        if not isinstance(message, str):
+            message = message.decode("utf-8")
+        return message, addr
+
+    async def recvfrom_bytes(self) -> Tuple[bytes, Address]:
+        """
+        Returns a reliably received message on the socket as bytes, without
+        decoding binary messages. Waits like recvfrom.
+        """
+
+        message, addr = await self.__received_messages.get()
+        self.__budget.drain(len(message))
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        return message, addr
+
+    async def sendto(self, receiver_addr: Address, message: str) -> bool:
+        """
+        Send message to an address reliably.
+
+        Args:
+            receiver_addr (Address): Address of destination
+            message (str): Message to send to the destination
+
+        Returns:
+            bool: Whether the message was acknowledged by the destination.
+        """
+
+        return await self.__send_message_reliably(receiver_addr, message)
+
+    async def sendto_bytes(self, receiver_addr: Address,
+                           data: Union[bytes, bytearray, memoryview]) -> bool:
+        """
+        Send a bytes-like payload to an address reliably, always in binary
+        framing and without copying it into packets.
+
+        Returns:
+            bool: Whether the payload was acknowledged by the destination.
+        """
+
+        return await self.__send_message_reliably(receiver_addr, data)
+
+    def rto(self, receiver_addr: Address) -> float:
+        """
+        Returns the retransmission timeout towards an address, shared by all
+        transmissions to it, or util.TIME_OUT if nothing has been sent there yet.
+        """
+
+        peer = self.__peers.get(receiver_addr)
+        return util.TIME_OUT if peer is None else peer.rtt.rto
+
+    def path_mtu(self, receiver_addr: Address) -> int:
+        """
+        Returns the largest datagram probing found to get through to an
+        address, or util.MAX_PACKET_SIZE if it was never probed.
+        """
+
+        peer = self.__peers.get(receiver_addr)
+        if peer is None or peer.path_mtu is None:
+            return util.MAX_PACKET_SIZE
+        return peer.path_mtu
+
+    def ack_stats(self) -> AckCounters:
+        """
+        Returns how many ACKs the receivers of this socket sent, and how many
+        were saved by delaying them.
+        """
+
+        return AckCounters(self.__ack_counters.sent, self.__ack_counters.saved)
+
+    def getsockname(self) -> Address:
+        """
+        Returns the address the socket is bound to, e.g. to learn the port
+        picked when it was created with port 0.
+        """
+
+        return self.__transport.get_extra_info("sockname")
+
+    def close(self):
+        """
+        Closes the underlying transport. Transmissions in progress are abandoned.
+        """
+
+        if self.__transport is not None:
+            self.__transport.close()
+            self.__expiry.cancel()
+
+    def __get_unique_msg_id(self, recvr_addr):
+        msg_id = util.MSG_ID_RANGE[next(self.__msg_ids) % len(util.MSG_ID_RANGE)]
+        while (recvr_addr, msg_id) in self.__senders:
+            msg_id = util.MSG_ID_RANGE[next(self.__msg_ids) % len(util.MSG_ID_RANGE)]
+        return msg_id
+
+    async def __send_message_reliably(self, recvr_addr, message):
+        """
+        Sends a message reliably with a new message sender, which moves to
+        TIME_WAIT once the transmission is over.
+        """
+
+        msg_id = self.__get_unique_msg_id(recvr_addr)
+        peer = self.__peers.open(recvr_addr)
+
+        sender = ReliableMessageSender(
+            self.__transport, recvr_addr, msg_id, self.__window_size, self.__binary, rtt=peer.rtt,
+            congestion=peer.seed(self.__congestion_control(self.__window_size)), sack=self.__sack,
+            compress=self.__compress, packet_size=self.path_mtu(recvr_addr),
+            probe_mtu=self.__probe_mtu and peer.path_mtu is None,
+            integrity=self.__integrity,
+            pacer=Pacer(self.__pacing_rate) if self.__pacing else None,
+            flow_control=self.__flow_control)
+
+        async_sender = AsyncMessageSender(sender, self.__loop)
+        if not self.__senders.add((recvr_addr, msg_id), async_sender):
+            return False
+        try:
+            return await async_sender.send_message(message)
+        finally:
+            peer.remember(sender)
+            self.__senders.finish((recvr_addr, msg_id))
@@ -5,6 +5,7 @@ import sys
 import getopt
 import socket
 import random
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 import os
 import util
@@ -26,6 +27,9 @@ class Client:
         self.name = username
         # This variable is used for inter-thread communication and to simultaneously close both the threads
         self.connected = True
+        # Commands are sent to the server one at a time, in the order they were typed, by a single background
+        # worker, so the input loop is not blocked by file transfers and a later command never overtakes them
+        self.outbox = ThreadPoolExecutor(max_workers=1)
 
     def start(self):
 
@@ -71,9 +75,10 @@ class Client:
                 print("incorrect userinput format")
                 continue
 
-            self.reliable_sock.sendto(
-                (self.server_addr, self.server_port), message_to_send)
+            self.send_to_server(message_to_send)
 
+        # Everything typed, files included, must reach the server before the client exits
+        self.outbox.shutdown(wait=True)
         time.sleep(1)  # Ensure all the messages are received by the server
 
     def receive_handler(self):
@@ -109,6 +114,16 @@ class Client:
                 file.close()
                 print("file:", message_parts[2]+":", filename)
 
+    # This function queues a command behind the ones typed before it and reports it if the server never acknowledged it
+    def send_to_server(self, message):
+        def check(transfer):
+            if transfer.exception() is not None or not transfer.result():
+                print("failed to send:", message.split(" ")[0])
+
+        transfer = self.outbox.submit(
+            self.reliable_sock.sendto, (self.server_addr, self.server_port), message)
+        transfer.add_done_callback(check)
+
     def help(self):
         # This function prints a list of all possible user inputs and their formats
         help_output = """This is a list of all possible user inputs and their formats.
@@ -155,8 +170,8 @@ class Client:
             message_to_send = util.make_message(
                 msg_type="send_file", msg_format=4, message=user_input[index_of_first_space + 1:] + " " + file_content)
             # packet_to_send = util.make_packet(msg=message_to_send)
-            self.reliable_sock.sendto(
-                (self.server_addr, self.server_port), message_to_send)
+            # The file is sent in the background, so the user can keep typing commands meanwhile
+            self.send_to_server(message_to_send)
         except:
             print("The specified file does not exist.")
 
@@ -1,14 +1,555 @@
+import select
 import socket
-from typing import Dict, Tuple
-from queue import Queue
-from threading import Thread
-from random import randint
-from reliable_transport import ReliableMessageSender, ReliableMessageReceiver
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from itertools import count
+from typing import Callable, Dict, Tuple, Union
+from queue import Empty, Queue
+from threading import Lock, Thread, Timer, current_thread
+from random import randrange
+import util
+from reliable_transport import (ReliableMessageSender, ReliableMessageReceiver, RttEstimator,
+                                AckCounters, CongestionControl, Pacer, RenoCongestionControl,
+                                SharedMessage, TimerWheel, CONGESTION_CONTROLS)
 
 Address = Tuple[str, int]
 MsgID = int
 
 
+class MessageStream:
+    """
+    A file-like reader over a message that may still be arriving.
+
+    Chunks are handed over by the message receiver as soon as they are in
+    order, so reading can start long before the whole message is received.
+    Iterating yields the chunks as bytes; read() blocks until it can return
+    the requested amount or the message is complete. If the receiver gives
+    up on the message before it is complete, both raise the error it was
+    aborted with.
+    """
+    def __init__(self, message: Union[str, bytes] = None, budget: "ReceiveBudget" = None):
+        self.__chunks = Queue()
+        self.__leftover = b""
+        self.__complete = False
+        self.__budget = budget
+        if message is not None:
+            self.feed(message)
+            self.close()
+
+    def feed(self, chunk: Union[str, bytes]):
+        """
+        Appends an in-order chunk of the message.
+        """
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        if chunk:
+            if self.__budget is not None:
+                self.__budget.hold(len(chunk))
+            self.__chunks.put(chunk)
+
+    def close(self):
+        """
+        Marks the message as complete.
+        """
+        self.__chunks.put(None)
+
+    def abort(self, error: Exception):
+        """
+        Marks the message as incomplete for good: reading past the chunks
+        already fed raises error.
+        """
+        self.__chunks.put(error)
+
+    def __next_chunk(self, timeout: float = None) -> bytes:
+        if self.__leftover:
+            chunk, self.__leftover = self.__leftover, b""
+            return chunk
+        if isinstance(self.__complete, Exception):
+            raise self.__complete
+        if self.__complete:
+            return None
+        chunk = self.__chunks.get(timeout=timeout)
+        if isinstance(chunk, Exception):
+            self.__complete = chunk
+            raise chunk
+        if chunk is None:
+            self.__complete = True
+        elif self.__budget is not None:
+            self.__budget.drain(len(chunk))
+        return chunk
+
+    def __iter__(self):
+        chunk = self.__next_chunk()
+        while chunk is not None:
+            yield chunk
+            chunk = self.__next_chunk()
+
+    def read(self, size: int = -1, timeout: float = None) -> bytes:
+        """
+        Reads up to size bytes, or the rest of the message if size is negative.
+        Returns b"" once the whole message has been read.
+
+        If timeout is a positive number, it blocks at most timeout seconds and
+        raises the queue.Empty exception if the bytes did not arrive within
+        that time; nothing is consumed then, so read can be called again.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        parts = []
+        wanted = size
+        try:
+            while size < 0 or wanted > 0:
+                remaining = None if deadline is None else max(0, deadline - time.monotonic())
+                chunk = self.__next_chunk(remaining)
+                if chunk is None:
+                    break
+                if 0 <= wanted < len(chunk):
+                    chunk, self.__leftover = chunk[:wanted], chunk[wanted:]
+                parts.append(chunk)
+                wanted -= len(chunk)
+        except Empty:
+            self.__leftover = b"".join(parts) + self.__leftover
+            raise
+        return b"".join(parts)
+
+
+class ReceiveBudget:
+    """
+    The receive buffer space of a socket: the bytes its receivers hold while
+    they reassemble messages, plus the bytes of messages waiting for the
+    application to read them. Receivers advertise free() to senders that
+    offer flow control.
+
+    While the application has read everything, the whole cap is free to
+    reassemble messages in. Otherwise the limit applies, which starts at
+    minimum and is tuned every tune_interval seconds to twice what the
+    application read in that time, up to cap, so a socket read quickly lets
+    senders run ahead while one read slowly holds them back.
+    """
+
+    def __init__(self, cap=util.RECEIVE_WINDOW_CAP, minimum=util.RECEIVE_WINDOW_MIN,
+                 tune_interval=util.RECEIVE_TUNE_INTERVAL):
+        self.cap = cap
+        self.__minimum = min(minimum, cap)
+        self.__tune_interval = tune_interval
+        self.__lock = Lock()
+        self.limit = self.__minimum
+        self.held = 0
+        self.unread = 0
+        self.__drained = 0
+        self.__tuned = time.monotonic()
+
+    def free(self) -> int:
+        """
+        Returns how many more bytes may be held.
+        """
+        with self.__lock:
+            self.__tune()
+            return max(0, (self.limit if self.unread else self.cap) - self.held)
+
+    def reserve(self, size: int):
+        """
+        Counts size bytes held by a receiver until it hands them over.
+        """
+        with self.__lock:
+            self.held += size
+
+    def release(self, size: int):
+        """
+        Counts size bytes a receiver no longer holds.
+        """
+        with self.__lock:
+            self.held = max(0, self.held - size)
+
+    def hold(self, size: int):
+        """
+        Counts size bytes handed over to the application and not read yet.
+        """
+        with self.__lock:
+            self.held += size
+            self.unread += size
+
+    def drain(self, size: int):
+        """
+        Counts size bytes read by the application.
+        """
+        with self.__lock:
+            self.held = max(0, self.held - size)
+            self.unread = max(0, self.unread - size)
+            self.__drained += size
+            self.__tune()
+
+    def __tune(self):
+        now = time.monotonic()
+        elapsed = now - self.__tuned
+        if elapsed < self.__tune_interval:
+            return
+        wanted = 2 * self.__drained * self.__tune_interval / elapsed
+        self.limit = int(min(self.cap, max(self.__minimum, wanted)))
+        self.__drained = 0
+        self.__tuned = now
+
+
+class ConnectionTable:
+    """
+    The senders or receivers of a socket, by (address, msg_id).
+
+    Entries are active until finish() moves them to TIME_WAIT, where they
+    still absorb late duplicate packets for time_wait seconds before they are
+    evicted. At most capacity entries are kept: beyond that, the entries
+    longest in TIME_WAIT are evicted first, and once only active ones are
+    left, add() refuses new entries. If idle_timeout is set, active entries
+    not looked up for that long are evicted and handed to on_evict. Every
+    operation is O(1) amortized.
+    """
+
+    def __init__(self, capacity=util.MAX_CONNECTIONS, time_wait=util.TIME_WAIT,
+                 idle_timeout: float = None, on_evict: Callable = None):
+        self.__capacity = capacity
+        self.__time_wait = time_wait
+        self.__idle_timeout = idle_timeout
+        self.__on_evict = on_evict
+        self.__active = OrderedDict()  # (entry, last use), least recently used first.
+        self.__finished = OrderedDict()  # (entry, eviction time), oldest first.
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__active) + len(self.__finished)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key):
+        """
+        Returns the active or TIME_WAIT entry for key, or None.
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__expire(now)
+            if key in self.__active:
+                entry, _ = self.__active[key]
+                self.__active[key] = (entry, now)
+                self.__active.move_to_end(key)
+                return entry
+            if key in self.__finished:
+                return self.__finished[key][0]
+            return None
+
+    def add(self, key, entry) -> bool:
+        """
+        Adds an active entry for key. Returns False, leaving the table as it
+        was, if it is full of active entries.
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__expire(now)
+            self.__finished.pop(key, None)
+            if key not in self.__active and len(self.__active) >= self.__capacity:
+                return False
+            self.__active[key] = (entry, now)
+            self.__active.move_to_end(key)
+            while len(self) > self.__capacity:
+                self.__finished.popitem(last=False)
+            return True
+
+    def finish(self, key):
+        """
+        Moves the entry for key to TIME_WAIT.
+        """
+        with self.__lock:
+            if key in self.__active:
+                self.__finished[key] = (self.__active.pop(key)[0],
+                                        time.monotonic() + self.__time_wait)
+
+    def expire(self):
+        """
+        Evicts the entries whose TIME_WAIT or idle_timeout is over.
+        """
+        with self.__lock:
+            self.__expire(time.monotonic())
+
+    def __expire(self, now: float):
+        while self.__finished:
+            key, (_, evict_at) = next(iter(self.__finished.items()))
+            if evict_at > now:
+                break
+            del self.__finished[key]
+        while self.__idle_timeout is not None and self.__active:
+            key, (entry, used) = next(iter(self.__active.items()))
+            if used + self.__idle_timeout > now:
+                break
+            del self.__active[key]
+            if self.__on_evict is not None:
+                self.__on_evict(entry)
+
+
+class StreamedMessages:
+    """
+    Stands in for the on_data callback of a ReliableMessageReceiver on a
+    streaming socket: a MessageStream is queued as soon as a message starts
+    to arrive, and is fed its chunks as they become in order.
+    """
+
+    def __init__(self, received_messages: Queue, address: Address, budget: "ReceiveBudget"):
+        self.__received_messages = received_messages
+        self.__address = address
+        self.__budget = budget
+        self.__stream = None  # The stream of the message currently being received.
+
+    def __call__(self, chunk: Union[str, bytes]):
+        if self.__stream is None:
+            self.__stream = MessageStream(budget=self.__budget)
+            self.__received_messages.put((self.__stream, self.__address))
+        if chunk is None:
+            self.__stream.close()
+            self.__stream = None
+        else:
+            self.__stream.feed(chunk)
+
+    def abort(self):
+        """
+        Fails the message being received, if any, once its receiver is retired.
+        """
+        if self.__stream is not None:
+            self.__stream.abort(ConnectionAbortedError(
+                "the message from %s:%d was abandoned before it was complete" % self.__address))
+            self.__stream = None
+
+
+class CompletedMessages:
+    """
+    Stands in for the completed message queue of a ReliableMessageReceiver:
+    instead of parking a thread on a queue, every completed message is handed
+    straight to on_message_completed(key, message).
+    """
+
+    def __init__(self, on_message_completed: Callable, key: Tuple[Address, MsgID]):
+        self.__on_message_completed = on_message_completed
+        self.__key = key
+
+    def put(self, message: Union[str, bytes]):
+        self.__on_message_completed(self.__key, message)
+
+
+class DeferredCalls:
+    """
+    Callbacks that the receive thread runs once their delay has passed, so
+    everything they touch is only ever used from that thread. schedule()
+    works like asyncio's loop.call_later.
+    """
+
+    def __init__(self):
+        self.__timers = TimerWheel()
+        self.__callbacks = {}
+        self.__keys = count()
+
+    def schedule(self, delay: float, callback: Callable[[], None]) -> "DeferredCall":
+        key = next(self.__keys)
+        self.__callbacks[key] = callback
+        self.__timers.schedule(key, time.monotonic() + delay)
+        return DeferredCall(self, key)
+
+    def cancel(self, key: int):
+        self.__timers.cancel(key)
+        self.__callbacks.pop(key, None)
+
+    def run_due(self):
+        """
+        Runs every callback whose delay has passed.
+        """
+        for key in self.__timers.expired(time.monotonic()):
+            self.__callbacks.pop(key)()
+
+    def next_timeout(self) -> float:
+        """
+        Returns how long until the next callback is due, or None.
+        """
+        return self.__timers.next_timeout(time.monotonic())
+
+
+@dataclass
+class DeferredCall:
+    calls: DeferredCalls
+    key: int
+
+    def cancel(self):
+        self.calls.cancel(self.key)
+
+
+@dataclass
+class Batch:
+    """
+    Small messages waiting to be sent to an address in one transmission, and
+    the Future of its outcome.
+    """
+
+    messages: list = field(default_factory=list)
+    size: int = 0
+    future: Future = field(default_factory=Future)
+    timer: Timer = None
+
+
+@dataclass
+class Peer:
+    """
+    What a socket remembers of an address across its transmissions: one RTT
+    estimate that every sender to it shares, the slow start threshold the
+    last transmission ended with, and the path MTU probing found.
+    """
+
+    rtt: RttEstimator = field(default_factory=RttEstimator)
+    ssthresh: float = None
+    path_mtu: int = None
+
+    def seed(self, congestion: CongestionControl) -> CongestionControl:
+        """
+        Starts a new sender's congestion control from the remembered
+        slow start threshold instead of from scratch.
+        """
+        if self.ssthresh is not None and isinstance(congestion, RenoCongestionControl):
+            congestion.ssthresh = self.ssthresh
+        return congestion
+
+    def remember(self, sender: ReliableMessageSender):
+        """
+        Keeps what a finished transmission learned of the path.
+        """
+        if isinstance(sender.congestion, RenoCongestionControl):
+            self.ssthresh = sender.congestion.ssthresh
+        if sender.probe_mtu:
+            self.path_mtu = sender.path_mtu
+
+
+class PeerTable:
+    """
+    The Peer of every address a socket sent to, for at most capacity
+    addresses; beyond that the least recently used are forgotten.
+    """
+
+    def __init__(self, capacity=util.MAX_CONNECTIONS):
+        self.__capacity = capacity
+        self.__peers = OrderedDict()  # Least recently used first.
+        self.__lock = Lock()
+
+    def get(self, address: Address) -> Peer:
+        """
+        Returns the Peer of an address, or None if it is not remembered.
+        """
+        with self.__lock:
+            return self.__peers.get(address)
+
+    def open(self, address: Address) -> Peer:
+        """
+        Returns the Peer of an address, remembering a new one if needed.
+        """
+        with self.__lock:
+            peer = self.__peers.get(address)
+            if peer is None:
+                peer = self.__peers[address] = Peer()
+                if len(self.__peers) > self.__capacity:
+                    self.__peers.popitem(last=False)
+            self.__peers.move_to_end(address)
+            return peer
+
+
+@dataclass
+class SocketOptions:
+    """
+    The optional transport features of a ReliableSocket, and their tuning.
+    AsyncReliableSocket takes the same options, except those of its own
+    design: streaming, persistent connections, batching, send workers and
+    port sharing.
+    """
+
+    # Senders offer the compact binary packet format of
+    # util.make_binary_packet, and fall back to text packets if the receiver
+    # declines it.
+    binary: bool = False
+    # How each sender sizes its congestion window, which never exceeds
+    # window_size: "fixed" (always window_size), "reno" (AIMD with slow
+    # start) or "cubic".
+    congestion_control: str = "fixed"
+    # Senders ask receivers to report the out-of-order packets they hold in
+    # every ACK, and never retransmit those packets.
+    sack: bool = False
+    # Messages of at least util.COMPRESS_THRESHOLD bytes are sent compressed
+    # with zlib, unless a sample of them barely compresses; recvfrom returns
+    # them as they were. Messages over persistent connections never are.
+    # Compressed messages are only accepted by sockets that set it too; the
+    # others receive them uncompressed.
+    compress: bool = False
+    # The first transmission to an address also sends probes of
+    # util.PROBE_SIZES bytes, and later ones use the largest probe that
+    # arrived whole as their datagram size instead of util.MAX_PACKET_SIZE.
+    # Receivers echo the probes that fit in their bufsize.
+    probe_mtu: bool = False
+    # The check ending every binary packet: "crc32", "adler32" (faster and
+    # weaker) or "none", which trusts the UDP checksum and suits loopback.
+    # Text packets always carry crc32.
+    integrity: str = "crc32"
+    # Senders spread their data packets over each RTT, at util.PACING_GAIN
+    # times the congestion window per smoothed RTT, instead of sending what
+    # the window allows at once. pacing_rate fixes the rate in bits per
+    # second instead, and implies pacing.
+    pacing: bool = False
+    pacing_rate: float = None
+    # Senders send no more than the receiver advertises it can still buffer,
+    # so a peer that reads slowly holds them back. Every socket buffers up to
+    # receive_window bytes of messages being reassembled or not read yet,
+    # tuned down to util.RECEIVE_WINDOW_MIN while its application falls
+    # behind, and refuses messages announced larger unless streamed.
+    flow_control: bool = False
+    receive_window: int = util.RECEIVE_WINDOW_CAP
+    # Above 1, receivers acknowledge every ack_every packets that arrive in
+    # order, or whatever arrived within ack_delay seconds. ack_stats() counts
+    # the ACKs sent and saved.
+    ack_every: int = 1
+    ack_delay: float = util.ACK_DELAY
+    # At most max_connections senders and as many receivers are kept; once
+    # none of them is in TIME_WAIT, new transmissions are refused.
+    max_connections: int = util.MAX_CONNECTIONS
+    # The kernel receive buffer, which has to absorb the windows of large
+    # datagrams or of many concurrent transfers.
+    recv_buffer: int = util.SOCKET_BUFFER_SIZE
+    # A MessageStream is queued as soon as a message starts to arrive, for
+    # recv_stream to read it while it arrives.
+    streaming: bool = False
+    # The first message to an address opens a connection that later ones are
+    # sent within, without start and end packets, until idle_timeout seconds
+    # pass without a message. The connection is offered binary framing, so
+    # that bytes and streams can be sent over it too. idle_timeout must stay
+    # below util.RECEIVE_IDLE_TIME_OUT, after which the receiver forgets the
+    # connection.
+    persistent: bool = False
+    idle_timeout: float = util.IDLE_TIME_OUT
+    # Messages shorter than batch_size are held for up to batch_delay
+    # seconds, or until those held for the same address add up to
+    # batch_size, and sent together in one transmission.
+    batching: bool = False
+    batch_delay: float = util.BATCH_DELAY
+    batch_size: int = util.BATCH_SIZE
+    # How many transmissions sendto_async runs at once.
+    send_workers: int = util.NUM_OF_SEND_WORKERS
+    # Several sockets, e.g. one per process, may bind the same address with
+    # SO_REUSEPORT; the kernel hands all the datagrams of a peer to one of
+    # them, which must also send its messages.
+    reuse_port: bool = False
+
+
+@dataclass
+class Connection:
+    """
+    A persistent connection to a peer. The lock serializes the messages sent
+    over it, and the idle timer closes it once nothing was sent for a while.
+    """
+
+    sender: ReliableMessageSender
+    lock: Lock = field(default_factory=Lock)
+    idle_timer: Timer = None
+
+
 class ReliableSocket:
     """
     This is a socket that reliably transports messages.
@@ -25,21 +566,96 @@ class ReliableSocket:
             Sends a message to an address
         ReliableSocket.recvfrom()
             Receives a message sent to the socket
+        ReliableSocket.sendto_bytes(receiver_addr, data)
+            Sends a bytes-like payload to an address without text encoding
+        ReliableSocket.recvfrom_bytes()
+            Receives a message sent to the socket as bytes
+        ReliableSocket.send_stream(receiver_addr, source)
+            Sends everything read from a file object or an iterable of bytes
+        ReliableSocket.recv_stream()
+            Receives a message sent to the socket as a MessageStream
+        ReliableSocket.sendto_async(receiver_addr, message)
+            Sends a message in the background and returns a Future of the outcome
+        ReliableSocket.sendto_many(receiver_addrs, message)
+            Sends the same message to several addresses at once
+        ReliableSocket.sendto_many_async(receiver_addrs, message)
+            Same as sendto_many, returning a Future of the outcome for each address
+        ReliableSocket.rto(receiver_addr)
+            Returns the current retransmission timeout towards an address
+        ReliableSocket.path_mtu(receiver_addr)
+            Returns the largest datagram sent to an address
+        ReliableSocket.ack_stats()
+            Returns how many ACKs the socket's receivers sent and saved
+        ReliableSocket.buffered()
+            Returns how many received bytes the socket holds
+        ReliableSocket.getsockname()
+            Returns the address the socket is bound to
+
+    Options:
+        Every transport feature is off unless asked for, so by default the
+        socket speaks the plain text protocol. Features and their tuning are
+        passed as a SocketOptions, or as keyword arguments that override it.
+        Senders offer a feature in their start packet and fall back if the
+        peer declines it; receivers accept every feature whatever their own
+        options, except compression, which they accept only if compress is
+        set.
     """
-    def __init__(self, dest, port, window_size, bufsize=4096):
+    def __init__(self, dest, port, window_size, bufsize=util.MAX_DATAGRAM_SIZE,
+                 options: SocketOptions = None, **overrides):
+        options = replace(options or SocketOptions(), **overrides)
+        if options.persistent and not 0 < options.idle_timeout < util.RECEIVE_IDLE_TIME_OUT:
+            raise ValueError("idle_timeout must be below util.RECEIVE_IDLE_TIME_OUT, "
+                             "after which receivers forget the connection")
         self.__dest = dest
         self.__port = port
         self.__window_size = window_size
         self.__bufsize = bufsize
+        self.__binary = options.binary
+        self.__congestion_control = CONGESTION_CONTROLS[options.congestion_control]
+        self.__sack = options.sack
+        self.__compress = options.compress
+        self.__probe_mtu = options.probe_mtu
+        self.__integrity = options.integrity
+        self.__pacing = options.pacing or options.pacing_rate is not None
+        self.__pacing_rate = None if options.pacing_rate is None else options.pacing_rate / 8
+        self.__flow_control = options.flow_control
+        self.__budget = ReceiveBudget(options.receive_window)
+        self.__streaming = options.streaming
+        self.__persistent = options.persistent
+        self.__idle_timeout = options.idle_timeout
+        self.__ack_every = options.ack_every
+        self.__ack_delay = options.ack_delay
+        self.__ack_counters = AckCounters()
+        self.__deferred = DeferredCalls()
+        self.__batching = options.batching
+        self.__batch_delay = options.batch_delay
+        self.__batch_size = options.batch_size
         self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if options.reuse_port:
+            self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, options.recv_buffer)
         self.__sock.settimeout(None)
         self.__sock.bind((self.__dest, self.__port))
 
-        self.__senders: Dict[Tuple[Address, MsgID], ReliableMessageSender] = {}
-        self.__receivers: Dict[Tuple[Address, MsgID], ReliableMessageReceiver] = {}
+        self.__senders = ConnectionTable(options.max_connections)
+        self.__receivers = ConnectionTable(options.max_connections,
+                                           idle_timeout=util.RECEIVE_IDLE_TIME_OUT,
+                                           on_evict=self.__on_receiver_evicted)
+        # msg_ids are handed out in turn, starting anywhere in the range so a
+        # restarted socket does not reuse ids the peers still remember.
+        self.__msg_ids = count(randrange(len(util.MSG_ID_RANGE)))
+        self.__peers = PeerTable(options.max_connections)
+        self.__connections: Dict[Address, Connection] = {}
+        self.__connections_lock = Lock()
+        self.__batches: Dict[Address, Batch] = {}
+        self.__batches_lock = Lock()
 
         self.__received_messages = Queue()
+        self.__send_pool = ThreadPoolExecutor(max_workers=options.send_workers,
+                                              thread_name_prefix="ReliableSocket-send")
+
+        self.__deferred.schedule(util.RECEIVE_IDLE_TIME_OUT / 2, self.__expire_receivers)
 
         # start the thread for receiving packets
         Thread(target=self.__receive_handler, args=(), daemon=True).start()
@@ -73,9 +689,68 @@ class ReliableSocket:
             raise the queue.Empty exception (timeout is ignored in that case).
         """
 
-        return self.__received_messages.get(block=block, timeout=timeout)
+        message, addr = self.__get_message(block, timeout)
+        if not isinstance(message, str):
+            message = message.decode("utf-8")
+        return message, addr
+
+    def recvfrom_bytes(self,
+                       block: bool = True,
+                       timeout: int = None) -> Tuple[bytes, Address]:
+        """
+        Returns a reliably received message on the socket as bytes.
+
+        Messages that arrived in binary framing are returned as reassembled,
+        without any text encoding. Blocking works as in recvfrom.
+
+        Returns:
+            Tuple[bytes, Address]:
+                A tuple of
+                    (i)  the received message, and
+                    (ii) the address from where the message is received from
+        """
+
+        message, addr = self.__get_message(block, timeout)
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        return message, addr
+
+    def recv_stream(self,
+                    block: bool = True,
+                    timeout: int = None) -> Tuple[MessageStream, Address]:
+        """
+        Returns the next message on the socket as a MessageStream.
+
+        On a streaming socket the stream is returned as soon as the message
+        starts to arrive; otherwise it wraps a completely received message.
+        Blocking works as in recvfrom.
+
+        Returns:
+            Tuple[MessageStream, Address]:
+                A tuple of
+                    (i)  a reader over the message, and
+                    (ii) the address from where the message is received from
+        """
+
+        message, addr = self.__received_messages.get(block=block, timeout=timeout)
+        if not isinstance(message, MessageStream):
+            self.__budget.drain(len(message))
+            message = MessageStream(message)
+        return message, addr
+
+    def __get_message(self, block, timeout):
+        """
+        Dequeues the next message, reading it to the end if it is a stream.
+        """
+
+        message, addr = self.__received_messages.get(block=block, timeout=timeout)
+        if isinstance(message, MessageStream):
+            message = message.read()
+        else:
+            self.__budget.drain(len(message))
+        return message, addr
 
-    def sendto(self, receiver_addr: Address, message: str):
+    def sendto(self, receiver_addr: Address, message: str) -> bool:
         """
         Send message to an address reliably.
 
@@ -83,50 +758,222 @@ class ReliableSocket:
             receiver_addr (Address): Address of destination
             message (str): Message to send to the destination
 
+        Returns:
+            bool: Whether the message was acknowledged by the destination.
+
         Note:
             This function call is syncronous. It blocks until the message is
             reliably transported to the destination (which can take arbitrary
-            time).
+            time). With batching, a short message may first wait for others
+            to the same address for up to batch_delay seconds.
+        """
+
+        if self.__batches_message(message):
+            return self.__add_to_batch(receiver_addr, message).result()
+        return self.__send_message_reliably(receiver_addr, message)
+
+    def sendto_bytes(self, receiver_addr: Address,
+                     data: Union[bytes, bytearray, memoryview]) -> bool:
+        """
+        Send a bytes-like payload to an address reliably.
+
+        The payload is always sent in binary framing and sliced into packets
+        without being copied. Like sendto, this call blocks until the payload
+        is acknowledged.
+
+        Args:
+            receiver_addr (Address): Address of destination
+            data (bytes): Payload to send to the destination
+
+        Returns:
+            bool: Whether the payload was acknowledged by the destination.
+        """
+
+        if self.__batches_message(data):
+            return self.__add_to_batch(receiver_addr, data).result()
+        return self.__send_message_reliably(receiver_addr, data)
+
+    def sendto_async(self, receiver_addr: Address,
+                     message: Union[str, bytes]) -> Future:
+        """
+        Send a message or a bytes-like payload to an address reliably, without
+        blocking the caller.
+
+        The transmission runs on the socket's bounded pool of send workers;
+        if all of them are busy, it waits for one to become free. With
+        batching, a short message shares the Future of its batch.
+
+        Args:
+            receiver_addr (Address): Address of destination
+            message (str | bytes): Message or payload to send to the destination
+
+        Returns:
+            Future: Resolves to whether the message was acknowledged by the
+                destination, as sendto or sendto_bytes would have returned.
+        """
+
+        if self.__batches_message(message):
+            return self.__add_to_batch(receiver_addr, message)
+        return self.__send_pool.submit(self.__send_message_reliably, receiver_addr, message)
+
+    def sendto_many(self, receiver_addrs, message: Union[str, bytes]) -> Dict[Address, bool]:
+        """
+        Send the same message or bytes-like payload to several addresses
+        reliably.
+
+        The message is split, and compressed if enabled, once for all the
+        addresses, and the chunks are framed from shared buffers. Each address
+        gets a transmission of its own, with its own window and retransmission
+        state, and they all run at once on the send workers. Batching and
+        persistent connections are not used.
+
+        Args:
+            receiver_addrs: Addresses of destination; repeated ones are sent to once
+            message (str | bytes): Message or payload to send to the destinations
+
+        Returns:
+            Dict[Address, bool]: Whether each destination acknowledged the message.
+        """
+
+        deliveries = self.sendto_many_async(receiver_addrs, message)
+        return {recvr_addr: delivery.result() for recvr_addr, delivery in deliveries.items()}
+
+    def sendto_many_async(self, receiver_addrs,
+                          message: Union[str, bytes]) -> Dict[Address, Future]:
+        """
+        Send the same message or bytes-like payload to several addresses, as
+        sendto_many does, without blocking the caller.
+
+        Returns:
+            Dict[Address, Future]: Resolves to whether each destination
+                acknowledged the message.
+        """
+
+        shared = {}  # Messages are shared by the senders with the same chunk size.
+        deliveries = {}
+        for recvr_addr in dict.fromkeys(receiver_addrs):
+            sender = self.__new_sender(recvr_addr)
+            if sender is None:
+                deliveries[recvr_addr] = Future()
+                deliveries[recvr_addr].set_result(False)
+                continue
+            if sender.chunk_size not in shared:
+                shared[sender.chunk_size] = sender.share_message(message)
+            deliveries[recvr_addr] = self.__send_pool.submit(
+                self.__send_shared, recvr_addr, sender, shared[sender.chunk_size])
+        return deliveries
+
+    def send_stream(self, receiver_addr: Address, source) -> bool:
+        """
+        Send everything read from a file object or an iterable of bytes to an
+        address reliably, as one message.
+
+        The source is read lazily, one chunk at a time as window space opens,
+        so arbitrarily large payloads are sent in memory bounded by the window.
+        The payload is always sent in binary framing. Like sendto, this call
+        blocks until the payload is acknowledged.
+
+        Args:
+            receiver_addr (Address): Address of destination
+            source: A binary or text file object, or an iterable of bytes
+
+        Returns:
+            bool: Whether the payload was acknowledged by the destination.
+        """
+
+        return self.__send_message_reliably(receiver_addr, source, stream=True)
+
+    def rto(self, receiver_addr: Address) -> float:
+        """
+        Returns the retransmission timeout towards an address, shared by all
+        transmissions to it, or util.TIME_OUT if nothing has been sent there yet.
+        """
+
+        peer = self.__peers.get(receiver_addr)
+        return util.TIME_OUT if peer is None else peer.rtt.rto
+
+    def path_mtu(self, receiver_addr: Address) -> int:
+        """
+        Returns the largest datagram probing found to get through to an
+        address, or util.MAX_PACKET_SIZE if it was never probed.
+        """
+
+        peer = self.__peers.get(receiver_addr)
+        if peer is None or peer.path_mtu is None:
+            return util.MAX_PACKET_SIZE
+        return peer.path_mtu
+
+    def ack_stats(self) -> AckCounters:
+        """
+        Returns how many ACKs the receivers of this socket sent, and how many
+        were saved by delaying them.
+        """
+
+        return AckCounters(self.__ack_counters.sent, self.__ack_counters.saved)
+
+    def buffered(self) -> int:
+        """
+        Returns how many bytes the socket holds: chunks of messages being
+        reassembled, and messages not read yet.
         """
 
-        self.__send_message_reliably(receiver_addr, message)
+        return self.__budget.held
+
+    def getsockname(self) -> Address:
+        """
+        Returns the address the socket is bound to, e.g. to learn the port
+        picked when it was created with port 0.
+        """
+
+        return self.__sock.getsockname()
 
     @staticmethod
     def __is_from_a_receiver(sender_type: str) -> bool:
         return sender_type == "r"
 
-    @staticmethod
-    def __parse_raw_packet(raw_packet: str) -> Tuple[str, int, str]:
-        raw_packet = raw_packet.split(':')
-        return raw_packet[0], int(raw_packet[1]), ':'.join(raw_packet[2:])
-
     def __receive_handler(self):
         """
         Receives packets on the socket and redirects them to the their particular
         reliable message sender/receivers.
+
+        Packets are read into one reusable buffer, so the packets handed to
+        senders and receivers are only valid until they return.
         """
 
+        buffer = bytearray(self.__bufsize)
         while True:
 
+            # run delayed work, and wait for a packet no longer than until more is due
+            self.__deferred.run_due()
+            timeout = self.__deferred.next_timeout()
+            if timeout is not None and not select.select([self.__sock], [], [], timeout)[0]:
+                continue
+
             # recieve a packet for a message from a client
-            byte_packet, addr = self.__sock.recvfrom(self.__bufsize)
-            raw_packet = byte_packet.decode("utf-8")
-            sender_type, msg_id, packet = self.__parse_raw_packet(raw_packet)
+            nbytes, addr = self.__sock.recvfrom_into(buffer)
+            try:
+                sender_type, msg_id, packet = util.parse_datagram(buffer, nbytes)
 
-            if self.__is_from_a_receiver(sender_type):
-                # this belongs to a sender
-                self.__send_to_a_sender(addr, msg_id, packet)
-            else:
-                # this belongs to a receiver
-                self.__send_to_a_receiver(addr, msg_id, packet)
+                if self.__is_from_a_receiver(sender_type):
+                    # this belongs to a sender
+                    self.__send_to_a_sender(addr, msg_id, packet)
+                else:
+                    # this belongs to a receiver
+                    self.__send_to_a_receiver(addr, msg_id, packet)
+            except Exception:
+                # A malformed packet must not stop the socket from receiving.
+                traceback.print_exc()
 
     def __send_to_a_sender(self, addr, msg_id: int, ack_packet: str):
         """
         Redirects received ack packet to the corresponding message sender
         """
 
-        if (addr, msg_id) in self.__senders:
-            sender: ReliableMessageSender = self.__senders[(addr, msg_id)]
+        sender: ReliableMessageSender = self.__senders.get((addr, msg_id))
+        if sender is not None:
+            # ACKs are queued for the sending thread, so copy them out of the buffer
+            if isinstance(ack_packet, memoryview):
+                ack_packet = bytes(ack_packet)
             sender.on_packet_received(ack_packet)
         else:
             print("Warning: no sender identified for", (addr, msg_id))
@@ -137,66 +984,259 @@ class ReliableSocket:
         If no such receiver is found, a new message receiver is initialized.
         """
 
-        if not (addr, msg_id) in self.__receivers:
+        receiver: ReliableMessageReceiver = self.__receivers.get((addr, msg_id))
+        if receiver is None:
             # this is a new transmission, set up new receiver
-            self.__setup_new_receiver(addr, msg_id)
+            receiver = self.__setup_new_receiver(addr, msg_id)
+            if receiver is None:
+                return  # No room for it: the sender retransmits its start.
 
-        receiver: ReliableMessageReceiver = self.__receivers[(addr, msg_id)]
         receiver.on_packet_received(packet)
 
-    def __setup_new_receiver(self, new_addr, msg_id: int):
+    def __setup_new_receiver(self, new_addr, msg_id: int) -> ReliableMessageReceiver:
         """
-        Initializes new message receiver.
-        Initialization involves making a queue in which the message receiver can enqueue the message
-        once it is completely (and reliably) received. ReliableSocket needs to start a thread that
-        dequeues this queue to get the completed message.
+        Initializes new message receiver, or returns None if the receivers
+        table is full.
+        Completed messages are handed from the receiver straight to
+        __on_message_completed, on the thread that received the last packet.
+        On a streaming socket, the receiver instead feeds a MessageStream per message,
+        queued as soon as the message starts to arrive.
         """
 
-        completed_msg_q: Queue = Queue()
-        self.__receivers[(new_addr, msg_id)] = ReliableMessageReceiver(
-            self.__sock, new_addr, msg_id, completed_msg_q)
+        on_data = None
+        if self.__streaming:
+            on_data = StreamedMessages(self.__received_messages, new_addr, self.__budget)
 
-        Thread(target=self.__process_completed_message,
-               args=(new_addr, completed_msg_q),
-               daemon=True).start()
+        receiver = ReliableMessageReceiver(
+            self.__sock, new_addr, msg_id,
+            CompletedMessages(self.__on_message_completed, (new_addr, msg_id)),
+            on_data=on_data, ack_every=self.__ack_every, ack_delay=self.__ack_delay,
+            schedule=self.__deferred.schedule, ack_counters=self.__ack_counters,
+            receive_budget=self.__budget, compress=self.__compress)
+        if not self.__receivers.add((new_addr, msg_id), receiver):
+            return None
+        return receiver
 
-    def __process_completed_message(self, sender_addr, completed_msg_q: Queue):
+    def __expire_receivers(self):
         """
-        Waits for a completed message to be received by a reliable message receiver
-        and then processes it
+        Abandons idle receivers even while no packet arrives, every half
+        util.RECEIVE_IDLE_TIME_OUT.
         """
+        self.__receivers.expire()
+        self.__deferred.schedule(util.RECEIVE_IDLE_TIME_OUT / 2, self.__expire_receivers)
 
-        # blocks here for message
-        received_msg = completed_msg_q.get()
+    @staticmethod
+    def __on_receiver_evicted(receiver: ReliableMessageReceiver):
+        """
+        Aborts the message an active receiver was streaming when it is
+        evicted, and gives back the buffer space it held.
+        """
+        receiver.abandon()
+        if isinstance(receiver.on_data, StreamedMessages):
+            receiver.on_data.abort()
 
-        # act on completed message
-        self.__received_messages.put((received_msg, sender_addr))
+    def __on_message_completed(self, key, received_msg):
+        """
+        Processes a message completed by a reliable message receiver. The
+        receiver moves to TIME_WAIT once its transmission is over, which for
+        a persistent connection is when it reports the connection closed
+        with None.
+        """
 
-        # # delete this message receiver (as its of no use now, message has been completely received)
-        # del self.__receivers[(sender_addr, msg_id)]
+        receiver: ReliableMessageReceiver = self.__receivers.get(key)
+        if received_msg is not None and not self.__streaming:
+            self.__budget.hold(len(received_msg))
+            self.__received_messages.put((received_msg, key[0]))
+        if received_msg is None or receiver is None or not receiver.connection:
+            self.__receivers.finish(key)
 
     def __get_unique_msg_id(self, recvr_addr):
-        msg_id = randint(50000, 99999)
+        """
+        Returns the next msg_id not in use towards an address. As fewer
+        senders than msg_ids are ever kept, this takes O(1) amortized.
+        """
+
+        msg_id = util.MSG_ID_RANGE[next(self.__msg_ids) % len(util.MSG_ID_RANGE)]
         while (recvr_addr, msg_id) in self.__senders:
-            msg_id = randint(50000, 99999)
+            msg_id = util.MSG_ID_RANGE[next(self.__msg_ids) % len(util.MSG_ID_RANGE)]
         return msg_id
 
-    def __send_message_reliably(self, recvr_addr, message):
+    def __new_sender(self, recvr_addr, persistent=False) -> ReliableMessageSender:
+        """
+        Initializes a reliable message sender instance towards an address and
+        stores it in the senders table so that we can send acks to it from our
+        receive_handler. Returns None if the senders table is full.
+        """
+
+        msg_id = self.__get_unique_msg_id(recvr_addr)
+        peer = self.__peers.open(recvr_addr)
+
+        sender = ReliableMessageSender(
+            self.__sock, recvr_addr, msg_id, self.__window_size, self.__binary, rtt=peer.rtt,
+            congestion=peer.seed(self.__congestion_control(self.__window_size)), sack=self.__sack,
+            persistent=persistent, compress=self.__compress,
+            packet_size=self.path_mtu(recvr_addr),
+            probe_mtu=self.__probe_mtu and peer.path_mtu is None,
+            integrity=self.__integrity,
+            pacer=Pacer(self.__pacing_rate) if self.__pacing else None,
+            flow_control=self.__flow_control)
+
+        if not self.__senders.add((recvr_addr, msg_id), sender):
+            return None
+
+        return sender
+
+    def __send_message_reliably(self, recvr_addr, message, stream=False):
         """
-        Sends a message reliably.
+        Sends a message, or everything read from a stream, reliably.
         - Initializes a reliable message sender instance that can reliably send this message.
         - Stores this in a dictionary so that we can send acks to it from our receive_handler.
         - Notiifies the reliable message sender to start sending.
-        - Deletes the reliable message sender instance as the message has been completey sent. 
+        - Moves the reliable message sender instance to TIME_WAIT as the message has been completey sent. 
         """
 
-        msg_id = self.__get_unique_msg_id(recvr_addr)
+        if self.__persistent and not isinstance(message, list):
+            return self.__send_over_connection(recvr_addr, message, stream)
+
+        sender = self.__new_sender(recvr_addr)
+        if sender is None:
+            return False
+
+        if stream:
+            delivered = sender.send_stream(message)
+        else:
+            delivered = sender.send_message(message)
+
+        self.__remember_peer(recvr_addr, sender)
+        self.__senders.finish((recvr_addr, sender.msg_id))
+
+        return delivered
+
+    def __send_shared(self, recvr_addr, sender: ReliableMessageSender,
+                      shared: SharedMessage) -> bool:
+        """
+        Sends a message shared with other senders, then moves the sender to
+        TIME_WAIT.
+        """
+
+        delivered = sender.send_shared(shared)
+        self.__remember_peer(recvr_addr, sender)
+        self.__senders.finish((recvr_addr, sender.msg_id))
+        return delivered
+
+    def __batches_message(self, message) -> bool:
+        return self.__batching and len(message) < self.__batch_size
 
-        sender = ReliableMessageSender(self.__sock, recvr_addr, msg_id,
-                                       self.__window_size)
+    def __add_to_batch(self, recvr_addr, message) -> Future:
+        """
+        Adds a short message to the batch held for an address, starting a new
+        batch if there is none, and returns the Future of the batch. The batch
+        is handed to the send workers once it is full or batch_delay passed,
+        and always travels in a transmission of its own, even to a persistent
+        socket. The receiver hands its messages to recvfrom in the order they
+        joined it, and every sender of it gets the outcome of the whole batch.
+        """
+
+        with self.__batches_lock:
+            batch = self.__batches.get(recvr_addr)
+            if batch is None:
+                batch = self.__batches[recvr_addr] = Batch()
+                batch.timer = Timer(self.__batch_delay, self.__send_pool.submit,
+                                    args=(self.__flush_batch, recvr_addr, batch))
+                batch.timer.daemon = True
+                batch.timer.start()
+            batch.messages.append(message)
+            batch.size += len(message)
+            if batch.size >= self.__batch_size:
+                del self.__batches[recvr_addr]
+                batch.timer.cancel()
+                self.__send_pool.submit(self.__send_batch, recvr_addr, batch)
+            return batch.future
+
+    def __flush_batch(self, recvr_addr, batch: Batch):
+        """
+        Sends a batch whose batch_delay passed, unless it filled up meanwhile.
+        """
 
-        self.__senders[(recvr_addr, msg_id)] = sender
+        with self.__batches_lock:
+            if self.__batches.get(recvr_addr) is not batch:
+                return  # It filled up just as its timer expired, and was sent.
+            del self.__batches[recvr_addr]
+        self.__send_batch(recvr_addr, batch)
+
+    def __send_batch(self, recvr_addr, batch: Batch):
+        """
+        Sends a batch reliably and resolves its Future. A batch of one message
+        is sent as that message.
+        """
+
+        try:
+            if len(batch.messages) == 1:
+                delivered = self.__send_message_reliably(recvr_addr, batch.messages[0])
+            else:
+                delivered = self.__send_message_reliably(recvr_addr, batch.messages)
+        except Exception as error:
+            batch.future.set_exception(error)
+            raise
+        batch.future.set_result(delivered)
+
+    def __send_over_connection(self, recvr_addr, message, stream=False):
+        """
+        Sends a message over the persistent connection to an address, opening
+        it first if needed, and restarts the connection's idle timer.
+        """
+
+        while True:
+            with self.__connections_lock:
+                connection = self.__connections.get(recvr_addr)
+                if connection is None:
+                    sender = self.__new_sender(recvr_addr, persistent=True)
+                    if sender is None:
+                        return False
+                    connection = Connection(sender)
+                    self.__connections[recvr_addr] = connection
+
+            with connection.lock:
+                if self.__connections.get(recvr_addr) is not connection:
+                    continue  # It was closed while we waited for it.
+                if connection.idle_timer is not None:
+                    connection.idle_timer.cancel()
+
+                sender = connection.sender
+                if stream:
+                    delivered = sender.send_stream(message)
+                else:
+                    delivered = sender.send_message(message)
+                self.__remember_peer(recvr_addr, sender)
+
+                if sender.connected:
+                    connection.idle_timer = Timer(self.__idle_timeout,
+                                                  self.__close_idle_connection,
+                                                  args=(recvr_addr, connection))
+                    connection.idle_timer.daemon = True
+                    connection.idle_timer.start()
+                else:
+                    # The connection could not be opened or was declined.
+                    self.__forget_connection(recvr_addr, connection)
+                return delivered
+
+    def __remember_peer(self, recvr_addr, sender: ReliableMessageSender):
+        self.__peers.open(recvr_addr).remember(sender)
+
+    def __close_idle_connection(self, recvr_addr, connection: Connection):
+        """
+        Closes a connection whose idle timer expired, unless a message was
+        sent over it in the meantime.
+        """
 
-        sender.send_message(message)
+        with connection.lock:
+            if connection.idle_timer is not current_thread():
+                return
+            connection.sender.close()
+            self.__forget_connection(recvr_addr, connection)
 
-        # del self.__senders[(recvr_addr, msg_id)]
\ No newline at end of file
+    def __forget_connection(self, recvr_addr, connection: Connection):
+        with self.__connections_lock:
+            if self.__connections.get(recvr_addr) is connection:
+                del self.__connections[recvr_addr]
+        self.__senders.finish((recvr_addr, connection.sender.msg_id))
@@ -6,17 +6,423 @@ Students should implement the SELECTIVE REPEAT protocol of sliding window.
 """
 
 from queue import Queue, Empty
-from typing import Tuple
+from typing import Callable, Iterator, Tuple, Union
 from socket import socket
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import util
 import time
 import random
-import collections
 
 Address = Tuple[str, int]
 
 
+@dataclass
+class RttEstimator:
+    """
+    Derives the retransmission timeout (RTO) from measured round trip times.
+
+    Follows RFC 6298: a smoothed RTT and an RTT variance are updated from every
+    sample, the RTO is srtt + 4 * rttvar, clamped to [min_rto, max_rto], and it
+    doubles on every timeout until the next sample. Callers apply Karn's rule by
+    never sampling packets that were retransmitted.
+    """
+
+    rto: float = util.TIME_OUT
+    min_rto: float = util.MIN_TIME_OUT
+    max_rto: float = util.MAX_TIME_OUT
+    srtt: float = None
+    rttvar: float = None
+
+    def on_sample(self, rtt: float):
+        """
+        Updates the estimate with the round trip time of an unambiguous ACK.
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+
+    def on_timeout(self):
+        """
+        Backs the RTO off exponentially after a retransmission timeout.
+        """
+        self.rto = min(self.rto * 2, self.max_rto)
+
+
+@dataclass
+class TimerWheel:
+    """
+    A hashed timing wheel of deadlines, keyed by sequence number.
+
+    Deadlines are hashed into `size` slots of `tick` seconds each, so
+    scheduling and cancelling a deadline are O(1), and finding expired ones
+    only visits the slots whose time has passed. Deadlines more than
+    size * tick ahead stay in their slot until a later revolution.
+    """
+
+    tick: float = util.TIMER_TICK
+    size: int = 512
+
+    def __post_init__(self):
+        self.slots = [{} for _ in range(self.size)]
+        self.slot_of = {}
+        self.cursor = int(time.monotonic() / self.tick)  # First unprocessed tick.
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def schedule(self, key: int, deadline: float):
+        """
+        Sets (or moves) the deadline of key.
+        """
+        self.cancel(key)
+        slot = max(int(deadline / self.tick), self.cursor) % self.size
+        self.slots[slot][key] = deadline
+        self.slot_of[key] = slot
+
+    def cancel(self, key: int):
+        """
+        Removes the deadline of key, if it has one.
+        """
+        slot = self.slot_of.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def expired(self, now: float) -> list:
+        """
+        Removes and returns the keys whose deadline is at or before now.
+        """
+        now_tick = int(now / self.tick)
+        expired = []
+        if self.slot_of:
+            last_tick = min(now_tick, self.cursor + self.size - 1)
+            for tick in range(self.cursor, last_tick + 1):
+                slot = self.slots[tick % self.size]
+                for key in [key for key, deadline in slot.items() if deadline <= now]:
+                    del slot[key]
+                    del self.slot_of[key]
+                    expired.append(key)
+        self.cursor = max(self.cursor, now_tick)
+        return expired
+
+    def next_timeout(self, now: float) -> float:
+        """
+        Returns how long to wait from now until the earliest deadline, or None
+        if nothing is scheduled.
+        """
+        if not self.slot_of:
+            return None
+        for tick in range(self.cursor, self.cursor + self.size):
+            slot = self.slots[tick % self.size]
+            if slot:
+                earliest = min(slot.values())
+                if earliest < (tick + 1) * self.tick:
+                    return max(0.0, earliest - now)
+        return self.size * self.tick
+
+
+@dataclass
+class InFlightPacket:
+    """
+    A slot of SendWindow: the framed packet and its transmission state.
+    """
+
+    packet: object = None
+    timestamp: float = 0.0
+    retransmitted: bool = False
+    in_flight: bool = False
+
+
+@dataclass
+class SendWindow:
+    """
+    Fixed-capacity ring buffer of the packets in flight.
+
+    The packet with sequence number seq lives in slot seq % capacity, which is
+    unique as long as fewer than `capacity` sequence numbers separate the
+    window base from the next packet. Slots are allocated once and reused, and
+    looking up, adding or dropping a packet is O(1).
+    """
+
+    capacity: int
+    base: int
+
+    def __post_init__(self):
+        self.slots = [InFlightPacket() for _ in range(self.capacity)]
+        self.next_seq_num = self.base
+        self.count = 0  # Packets sent and not yet acknowledged.
+
+    def __len__(self):
+        return self.count
+
+    def get(self, seq_num: int) -> InFlightPacket:
+        """
+        Returns the packet with seq_num if it is still in flight, else None.
+        """
+        if not self.base <= seq_num < self.next_seq_num:
+            return None
+        slot = self.slots[seq_num % self.capacity]
+        return slot if slot.in_flight else None
+
+    def was_retransmitted(self, seq_num: int) -> bool:
+        """
+        Returns whether the packet with seq_num was ever retransmitted, even
+        if a selective ACK already dropped it.
+        """
+        if not self.base <= seq_num < self.next_seq_num:
+            return False
+        return self.slots[seq_num % self.capacity].retransmitted
+
+    def push(self, packet) -> InFlightPacket:
+        """
+        Stores the packet with sequence number next_seq_num.
+        """
+        slot = self.slots[self.next_seq_num % self.capacity]
+        slot.packet, slot.retransmitted, slot.in_flight = packet, False, True
+        self.next_seq_num += 1
+        self.count += 1
+        return slot
+
+    def forget(self, seq_num: int) -> bool:
+        """
+        Drops an acknowledged packet. Returns whether it was in flight.
+        """
+        slot = self.get(seq_num)
+        if slot is None:
+            return False
+        slot.packet, slot.in_flight = None, False
+        self.count -= 1
+        return True
+
+
+@dataclass
+class CongestionControl:
+    """
+    Decides how many packets a sender may have in flight.
+
+    The congestion window (cwnd) is counted in packets and is always bounded
+    by max_window, the window size the sender was configured with. This base
+    class keeps cwnd at max_window, which is the classic fixed sliding window.
+    Subclasses adapt it to ACKs and losses.
+    """
+
+    max_window: int
+    cwnd: float = None
+
+    def __post_init__(self):
+        if self.cwnd is None:
+            self.cwnd = self.max_window
+
+    def window(self) -> int:
+        """
+        Returns the number of packets that may currently be in flight.
+        """
+        return max(1, min(int(self.cwnd), self.max_window))
+
+    def on_ack(self, acked: int):
+        """
+        Called when an ACK newly acknowledges `acked` packets.
+        """
+
+    def on_loss(self):
+        """
+        Called once per window when duplicate ACKs reveal a lost packet.
+        """
+
+    def on_timeout(self):
+        """
+        Called when a retransmission timeout fires.
+        """
+
+
+@dataclass
+class RenoCongestionControl(CongestionControl):
+    """
+    Reno-style AIMD: slow start up to ssthresh, then one packet per RTT of
+    additive increase; the window halves on loss and restarts from one
+    packet on timeout.
+    """
+
+    cwnd: float = 1.0
+    ssthresh: float = None
+
+    def __post_init__(self):
+        if self.ssthresh is None:
+            self.ssthresh = self.max_window
+
+    def on_ack(self, acked: int):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.cwnd += acked / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_loss(self):
+        self.ssthresh = max(self.cwnd / 2, 2.0)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self):
+        self.ssthresh = max(self.cwnd / 2, 2.0)
+        self.cwnd = 1.0
+
+
+@dataclass
+class CubicCongestionControl(RenoCongestionControl):
+    """
+    CUBIC-like growth: after a loss the window follows a cubic curve in the
+    time since that loss, which quickly regains the window it had (w_max),
+    plateaus around it, and then probes beyond it. It never grows slower than
+    Reno would.
+    """
+
+    beta: float = 0.7
+    scale: float = 0.4
+    w_max: float = 0.0
+    epoch_start: float = None
+    reno_cwnd: float = 0.0
+
+    def on_ack(self, acked: int):
+        if self.cwnd < self.ssthresh:
+            super().on_ack(acked)
+            return
+        now = time.monotonic()
+        if self.epoch_start is None:
+            self.epoch_start = now
+            self.w_max = max(self.w_max, self.cwnd)
+            self.reno_cwnd = self.cwnd
+        k = (self.w_max * (1 - self.beta) / self.scale) ** (1 / 3)
+        target = self.scale * (now - self.epoch_start - k) ** 3 + self.w_max
+        self.reno_cwnd += acked / self.reno_cwnd
+        target = max(target, self.reno_cwnd)
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) * acked / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_loss(self):
+        self.w_max = self.cwnd
+        self.epoch_start = None
+        self.cwnd = self.ssthresh = max(self.cwnd * self.beta, 2.0)
+
+    def on_timeout(self):
+        self.w_max = self.cwnd
+        self.epoch_start = None
+        self.ssthresh = max(self.cwnd * self.beta, 2.0)
+        self.cwnd = 1.0
+
+
+@dataclass
+class Pacer:
+    """
+    A token bucket that spreads packets over time instead of sending a
+    window in one burst.
+
+    Tokens are bytes, earned on the monotonic clock at rate bytes per second,
+    or, if rate is None, at gain times the congestion window per smoothed
+    RTT. At most burst seconds worth are saved up. A packet may be sent while
+    the bucket holds any tokens and then takes its size from it, so waking up
+    late only sends a slightly larger burst and the average rate holds.
+    """
+
+    rate: float = None
+    gain: float = util.PACING_GAIN
+    burst: float = util.PACING_BURST
+    tokens: float = 0.0
+    updated: float = None
+    current_rate: float = None  # Bytes per second as of the last refill, None if unpaced.
+
+    def refill(self, now: float, window_bytes: int, srtt: float):
+        """
+        Earns the tokens due since the last refill at the current rate.
+        Until an RTT is measured, a pacer without a rate lets everything through.
+        """
+        if self.rate is not None:
+            self.current_rate = self.rate
+        elif srtt:
+            self.current_rate = self.gain * window_bytes / srtt
+        else:
+            self.current_rate = None
+        if self.current_rate is None or self.updated is None:
+            self.tokens = 0.0 if self.current_rate is None else self.current_rate * self.burst
+        else:
+            self.tokens = min(self.tokens + (now - self.updated) * self.current_rate,
+                              self.current_rate * self.burst)
+        self.updated = now
+
+    def ready(self) -> bool:
+        return self.current_rate is None or self.tokens > 0
+
+    def consume(self, size: int):
+        if self.current_rate is not None:
+            self.tokens -= size
+
+    def delay(self) -> float:
+        """
+        Returns how long until the bucket holds tokens again.
+        """
+        if self.ready():
+            return 0.0
+        return -self.tokens / self.current_rate
+
+
+@dataclass
+class SharedMessage:
+    """
+    A message split once for several ReliableMessageSenders that send it to
+    different receivers, e.g. the recipients of ReliableSocket.sendto_many.
+
+    Every sender sends the same chunks with its own window and retransmission
+    state. As the check of a binary packet covers its body ahead of its
+    header, the body's part of it is computed by the first sender to frame a
+    chunk and reused by the others.
+    """
+
+    chunks: list
+    offer: dict
+    chunk_size: int
+    text: str = None  # The message, if text chunks can be fallen back to.
+
+    def __post_init__(self):
+        self.checks = {}  # Body checks of the chunks, by integrity.
+
+    def fallback(self) -> Iterator:
+        """
+        Returns the text chunks to send if binary framing is declined, or None.
+        """
+        if self.text is None:
+            return None
+        return util.iter_text_chunks(self.text, self.chunk_size)
+
+    def check(self, index: int, integrity: str) -> int:
+        """
+        Returns util.check_body of the chunk at index, computing it only once.
+        """
+        checks = self.checks.setdefault(integrity, [None] * len(self.chunks))
+        if checks[index] is None:
+            checks[index] = util.check_body(self.chunks[index], integrity)
+        return checks[index]
+
+
+CONGESTION_CONTROLS = {
+    "fixed": CongestionControl,
+    "reno": RenoCongestionControl,
+    "cubic": CubicCongestionControl,
+}
+
+
+@dataclass
+class AckCounters:
+    """
+    How many data and eom packets receivers acknowledged right away, and how
+    many ACKs delayed acknowledgement saved by covering several packets.
+    """
+
+    sent: int = 0
+    saved: int = 0
+
+
 @dataclass
 class MessageSender:
     """
@@ -55,8 +461,43 @@ class ReliableMessageSender(MessageSender):
     """
 
     window_size: int
+    binary: bool = False
+    rtt: RttEstimator = field(default_factory=RttEstimator)
+    congestion: CongestionControl = None
+    sack: bool = False
+    persistent: bool = False
+    compress: bool = False
+    packet_size: int = util.MAX_PACKET_SIZE
+    probe_mtu: bool = False
+    integrity: str = "crc32"
+    pacer: Pacer = None
+    flow_control: bool = False
+
+    def __post_init__(self):
+        self.connected = False  # Whether a persistent connection is open.
+        self.binary_framing = False
+        self.path_mtu = self.packet_size  # Largest datagram a probe got through with.
+        self.shared = None  # The SharedMessage being sent, if any.
 
-    def on_packet_received(self, packet: str):
+    @property
+    def rto(self) -> float:
+        """
+        The retransmission timeout currently used for start, data and end packets.
+        """
+        return self.rtt.rto
+
+    def send_binary(self, *parts: bytes):
+        """
+        Send a binary packet to the receiver without any text encoding or copying.
+
+        Args:
+            parts (bytes): The pieces of the packet, e.g. the body it covers
+                between the header and trailer made by util.make_binary_frame.
+        """
+        util.send_datagram(self.sock, self.receiver_addr,
+                           (b"s:%d:" % self.msg_id,) + parts)
+
+    def on_packet_received(self, packet: Union[str, bytes]):
         """
         TO BE IMPLEMENTED BY STUDENTS
 
@@ -74,7 +515,21 @@ class ReliableMessageSender(MessageSender):
             self.ack_queue = Queue()
         self.ack_queue.put(packet)
 
-    def send_message(self, message: str):
+    def send_stream(self, source) -> bool:
+        """
+        Reliably sends everything read from a file object or an iterable of
+        bytes as one message.
+
+        Chunks are read from source only as window space opens, so memory use
+        is bounded by the window rather than by the size of the message. The
+        size is not announced, and the stream always requires binary framing.
+        Under flow control, a receiver that does not stream may run out of
+        room before the end; the stream is then abandoned once probing its
+        closed window stalls. Returns True once the end packet is acknowledged, False otherwise.
+        """
+        return self.__transfer(util.iter_chunks(source, self.chunk_size), {"codec": "bin"})
+
+    def send_message(self, message: Union[str, bytes]) -> bool:
         """
         TO BE IMPLEMENTED BY STUDENTS
 
@@ -94,101 +549,544 @@ class ReliableMessageSender(MessageSender):
          cumulative ACKs from the receiver to slide the window appropriately.
         5) If no ACKs are received for util.TIME_OUT seconds, 
          resend all packets in the current window.
+         (util.TIME_OUT is only the initial timeout: self.rtt adapts it to
+         the measured round trip time.)
         6) Once all data chunks have been reliably sent, 
          reliably send an 'end' packet (again waiting for its ACK).
         7) Note: Only data packets are transmitted using the sliding window mechanism; 
          the 'start' and 'end' packets are sent separately with their own reliability logic.
+
+        A bytes-like message is sent as-is and always requires binary framing.
+        Returns True once the end packet is acknowledged, False if the
+        transmission had to be abandoned. Which options are offered at start
+        is up to start_packet, and how chunks are made up to split_message.
         """
-        # Lazy initialize the ACK queue if needed.
-        if not hasattr(self, "ack_queue"):
-            self.ack_queue = Queue()
+        return self.__transfer(*self.split_message(message))
+
+    def split_message(self, message: Union[str, bytes, list]) -> Tuple[Iterator, dict, Iterator]:
+        """
+        Breaks a message, or a list of messages to batch, into chunks. Returns
+        an iterator over them, the options to offer in the start packet, and
+        an iterator over text chunks to fall back to if binary framing is not
+        in use (None for raw bytes and batches).
+
+        A batch is packed by util.make_batch and offered as batch=1, so the
+        receiver splits it back into the messages. If compress is set, a
+        message of at least util.COMPRESS_THRESHOLD bytes is compressed,
+        unless a sample of it barely compresses, and offered as comp=zlib
+        along with its uncompressed size as orig=<bytes>.
+        Batches and compressed messages always use binary framing, and are
+        never sent over a persistent connection.
+        """
+        batch = isinstance(message, list)
+        if batch:
+            message = util.make_batch(message)
+        compressed = None
+        if self.compress and not self.persistent and len(message) >= util.COMPRESS_THRESHOLD:
+            plain = message.encode("utf-8") if isinstance(message, str) else message
+            compressed = util.compress(plain)
 
-        # 1) Break the message into chunks.
+        # 1) Break the message into chunks. With binary framing the message is
+        # encoded at most once and chunked into zero-copy slices of its bytes;
+        # text is chunked by its encoded length. A connection is opened with
+        # binary framing offered, so that bytes can be sent over it later, and
+        # keeps the framing it negotiated.
+        chunk_size = self.chunk_size
+        raw = not isinstance(message, str)
+        if compressed is not None:
+            payload = memoryview(compressed)
+            offer = {"codec": "bin", "size": len(payload), "chunk": chunk_size,
+                     "comp": "zlib", "orig": len(plain)}
+        elif (raw or self.binary or (self.persistent and not self.connected)
+              or (self.connected and self.binary_framing)):
+            payload = memoryview(message if raw else message.encode("utf-8"))
+            offer = {"codec": "bin", "size": len(payload), "chunk": chunk_size}
+        else:
+            # Under flow control the receiver reserves room for the encoded
+            # size up front, or refuses a message that would never fit.
+            offer = {"size": len(message.encode("utf-8"))} if self.flow_control else {}
+            return util.iter_text_chunks(message, chunk_size), offer, None
+        if batch:
+            offer["batch"] = 1
         chunks = [
-            message[i : i + util.CHUNK_SIZE]
-            for i in range(0, len(message), util.CHUNK_SIZE)
+            payload[i : i + chunk_size]
+            for i in range(0, len(payload), chunk_size)
         ]
-        # 2) Choose a random starting sequence number.
-        base_seq_num = random.randint(1000, 9999)
+        # The peer may decline binary framing: str messages then fall back to text chunks.
+        fallback = None
+        if not raw:
+            fallback = util.iter_text_chunks(message, chunk_size)
+        return iter(chunks), offer, fallback
 
-        # 3) Reliably send the start packet.
-        start_packet = util.make_packet("start", base_seq_num)
-        attempts = 0
-        while attempts < util.NUM_OF_RETRANSMISSIONS:
-            self.send(start_packet)
+    def share_message(self, message: Union[str, bytes]) -> SharedMessage:
+        """
+        Splits a message as split_message does, into chunks that senders to
+        other receivers can send as well with send_shared. They must have the
+        same chunk_size and options.
+        """
+        chunks, offer, fallback = self.split_message(message)
+        return SharedMessage(list(chunks), offer, self.chunk_size,
+                             message if fallback is not None else None)
+
+    def send_shared(self, shared: SharedMessage) -> bool:
+        """
+        Reliably sends a message split by share_message, as send_message
+        would send it. Is never sent over a persistent connection.
+        """
+        self.shared = shared
+        return self.__transfer(iter(shared.chunks), shared.offer, shared.fallback())
+
+    @property
+    def chunk_size(self) -> int:
+        """
+        The number of message bytes sent in each data packet, counted once
+        text is encoded, so that no datagram exceeds packet_size.
+        """
+        return util.chunk_size_for(self.packet_size)
+
+    def close(self) -> bool:
+        """
+        Reliably sends the end packet, which closes a persistent connection.
+        Returns whether it was acknowledged.
+
+        Over a persistent connection, messages are sent as data packets
+        followed by an eom packet, all in one sequence space, and the start
+        and end packets are only sent to open the connection and to close it.
+        """
+        end_ack = self.__send_reliably(*self.end_packet(), self.send_packet)
+        return end_ack is not None
+
+    def __transfer(self, chunks, offer: dict, fallback=None) -> bool:
+        """
+        Runs one transmission of the chunks produced by an iterator: the start
+        handshake offering the given options, the sliding window and the end
+        handshake, blocking on self.ack_queue in between.
+
+        On an open persistent connection the handshakes are skipped and the
+        chunks are followed by an eom packet in the same sequence space.
+        """
+        # Lazy initialize the ACK queue if it doesn't exist.
+        if not hasattr(self, "ack_queue"):
+            self.ack_queue = Queue()
+
+        if not self.connected:
+            self.send_probes()
+            start_ack = self.__send_reliably(*self.start_packet(offer))
+            if start_ack is None:
+                return False  # Failed to send start packet reliably
+            self.on_start_ack(start_ack)
+        if not self.begin_message(chunks, offer, fallback):
+            return False
+
+        # ACKs still queued from the previous message are stale by now.
+        while not self.ack_queue.empty():
+            self.ack_queue.get_nowait()
+
+        # 5) Send data packets using the sliding window, waiting for an ACK
+        # but no longer than the earliest deadline in between.
+        while True:
+            timeout = self.advance(time.monotonic())
+            if timeout is None:
+                break  # Every chunk was sent and acknowledged, or abandoned.
+            if timeout < util.PACING_SPIN and self.ack_queue.empty():
+                # A queue timeout would overshoot a short pacing delay.
+                util.sleep_until(time.monotonic() + timeout)
+                continue
             try:
-                ack_packet = self.ack_queue.get(timeout=util.TIME_OUT)
-                if util.validate_checksum(ack_packet):
-                    ack_type, ack_seq_str, _, _ = util.parse_packet(ack_packet)
-                    if ack_type == "ack" and int(ack_seq_str) == base_seq_num + 1:
-                        break
+                packet = self.ack_queue.get(timeout=timeout)
             except Empty:
-                attempts += 1
-        else:
-            return  # Failed to send start packet reliably
+                continue
+            self.on_acks(self.__queued_acks(packet))
 
-        # 4) Initialize sliding window variables.
-        next_seq_num = base_seq_num + 1
-        window_base = next_seq_num
-        packets_in_flight = (
-            collections.OrderedDict()
-        )  # Maps sequence numbers to packet info.
-        final_seq_num = base_seq_num + len(chunks)
-
-        # 5) Send data packets using the sliding window.
-        while window_base <= final_seq_num:
-            # Fill the window.
-            while next_seq_num < window_base + self.window_size and (
-                next_seq_num - base_seq_num - 1
-            ) < len(chunks):
-                chunk_index = next_seq_num - base_seq_num - 1
-                data_packet = util.make_packet(
-                    "data", next_seq_num, chunks[chunk_index]
-                )
-                self.send(data_packet)
-                packets_in_flight[next_seq_num] = {
-                    "packet": data_packet,
-                    "timestamp": time.time(),
-                }
-                next_seq_num += 1
+        if self.abandoned:
+            return False  # The receiver stopped acknowledging anything.
+
+        # 6) Reliably send the end packet, unless the connection stays open.
+        return self.connected or self.close()
 
+    def __queued_acks(self, packet) -> list:
+        """
+        Returns packet along with every ACK already queued behind it.
+        """
+        packets = [packet]
+        while True:
             try:
-                # Wait for an ACK.
-                ack_packet = self.ack_queue.get(timeout=util.TIME_OUT)
-                if not util.validate_checksum(ack_packet):
-                    continue
-                ack_type, ack_seq_str, _, _ = util.parse_packet(ack_packet)
-                ack_seq_num = int(ack_seq_str)
-                if ack_type == "ack":
-                    # Remove all packets with sequence numbers less than the ACK.
-                    for seq in list(packets_in_flight.keys()):
-                        if seq < ack_seq_num:
-                            packets_in_flight.pop(seq, None)
-                    window_base = max(window_base, ack_seq_num)
+                packets.append(self.ack_queue.get_nowait())
             except Empty:
-                # No ACK received: retransmit timed-out packets.
-                current_time = time.time()
-                for seq_num, info in list(packets_in_flight.items()):
-                    if current_time - info["timestamp"] > util.TIME_OUT:
-                        self.send(info["packet"])
-                        packets_in_flight[seq_num]["timestamp"] = current_time
-
-        # 6) Reliably send the end packet.
-        end_seq_num = next_seq_num
-        end_packet = util.make_packet("end", end_seq_num)
+                return packets
+
+    # The non-blocking steps of a transmission. send_message drives them from
+    # a thread, and async_reliable_socket from an event loop.
+
+    def send_probes(self):
+        """
+        If probe_mtu is set, sends a probe packet ahead of the start packet
+        for each size in util.PROBE_SIZES above packet_size.
+        """
+        if not self.probe_mtu:
+            return
+        for size in util.PROBE_SIZES:
+            if size > self.packet_size:
+                try:
+                    self.send_binary(*util.make_probe(size))
+                except OSError:
+                    return  # Larger than the local interface allows.
+
+    def on_probe_echo(self, size: int):
+        """
+        Raises path_mtu to the size of a probe the receiver echoed. The next
+        messages over a persistent connection already use it.
+        """
+        if size in util.PROBE_SIZES:
+            self.path_mtu = max(self.path_mtu, size)
+            if self.connected:
+                self.packet_size = self.path_mtu
+
+    def start_packet(self, offer: dict) -> Tuple[str, int]:
+        """
+        Begins a transmission. Returns the start packet offering the given
+        options, and the sequence number of the ACK that acknowledges it.
+
+        Besides them, it offers selective ACKs (sack=1), a persistent
+        connection (conn=1), the integrity check of binary packets unless it
+        is crc32 (sum=<integrity>), and flow control (rwnd=1), as enabled.
+        The start packet itself is always checked by crc32, and so is every
+        packet if the receiver declines the check.
+        """
+        # Lazy initialize congestion control if needed.
+        if self.congestion is None:
+            self.congestion = CongestionControl(self.window_size)
+
+        # 2) Choose a random starting sequence number.
+        self.start_seq_num = random.randint(1000, 9999)
+        if self.sack:
+            offer = dict(offer, sack=1)
+        if self.persistent:
+            offer = dict(offer, conn=1)
+        if self.integrity != "crc32":
+            offer = dict(offer, sum=self.integrity)
+        if self.flow_control:
+            offer = dict(offer, rwnd=1)
+
+        # 3) The start packet offers binary framing if enabled. Peers that do
+        # not understand the offer reply with an empty ACK body.
+        packet = util.make_packet("start", self.start_seq_num, util.make_options(offer))
+        return packet, self.start_seq_num + 1
+
+    def on_start_ack(self, body):
+        """
+        Sets up the sliding window for the framing and options the peer
+        accepted in the body of the start packet's ACK.
+        """
+        accepted = util.parse_options(body)
+        self.use_sack = accepted.get("sack") == "1"
+        self.connected = accepted.get("conn") == "1"
+        self.binary_framing = accepted.get("codec") == "bin"
+        self.batching = accepted.get("batch") == "1"
+        self.compressing = accepted.get("comp") == "zlib"
+        self.packet_integrity = "crc32"
+        if accepted.get("sum") == self.integrity:
+            self.packet_integrity = self.integrity
+        # The receive window in bytes, None unless the peer advertises one.
+        self.peer_window = None
+        self.window_answered = True
+        if accepted.get("rwnd") == "1":
+            self.peer_window = util.parse_size(accepted.get("win"))
+        if self.connected:
+            self.packet_size = self.path_mtu
+        if self.binary_framing:
+            self.make_packet = self.__make_binary_packet
+            self.send_packet = self.__send_binary_packet
+        else:
+            self.make_packet, self.send_packet = util.make_packet, self.send
+
+        # 4) Initialize sliding window variables.
+        self.window = SendWindow(self.window_size, self.start_seq_num + 1)
+        self.lost_seq_nums = set()  # Timed out, waiting for window space.
+        self.timers = TimerWheel()  # Retransmission deadline of every packet in flight.
+        self.duplicate_acks = 0
+        self.recovery_seq_num = self.window.base  # Losses below this were already reacted to.
+        self.last_backoff = time.monotonic()
+        self.stalled_time_outs = 0  # Backoffs since the window last slid.
+        self.abandoned = False
+
+    def begin_message(self, chunks, offer: dict, fallback=None) -> bool:
+        """
+        Makes the chunks produced by an iterator the next ones to send. If
+        binary framing is not in use, the text chunks produced by fallback are
+        sent instead; returns False if there are none, as raw bytes cannot be
+        carried in text packets. Also returns False for a batch the receiver
+        will not split. A compressed message the receiver will not restore
+        is restored here and sent as it is.
+        """
+        if offer.get("batch") and not self.batching:
+            return False
+        if offer.get("comp") and not self.compressing and self.binary_framing:
+            payload = memoryview(util.decompress(b"".join(chunks), offer["orig"]))
+            chunks = iter([payload[i : i + self.chunk_size]
+                           for i in range(0, len(payload), self.chunk_size)])
+            # The checks of the shared chunks cover the compressed ones.
+            self.shared = None
+        if offer.get("codec") == "bin" and not self.binary_framing:
+            if fallback is None:
+                return False
+            chunks = fallback
+        self.chunks = chunks  # Set to None once every chunk has been sent.
+        return True
+
+    def advance(self, now: float) -> float:
+        """
+        Declares packets whose deadline passed lost and sends whatever the
+        window allows. Returns how long to wait for ACKs before calling again,
+        or None once every chunk was sent and acknowledged, or once the
+        transmission is abandoned because util.NUM_OF_STALLED_TIME_OUTS
+        backoffs passed without the window sliding (self.abandoned is set).
+        """
+        # Deadlines are checked on every call, so a stream of duplicate ACKs
+        # cannot delay them.
+        self.__on_timers_expired(now)
+        if self.stalled_time_outs > util.NUM_OF_STALLED_TIME_OUTS:
+            self.abandoned = True
+            self.connected = False
+            return None
+        paced = self.__fill_window(now)
+        if self.chunks is None and self.window.base == self.window.next_seq_num:
+            return None
+        timeout = self.timers.next_timeout(time.monotonic())
+        if paced:
+            return min(self.pacer.delay(), self.rtt.rto if timeout is None else timeout)
+        return self.rtt.rto if timeout is None else timeout
+
+    def on_acks(self, packets: list):
+        """
+        Acts on a batch of ACKs: selective ACK ranges are applied from each
+        of them, but only the highest cumulative ACK slides the window.
+        """
+        highest = None
+        duplicates = 0
+        for packet in packets:
+            ack = util.read_packet(packet)
+            if ack is not None and ack[0] == "probe":
+                self.on_probe_echo(ack[1])
+            if ack is None or ack[0] != "ack":
+                continue
+            _, ack_seq_num, ack_body = ack
+            self.window_answered = True
+            options = util.parse_options(ack_body) if ack_body else {}
+            if self.use_sack and "sack" in options:
+                self.__on_sack(ack_seq_num, options["sack"])
+            window = util.parse_size(options.get("win"))
+            if self.peer_window is not None and window is not None and (
+                    highest is None or ack_seq_num >= highest):
+                self.peer_window = window
+            if ack_seq_num == self.window.base:
+                duplicates += 1
+            if highest is None or ack_seq_num > highest:
+                highest = ack_seq_num
+        if highest is None:
+            return
+        if highest > self.window.base:
+            self.__on_cumulative_ack(highest)
+        elif (highest == self.window.base and self.window.get(highest) is not None
+              and not self.__window_closed()):
+            # A receiver with no room left repeats its ACK, which tells nothing of losses.
+            self.__on_duplicate_acks(duplicates)
+
+    def end_packet(self) -> Tuple[Union[str, tuple], int]:
+        """
+        Ends the transmission, closing a persistent connection. Returns the
+        end packet, and the sequence number of the ACK that acknowledges it.
+        """
+        self.connected = False
+        end_seq_num = self.window.next_seq_num
+        return self.make_packet("end", end_seq_num), end_seq_num + 1
+
+    def __fill_window(self, now: float) -> bool:
+        """
+        Retransmits packets declared lost by a timeout first, then sends new
+        packets, as far as the congestion window, the receive window and the
+        pacer allow. New chunks are only pulled from self.chunks here, and on
+        a persistent connection the last one is followed by an eom packet.
+        Returns whether the pacer held back a packet the window allowed.
+        """
+        window = self.congestion.window()
+        if self.peer_window is not None:
+            # No more than the receive window the receiver advertised as
+            # win=<bytes> is in flight, counted in chunks. A closed window
+            # still lets one packet through, to probe it.
+            window = min(window, max(1, self.peer_window // self.chunk_size))
+        if self.pacer is not None:
+            self.pacer.refill(now, window * self.packet_size, self.rtt.srtt)
+        for seq in sorted(self.lost_seq_nums):
+            if len(self.window) - len(self.lost_seq_nums) >= window:
+                break
+            if self.pacer is not None and not self.pacer.ready():
+                return True
+            self.lost_seq_nums.discard(seq)
+            self.__transmit(seq, retransmission=True)
+        next_seq_num = self.window.next_seq_num
+        while (self.chunks is not None and not self.lost_seq_nums
+               and next_seq_num < self.window.base + window):
+            if self.pacer is not None and not self.pacer.ready():
+                return True
+            chunk = next(self.chunks, None)
+            if chunk is not None:
+                packet = self.make_packet("data", next_seq_num, chunk)
+            elif self.connected:
+                # Mark where the message ends inside the connection.
+                packet = self.make_packet("eom", next_seq_num)
+                self.chunks = None
+            else:
+                self.chunks = None
+                break
+            self.window.push(packet)
+            self.__transmit(next_seq_num)
+            next_seq_num += 1
+        return False
+
+    def __transmit(self, seq_num: int, retransmission: bool = False):
+        """
+        Sends a packet in flight and arms its retransmission deadline.
+        """
+        slot = self.window.get(seq_num)
+        if self.pacer is not None:
+            self.pacer.consume(util.packet_length(slot.packet))
+        self.send_packet(slot.packet)
+        slot.timestamp = time.monotonic()
+        slot.retransmitted = slot.retransmitted or retransmission
+        self.timers.schedule(seq_num, slot.timestamp + self.rtt.rto)
+
+    def __forget(self, seq_num: int):
+        """
+        Drops a packet the receiver holds from every retransmission structure.
+        """
+        if self.window.forget(seq_num):
+            self.timers.cancel(seq_num)
+            self.lost_seq_nums.discard(seq_num)
+
+    def __on_sack(self, ack_seq_num: int, sack: str):
+        """
+        Drops the packets a selective ACK reports as held by the receiver, so
+        they are never retransmitted.
+        """
+        for first, last in util.parse_sack_blocks(sack):
+            first = max(first, ack_seq_num, self.window.base)
+            for seq in range(first, min(last + 1, self.window.next_seq_num)):
+                self.__forget(seq)
+
+    def __on_cumulative_ack(self, ack_seq_num: int):
+        """
+        Slides the window up to ack_seq_num.
+        """
+        # Karn's rule: only sample an ACK whose newly acknowledged packets were
+        # all sent exactly once. A retransmission that filled a hole below the
+        # newest one would otherwise add the whole recovery to the sample.
+        newest = self.window.get(ack_seq_num - 1)
+        sample = newest is not None
+        sent_at = newest.timestamp if sample else None
+        # Remove all packets with sequence numbers less than the ACK.
+        for seq in range(self.window.base, min(ack_seq_num, self.window.next_seq_num)):
+            if self.window.was_retransmitted(seq):
+                sample = False
+            self.__forget(seq)
+        if sample:
+            self.rtt.on_sample(time.monotonic() - sent_at)
+        self.congestion.on_ack(ack_seq_num - self.window.base)
+        self.window.base = ack_seq_num
+        self.duplicate_acks = 0
+        self.stalled_time_outs = 0
+
+    def __on_duplicate_acks(self, duplicates: int):
+        """
+        Fast-retransmits the window base once three duplicate ACKs arrived.
+        """
+        before = self.duplicate_acks
+        self.duplicate_acks += duplicates
+        if before < 3 <= self.duplicate_acks and self.window.base >= self.recovery_seq_num:
+            # Fast retransmit: the receiver is missing the window base.
+            self.recovery_seq_num = self.window.next_seq_num
+            self.congestion.on_loss()
+            self.lost_seq_nums.discard(self.window.base)
+            self.__transmit(self.window.base, retransmission=True)
+
+    def __on_timers_expired(self, now: float):
+        """
+        Declares packets whose deadline passed lost. The RTO backs off and the
+        congestion window shrinks only if one of them was sent after the last
+        such reaction, so one loss event is not punished once per packet.
+        """
+        expired = self.timers.expired(now)
+        if not expired:
+            return
+        if self.__window_closed() and self.window_answered:
+            # Probes of a closed window are retransmitted, without shrinking
+            # the congestion window, while the receiver answers them, waiting
+            # for its application to read. They back off and count as stalled
+            # all the same, so a window that never reopens is abandoned.
+            self.window_answered = False
+            self.rtt.on_timeout()
+            self.last_backoff = now
+            self.stalled_time_outs += 1
+            self.lost_seq_nums.update(expired)
+            return
+        if any(self.window.get(seq).timestamp >= self.last_backoff for seq in expired):
+            self.rtt.on_timeout()
+            self.congestion.on_timeout()
+            self.recovery_seq_num = self.window.next_seq_num
+            self.last_backoff = now
+            self.stalled_time_outs += 1
+        self.lost_seq_nums.update(expired)
+
+    def __window_closed(self) -> bool:
+        return self.peer_window is not None and self.peer_window < self.chunk_size
+
+    def __make_binary_packet(self, pck_type, seqno, msg=b""):
+        """
+        Frames a binary packet as (header, body, trailer) so the body stays a
+        slice of the message buffer. Data packets of a shared message reuse
+        the check of their chunk.
+        """
+        body_check = None
+        if pck_type == "data" and self.shared is not None:
+            body_check = self.shared.check(seqno - self.start_seq_num - 1, self.packet_integrity)
+        header, trailer = util.make_binary_frame(pck_type, seqno, msg, self.packet_integrity,
+                                                 body_check)
+        return header, msg, trailer
+
+    def __send_binary_packet(self, packet):
+        self.send_binary(*packet)
+
+    def __send_reliably(self, packet, ack_seq_num, send=None):
+        """
+        Sends a start or end packet until it is acknowledged with ack_seq_num,
+        giving up after util.NUM_OF_RETRANSMISSIONS timeouts.
+        Returns the body of the ACK, or None if it never arrived.
+        """
+        send = send or self.send
         attempts = 0
         while attempts < util.NUM_OF_RETRANSMISSIONS:
-            self.send(end_packet)
+            send(packet)
+            sent_at = time.monotonic()
+            deadline = sent_at + self.rtt.rto
             try:
-                ack_packet = self.ack_queue.get(timeout=util.TIME_OUT)
-                if util.validate_checksum(ack_packet):
-                    ack_type, ack_seq_str, _, _ = util.parse_packet(ack_packet)
-                    if ack_type == "ack" and int(ack_seq_str) == end_seq_num + 1:
-                        break
+                while True:
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        raise Empty
+                    ack = util.read_packet(self.ack_queue.get(timeout=wait))
+                    if ack is None:
+                        continue
+                    ack_type, ack_seq, body = ack
+                    if ack_type == "probe":
+                        self.on_probe_echo(ack_seq)
+                    if ack_type == "ack" and ack_seq == ack_seq_num:
+                        if attempts == 0:
+                            self.rtt.on_sample(time.monotonic() - sent_at)
+                        return body
             except Empty:
                 attempts += 1
-        else:
-            return  # Failed to send end packet reliably
+                self.rtt.on_timeout()
+        return None
 
 
 @dataclass
@@ -231,9 +1129,33 @@ class ReliableMessageReceiver(MessageReceiver):
     You can use self.send(packet) to send a packet back to the sender, and will have to call
     self.on_message_completed(message) when the complete message is received.
     You can add as many helper functions as you want.
+
+    Every option a sender offers in its start packet is accepted, and set up
+    where the start packet is handled.
     """
 
-    def on_packet_received(self, packet: str):
+    # Called with every chunk as soon as all chunks before it arrived, then
+    # with None once the message is complete, which leaves the message given
+    # to on_message_completed empty.
+    on_data: Callable[[Union[str, bytes]], None] = None
+    # Above 1, with schedule set, one ACK covers ack_every packets that
+    # arrive in order, or whatever arrived in order within ack_delay seconds.
+    ack_every: int = 1
+    ack_delay: float = util.ACK_DELAY
+    # schedule(delay, callback) runs callback after delay seconds on the
+    # thread that delivers packets, and returns a handle with a cancel()
+    # method, like asyncio's loop.call_later.
+    schedule: Callable[[float, Callable[[], None]], object] = None
+    ack_counters: AckCounters = field(default_factory=AckCounters)
+    # A ReceiveBudget that the chunks held until they are handed over are
+    # reserved on, and whose free space flow control advertises.
+    receive_budget: object = None
+    # Accept messages compressed with zlib (comp=zlib) whose uncompressed
+    # size, announced as orig=<bytes>, fits the receive budget; they are
+    # never inflated beyond it. Otherwise the sender sends them as they are.
+    compress: bool = False
+
+    def on_packet_received(self, packet: Union[str, bytes]):
         """
         TO BE IMPLEMENTED BY STUDENTS
 
@@ -262,40 +1184,313 @@ class ReliableMessageReceiver(MessageReceiver):
         - Call self.on_message_completed(message) with the assembled message.
         - Send an ACK with the sequence number equal to (received sequence number + 1).
         """
-        if not util.validate_checksum(packet):
+        packet = util.read_packet(packet, getattr(self, "integrity", "crc32"))
+        if packet is None:
             return
-
-        packet_type, seq_num_str, msg_content, _ = util.parse_packet(packet)
-        seq_num = int(seq_num_str)
+        packet_type, seq_num, msg_content = packet
 
         # Lazy initialize receiver state.
         if not hasattr(self, "transmission_started"):
             self.transmission_started = False
+            self.flow_control = False
+            self.assembled = 0  # Bytes reserved for the in-order chunks not yet handed over.
+            self.remaining = None  # Bytes of the announced size not received yet, if reserved.
+            self.out_of_order = {}
+            self.unacked = 0  # In-order packets whose ACK is being delayed.
+            self.ack_timer = None
+
+        if packet_type == "start" and self.transmission_started and seq_num == self.start_seq_num:
+            # A duplicate of the start packet must not reset a transmission in progress.
+            self.send(self.start_ack)
 
-        if packet_type == "start":
+        elif packet_type == "start":
+            options = util.parse_options(msg_content)
+            size = util.parse_size(options.get("size"))
+            original = util.parse_size(options.get("orig"))
+            compressed = (options.get("comp") == "zlib" and self.compress
+                          and options.get("conn") != "1" and original is not None
+                          and (self.receive_budget is None or original <= self.receive_budget.cap))
+            if options.get("comp") == "zlib" and not compressed:
+                # Declined: the sender restores the message and sends it as it is.
+                size = original
+            if (options.get("rwnd") == "1" and self.receive_budget is not None
+                    and self.on_data is None and size is not None
+                    and (size > self.receive_budget.cap or not self.receive_budget.free())):
+                # It could never be reassembled within the window, or other
+                # messages already took all of it: leave the start
+                # unacknowledged.
+                return
+            self.abandon()
             self.start_seq_num = seq_num
             self.highest_seq_num_in_order = seq_num
-            self.received_chunks = {}
+            self.in_order_chunks = []  # Chunks up to highest_seq_num_in_order.
+            self.out_of_order = {}  # Chunks beyond it, by sequence number.
+            self.message_ends = set()  # Sequence numbers of eom packets not yet delivered.
             self.transmission_started = True
-            ack_packet = util.make_packet("ack", seq_num + 1)
-            self.send(ack_packet)
-
-        elif packet_type == "data" and self.transmission_started:
-            if seq_num not in self.received_chunks:
-                self.received_chunks[seq_num] = msg_content
-            current = self.highest_seq_num_in_order
-            while current + 1 in self.received_chunks:
-                current += 1
-            self.highest_seq_num_in_order = current
-            ack_packet = util.make_packet("ack", self.highest_seq_num_in_order + 1)
-            self.send(ack_packet)
+            # Accept binary framing and persistent connections if the sender
+            # offered them. When the sender announced the size of a single
+            # message, up to util.MAX_PREALLOCATED_SIZE, reassemble into one
+            # preallocated buffer, unless chunks are streamed out as they arrive.
+            self.binary = options.get("codec") == "bin"
+            self.connection = options.get("conn") == "1"
+            # Batches are split back into their messages once complete, so
+            # they are never streamed; each is completed, and handed to on_data
+            # followed by None, in turn, as bytes.
+            self.batch = options.get("batch") == "1" and not self.connection
+            self.streaming = self.on_data is not None and not self.batch
+            # Compressed messages are restored once complete, or chunk by
+            # chunk as they are handed to on_data, up to their original size.
+            self.compressed = compressed
+            self.original_size = original
+            # Check binary packets as the sender offered, besides crc32.
+            self.integrity = options.get("sum", "crc32")
+            if self.integrity not in util.INTEGRITY_CHECKS:
+                self.integrity = "crc32"
+            if self.compressed and self.streaming:
+                self.decompressor = util.Decompressor(original)
+            self.flow_control = options.get("rwnd") == "1" and self.receive_budget is not None
+            # The whole announced size is reserved up front for a buffer, and
+            # under flow control, so that the message's own chunks never close
+            # the window it needs to complete.
+            self.buffer = None
+            self.remaining = None
+            chunk_size = util.parse_size(options.get("chunk"), util.MAX_DATAGRAM_SIZE)
+            reserve = (size is not None and size <= util.MAX_PREALLOCATED_SIZE
+                       and not self.streaming and not self.connection)
+            if reserve and self.binary and chunk_size:
+                self.buffer = bytearray(size)
+                self.chunk_size = chunk_size
+            if self.buffer is not None or (reserve and self.flow_control):
+                self.__reserve(size)
+                self.assembled = size
+                self.remaining = size
+            # Report out-of-order chunks in selective ACKs if the sender asked.
+            self.sack = options.get("sack") == "1"
+            accepted = {}
+            if self.binary:
+                accepted["codec"] = "bin"
+            if self.sack:
+                accepted["sack"] = 1
+            if self.connection:
+                accepted["conn"] = 1
+            if self.batch:
+                accepted["batch"] = 1
+            if self.compressed:
+                accepted["comp"] = "zlib"
+            if self.integrity != "crc32":
+                accepted["sum"] = self.integrity
+            if self.flow_control:
+                accepted["rwnd"] = 1
+                accepted["win"] = self.__window()
+            self.start_ack = util.make_packet("ack", seq_num + 1, util.make_options(accepted))
+            self.send(self.start_ack)
+
+        elif packet_type in ("data", "eom") and self.transmission_started:
+            # Only a new packet that arrives in order, leaving no gap behind,
+            # may have its ACK delayed.
+            delay_ack = (packet_type == "data" and not self.out_of_order
+                         and seq_num == self.highest_seq_num_in_order + 1)
+            new = seq_num > self.highest_seq_num_in_order and seq_num not in self.out_of_order
+            if new and packet_type == "data" and not self.__fits_buffer(seq_num, msg_content):
+                # Beyond the size the sender announced: it would corrupt the message.
+                new = delay_ack = False
+            if (new and packet_type == "data" and self.flow_control and self.remaining is None
+                    and self.receive_budget.free() < len(msg_content)):
+                # No room for it: the ACK tells the sender its window is closed.
+                new = delay_ack = False
+            if new:
+                if packet_type == "eom":
+                    self.message_ends.add(seq_num)
+                    chunk = None
+                else:
+                    chunk = self.__store_chunk(seq_num, msg_content)
+                if seq_num == self.highest_seq_num_in_order + 1:
+                    # In order: hand it over, along with any chunks it unblocks.
+                    self.__deliver(seq_num, chunk)
+                    current = seq_num
+                    while current + 1 in self.out_of_order:
+                        current += 1
+                        self.__deliver(current, self.out_of_order.pop(current))
+                    self.highest_seq_num_in_order = current
+                else:
+                    self.out_of_order[seq_num] = chunk
+            if delay_ack:
+                self.__delay_ack()
+            else:
+                self.__send_ack(self.highest_seq_num_in_order + 1)
 
         elif packet_type == "end" and self.transmission_started:
-            sorted_chunks = [
-                self.received_chunks[seq] for seq in sorted(self.received_chunks.keys())
-            ]
-            complete_message = "".join(sorted_chunks)
-            self.on_message_completed(complete_message)
-            ack_packet = util.make_packet("ack", seq_num + 1)
-            self.send(ack_packet)
+            # On a persistent connection every message ends at its eom packet,
+            # and the end packet closes the connection.
+            if self.connection:
+                # Every message was already completed by its eom packet.
+                self.on_message_completed(None)
+            else:
+                self.__complete_message()
+            self.__send_ack(seq_num + 1)
+            self.abandon()
             self.transmission_started = False
+            self.end_seq_num = seq_num
+
+        elif packet_type == "end" and seq_num == getattr(self, "end_seq_num", None):
+            # The ACK of the end packet was lost: acknowledge the retransmission.
+            self.__send_ack(seq_num + 1)
+
+        elif packet_type == "probe":
+            # A probe got through whole: echo its size, without the padding.
+            self.send_binary(util.make_binary_packet("probe", seq_num))
+
+    def send_binary(self, *parts: bytes):
+        """
+        Send a binary packet back to the sender without any text encoding or copying.
+
+        Args:
+            parts (bytes): The pieces of the packet, e.g. one made by
+                util.make_binary_packet.
+        """
+        util.send_datagram(self.sock, self.sender_addr,
+                           (b"r:%d:" % self.msg_id,) + parts)
+
+    def abandon(self):
+        """
+        Gives back the buffer space held for chunks that were never handed
+        over, e.g. once the receiver is evicted before its transmission ends.
+        """
+        self.__release(self.assembled)
+        self.assembled = 0
+        for chunk in self.out_of_order.values():
+            if chunk is not None and self.remaining is None:
+                self.__release(len(chunk))
+        self.out_of_order = {}
+        self.remaining = None
+
+    def __reserve(self, size: int):
+        if self.receive_budget is not None:
+            self.receive_budget.reserve(size)
+
+    def __release(self, size: int):
+        if self.receive_budget is not None and size:
+            self.receive_budget.release(size)
+
+    def __window(self) -> int:
+        """
+        Returns the receive window to advertise: the free buffer space, plus
+        the room still reserved for the message being received.
+        """
+        return self.receive_budget.free() + (self.remaining or 0)
+
+    def __fits_buffer(self, seq_num: int, chunk) -> bool:
+        """
+        Returns whether a data chunk lies within the preallocated buffer, or
+        within the room reserved for the announced size, if there is one.
+        """
+        if self.buffer is None:
+            return self.remaining is None or len(chunk) <= self.remaining
+        offset = (seq_num - self.start_seq_num - 1) * self.chunk_size
+        return 0 <= offset and offset + len(chunk) <= len(self.buffer)
+
+    def __store_chunk(self, seq_num: int, chunk):
+        """
+        Copies a data chunk out of the packet, which is only valid for the
+        duration of on_packet_received. Returns what to keep until it is
+        delivered; chunks copied into the preallocated buffer need nothing.
+        """
+        if self.remaining is None:
+            self.__reserve(len(chunk))
+        else:
+            self.remaining -= len(chunk)
+        if not self.binary:
+            return chunk
+        if self.buffer is None:
+            return bytes(chunk)
+        offset = (seq_num - self.start_seq_num - 1) * self.chunk_size
+        self.buffer[offset : offset + len(chunk)] = chunk
+        return None
+
+    def __deliver(self, seq_num: int, chunk):
+        """
+        Hands over a chunk that just became in order, or completes the
+        message if seq_num is an eom packet.
+        """
+        if seq_num in self.message_ends:
+            self.message_ends.discard(seq_num)
+            self.__complete_message()
+        elif self.streaming:
+            self.__release(len(chunk))
+            self.on_data(self.decompressor.decompress(chunk) if self.compressed else chunk)
+        elif chunk is not None:
+            if self.remaining is None:
+                self.assembled += len(chunk)
+            self.in_order_chunks.append(chunk)
+
+    def __complete_message(self):
+        """
+        Assembles the in-order chunks into the complete message and starts
+        collecting the next one.
+        """
+        if self.buffer is not None:
+            complete_message = bytes(self.buffer)
+        else:
+            joiner = b"" if self.binary else ""
+            complete_message = joiner.join(self.in_order_chunks)
+        self.in_order_chunks = []
+        # The application holds the message from now on.
+        self.__release(self.assembled)
+        self.assembled = 0
+        if self.compressed and not self.streaming:
+            complete_message = util.decompress(complete_message, self.original_size)
+        if self.batch:
+            for message in util.split_batch(complete_message):
+                if self.on_data is not None:
+                    self.on_data(message)
+                    self.on_data(None)
+                self.on_message_completed(message)
+            return
+        if self.streaming:
+            if self.compressed:
+                self.on_data(self.decompressor.flush())
+            self.on_data(None)
+        # Binary messages are delivered as bytes; ReliableSocket decodes them
+        # only if the application asks for a str.
+        self.on_message_completed(complete_message)
+
+    def __delay_ack(self):
+        """
+        Holds back the ACK of an in-order packet until ack_every packets are
+        waiting for it or ack_delay has passed.
+        """
+        self.unacked += 1
+        if self.ack_every <= 1 or self.schedule is None or self.unacked >= self.ack_every:
+            self.__send_ack(self.highest_seq_num_in_order + 1)
+            return
+        self.ack_counters.saved += 1
+        if self.ack_timer is None:
+            self.ack_timer = self.schedule(self.ack_delay, self.__on_ack_timer)
+
+    def __on_ack_timer(self):
+        self.ack_timer = None
+        if self.unacked:
+            # The ACK sent now covers the packet whose ACK was counted as saved.
+            self.ack_counters.saved -= 1
+            self.__send_ack(self.highest_seq_num_in_order + 1)
+
+    def __send_ack(self, seq_num: int):
+        """
+        Acknowledges seq_num using the framing negotiated at start, covering
+        any packet whose ACK was delayed.
+        """
+        self.unacked = 0
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        self.ack_counters.sent += 1
+        options = {}
+        if self.sack and self.out_of_order:
+            options["sack"] = util.make_sack_blocks(self.out_of_order)
+        if self.flow_control:
+            options["win"] = self.__window()
+        body = util.make_options(options)
+        if self.binary:
+            self.send_binary(util.make_binary_packet("ack", seq_num, body.encode()))
+        else:
+            self.send(util.make_packet("ack", seq_num, body))
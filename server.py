@@ -3,47 +3,271 @@ This module defines the behaviour of server in your Chat Application
 '''
 import sys
 import getopt
+import math
 import socket
-from threading import Thread
+import multiprocessing
+import multiprocessing.connection
+import traceback
+from collections import OrderedDict, deque
+from queue import Queue
+from threading import Lock, Thread
 import util
 from reliable_socket import ReliableSocket
 
 
+class ClientRegistry:
+    '''
+    The clients of the server, indexed by username and by address, so that joining,
+    leaving and looking up a client take constant time however many are registered.
+    Each client is a dict of its username, its address and the worker its address is routed to.
+    '''
+
+    def __init__(self):
+        self.by_username = dict()
+        self.by_address = dict()
+        # Serializes changes, as workers also apply the joins and leaves of other workers from their inbox thread
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.by_username)
+
+    def add(self, client):
+        # Returns False if the username is already taken
+        with self.lock:
+            if client["username"] in self.by_username:
+                return False
+            self.by_username[client["username"]] = client
+            self.by_address[client["address"]] = client
+            return True
+
+    def remove(self, username, address):
+        # Returns whether a client of this username and address was registered
+        with self.lock:
+            client = self.by_username.get(username)
+            if client is None or client["address"] != address:
+                return False
+            del self.by_username[username]
+            if self.by_address.get(address) is client:
+                del self.by_address[address]
+            return True
+
+    def find(self, username):
+        # Returns the client of a username, or None if nobody joined with it
+        return self.by_username.get(username)
+
+    def username_of(self, address):
+        # Returns the username of the client at an address, or an empty string if it did not join
+        client = self.by_address.get(address)
+        return str() if client is None else client["username"]
+
+    def usernames(self):
+        # Returns the usernames in the order the clients joined
+        with self.lock:
+            return list(self.by_username)
+
+
+class OutboundQueues:
+    '''
+    The messages waiting to be sent to each client, drained by deficit round-robin.
+
+    Every address has a queue of its own, and at most one transmission to it runs at a time,
+    so messages to a client keep their order and a client that stops acknowledging only holds
+    up its own queue. At most max_in_flight transmissions run at once. When more queues are
+    waiting, they take turns: a queue whose deficit does not cover the encoded size of its next
+    message earns quantum bytes and waits for its next turn, so every client gets an even share
+    of the bytes sent however large its messages are. A message queued for several clients at once is
+    sent to those whose turn comes together with one sendto_many_async.
+    '''
+
+    def __init__(self, reliable_sock: ReliableSocket, max_in_flight: int = util.NUM_OF_SEND_WORKERS,
+                 quantum: int = util.CHUNK_SIZE):
+        self.reliable_sock = reliable_sock
+        self.max_in_flight = max_in_flight
+        self.quantum = quantum
+        # Queue and deficit of every address with messages queued or a transmission running
+        self.queues = dict()
+        self.deficits = dict()
+        # Addresses whose queue waits for a transmission to start, in turn order
+        self.active = OrderedDict()
+        self.in_flight = set()
+        self.lock = Lock()
+
+    def put(self, addresses, message):
+        # Queues a message for each address, along with the number of bytes it is charged
+        size = len(message.encode("utf-8")) if isinstance(message, str) else len(message)
+        with self.lock:
+            for address in addresses:
+                queue = self.queues.setdefault(address, deque())
+                queue.append((message, size))
+                if len(queue) == 1 and address not in self.in_flight:
+                    self.deficits[address] = 0
+                    self.active[address] = None
+            picks = self.schedule()
+        self.dispatch(picks)
+
+    def depth(self, address=None):
+        # Returns the number of messages queued for an address, or for all of them
+        with self.lock:
+            if address is not None:
+                return len(self.queues.get(address, ()))
+            return sum(len(queue) for queue in self.queues.values())
+
+    def discard(self, address):
+        # Drops the messages queued for an address, e.g. of a client that left
+        with self.lock:
+            if address in self.queues:
+                self.queues[address].clear()
+            if address in self.active:
+                del self.active[address]
+                del self.queues[address]
+                del self.deficits[address]
+
+    def schedule(self):
+        # Picks the messages to send next, while fewer than max_in_flight transmissions run.
+        # Must be called with the lock held
+        picks = list()
+        credited = False
+        while self.active and len(self.in_flight) < self.max_in_flight:
+            address = next(iter(self.active))
+            message, size = self.queues[address][0]
+            if self.deficits[address] < size:
+                if not credited:
+                    self.credit_rounds()
+                    credited = True
+                    continue
+                self.deficits[address] += self.quantum
+                self.active.move_to_end(address)
+                continue
+            self.queues[address].popleft()
+            self.deficits[address] -= size
+            del self.active[address]
+            self.in_flight.add(address)
+            picks.append((address, message))
+            credited = False
+        return picks
+
+    def credit_rounds(self):
+        # Credits every waiting queue in one step with the quanta of the whole rounds in which
+        # none of them could send its next message, so a message many quanta large does not cost
+        # a pass per quantum. Whole rounds leave the turn order as it was.
+        # Must be called with the lock held
+        rounds = min(math.ceil((self.queues[address][0][1] - self.deficits[address]) / self.quantum)
+                     for address in self.active)
+        if rounds > 0:
+            for address in self.active:
+                self.deficits[address] += rounds * self.quantum
+
+    def dispatch(self, picks):
+        # Starts the transmissions of the picked messages, one per distinct message
+        recipients = dict()
+        for address, message in picks:
+            recipients.setdefault(id(message), (message, list()))[1].append(address)
+        for message, addresses in recipients.values():
+            deliveries = self.reliable_sock.sendto_many_async(addresses, message)
+            for address, delivery in deliveries.items():
+                delivery.add_done_callback(lambda _, address=address: self.on_sent(address))
+
+    def on_sent(self, address):
+        # Lets the queue of an address take its turn again once its transmission is over
+        with self.lock:
+            self.in_flight.discard(address)
+            if self.queues.get(address):
+                self.active[address] = None
+            else:
+                # Deficit round-robin does not let an empty queue keep its deficit
+                self.queues.pop(address, None)
+                self.deficits.pop(address, None)
+            picks = self.schedule()
+        self.dispatch(picks)
+
+
+class InboundWorkers:
+    '''
+    A pool of threads that handle the commands of the clients.
+
+    The commands of an address are always handled by the same worker, in the order they
+    arrived, while the commands of different clients are handled in parallel. Each worker takes
+    up to backlog commands in advance; once they are all taken, submit waits for the worker to
+    catch up, so a flood of commands cannot grow the server's memory without bound.
+    '''
+
+    def __init__(self, handle, workers: int = util.NUM_OF_COMMAND_WORKERS,
+                 backlog: int = util.COMMAND_BACKLOG):
+        self.handle = handle
+        self.queues = [Queue(maxsize=backlog) for _ in range(workers)]
+        for queue in self.queues:
+            Thread(target=self.run, args=(queue,), daemon=True).start()
+
+    def submit(self, message, address):
+        self.queues[hash(address) % len(self.queues)].put((message, address))
+
+    def depth(self):
+        # Returns the number of commands waiting for a worker
+        return sum(queue.qsize() for queue in self.queues)
+
+    def run(self, queue):
+        while True:
+            message, address = queue.get()
+            # A malformed command must not take the worker, and the clients it serves, down with it
+            try:
+                self.handle(message, address)
+            except Exception:
+                traceback.print_exc()
+
+
 class Server:
     '''
     This is the main Server Class.
     '''
 
-    def __init__(self, dest: str, port: int, window: str):
+    def __init__(self, dest: str, port: int, window: str, worker: int = 0, inboxes=None,
+                 client_count=None, max_clients: int = util.MAX_NUM_CLIENTS,
+                 handlers: int = util.NUM_OF_COMMAND_WORKERS, backlog: int = util.COMMAND_BACKLOG):
         self.server_addr = dest
         self.server_port = port
-        self.reliable_sock = ReliableSocket(dest, port, int(window))
-        self.clients = list()
+        # Index of this worker among the processes sharing the port, see start_workers
+        self.worker = worker
+        self.reliable_sock = ReliableSocket(dest, port, int(window), reuse_port=inboxes is not None)
+        # Every client is sent its messages in turn from a queue of its own, see OutboundQueues
+        self.outbound = OutboundQueues(self.reliable_sock)
+        # Clients of every worker, each with the worker its address is routed to
+        self.clients = ClientRegistry()
+        self.max_clients = max_clients
+        # Queue of every worker, through which the others forward messages and announce their clients
+        self.inboxes = inboxes
+        # Clients of all workers together, counted against max_clients. Shared with the other
+        # workers if there are any, and kept under its lock as commands are handled in parallel
+        self.client_count = multiprocessing.Value("i", 0) if client_count is None else client_count
+        # Commands are handled on a pool of threads, in order for each client
+        self.inbound = InboundWorkers(self.handle, handlers, backlog)
+        if inboxes is not None:
+            Thread(target=self.handle_inbox, daemon=True).start()
 
     def start(self):
         # This is the main loop of the server that runs infinitely and receives messages from the clients and responds accordingly.
         while True:
             message, address = self.reliable_sock.recvfrom()
             # print(f"got {message} from {address}")
-            message_parts = message.split(" ")
-
-            if message_parts[0] == "join":
-                self.join(message_parts, address)
-            elif message_parts[0] == "request_users_list":
-                self.request_users_list(address)
-            elif message_parts[0] == "send_message":
-                self.send_message(message_parts, address)
-            elif message_parts[0] == "disconnect":
-                self.disconnect(message_parts, address)
-            elif message_parts[0] == "send_file":
-                self.send_file(message_parts, address)
+            self.inbound.submit(message, address)
+
+    def handle(self, message, address):
+        # Handles a command of a client, on one of the threads of self.inbound
+        message_parts = message.split(" ")
+
+        if message_parts[0] == "join":
+            self.join(message_parts, address)
+        elif message_parts[0] == "request_users_list":
+            self.request_users_list(address)
+        elif message_parts[0] == "send_message":
+            self.send_message(message_parts, address)
+        elif message_parts[0] == "disconnect":
+            self.disconnect(message_parts, address)
+        elif message_parts[0] == "send_file":
+            self.send_file(message_parts, address)
 
     def send_file(self, message_parts, address):
         # Extracts the username from the list of clients given the address of the client
-        username = str()
-        for client in self.clients:
-            if address == client["address"]:
-                username = client["username"]
+        username = self.clients.username_of(address)
 
         # Error handling in case the client did not follow the format and specified a non-integer value
         # Sends a err_unknown_message back to the client and the client disconnects
@@ -52,7 +276,7 @@ class Server:
         except:
             message_to_send = util.make_message(
                 msg_type="err_unknown_message", msg_format=2)
-            self.reliable_sock.sendto(address, message_to_send)
+            self.outbound.put([address], message_to_send)
             print("disconnected:", username, "sent unknown command")
             return
 
@@ -61,7 +285,7 @@ class Server:
         if len(message_parts) < num_of_users + 4:
             message_to_send = util.make_message(
                 msg_type="err_unknown_message", msg_format=2)
-            self.reliable_sock.sendto(address, message_to_send)
+            self.outbound.put([address], message_to_send)
             print("disconnected:", username, "sent unknown command")
             return
 
@@ -70,42 +294,41 @@ class Server:
                                             message="1 " + username + " " + " ".join(message_parts[1 + num_of_users + 1:]))
         print("file:", username)
 
-        # Maintains a list of usernames of users that have already received the file to ensure that each user gets the file at most once
-        sent_to_clients = list()
+        # Maintains a set of usernames of users that have already received the file to ensure that each user gets the file at most once
+        sent_to_clients = set()
+        # Addresses of the recipients, whose queues get the same message
+        deliveries = list()
         for i in range(0, num_of_users):
-            # To check whether a particular user was online and sent the file
-            sent = False
-            for client in self.clients:
-                if message_parts[2+i] == client["username"] and client["username"] not in sent_to_clients:
-                    self.reliable_sock.sendto(
-                        client["address"], message_to_send)
-                    sent = True
-                    sent_to_clients.append(client["username"])
+            recipient = message_parts[2+i]
+            if recipient in sent_to_clients:
+                continue
+            client = self.clients.find(recipient)
+            if client is not None:
+                self.deliver(client, message_to_send, deliveries)
+                sent_to_clients.add(recipient)
             # In case, a specified user is not sent the file
-            if not sent and message_parts[2+i] not in sent_to_clients:
-                print("file:", username, "to non-existent user",
-                      message_parts[2+i])
+            else:
+                print("file:", username, "to non-existent user", recipient)
+
+        # Queues the file for all the recipients, so that the next command is handled while it is delivered
+        self.outbound.put(deliveries, message_to_send)
 
     def disconnect(self, message_parts, address):
         # Extracts the username from the message
         username = message_parts[1]
         # Make a dictionary of client to remove later from the list of client
-        client = {"username": username, "address": address}
+        client = {"username": username, "address": address, "worker": self.worker}
 
         # Error handling in case the client is already removed and the server does not crash
-        try:
-            self.clients.remove(client)
+        if self.clients.remove(username, address):
+            self.outbound.discard(address)
+            self.release_slot()
+            self.announce(("leave", client))
             print("disconnected:", username)
-        except:
-            # print(username, "already disconnected")
-            pass
 
     def send_message(self, message_parts, address):
         # Extracts the username from the list of clients given the address of the client
-        username = str()
-        for client in self.clients:
-            if address == client["address"]:
-                username = client["username"]
+        username = self.clients.username_of(address)
 
         # Error handling in case the client did not follow the format and specified a non-integer value
         # Sends a err_unknown_message back to the client and the client disconnects
@@ -114,7 +337,7 @@ class Server:
         except:
             message_to_send = util.make_message(
                 msg_type="err_unknown_message", msg_format=2)
-            self.reliable_sock.sendto(address, message_to_send)
+            self.outbound.put([address], message_to_send)
             print("disconnected:", username, "sent unknown command")
             return
 
@@ -123,7 +346,7 @@ class Server:
         if len(message_parts) < num_of_users + 3:
             message_to_send = util.make_message(
                 msg_type="err_unknown_message", msg_format=2)
-            self.reliable_sock.sendto(address, message_to_send)
+            self.outbound.put([address], message_to_send)
             print("disconnected:", username, "sent unknown command")
             return
 
@@ -132,63 +355,135 @@ class Server:
                                             message="1 " + username + " " + " ".join(message_parts[1 + num_of_users + 1:]))
         print("msg:", username)
 
-        # Maintains a list of usernames of users that have already received the message to ensure that each user gets the message at most once
-        sent_to_clients = list()
+        # Maintains a set of usernames of users that have already received the message to ensure that each user gets the message at most once
+        sent_to_clients = set()
+        # Addresses of the recipients, whose queues get the same message
+        deliveries = list()
         for i in range(0, num_of_users):
-            # To check whether a particular user was online and sent the message
-            sent = False
-            for client in self.clients:
-                if message_parts[2+i] == client["username"] and client["username"] not in sent_to_clients:
-                    self.reliable_sock.sendto(
-                        client["address"], message_to_send)
-                    sent = True
-                    sent_to_clients.append(client["username"])
+            recipient = message_parts[2+i]
+            if recipient in sent_to_clients:
+                continue
+            client = self.clients.find(recipient)
+            if client is not None:
+                self.deliver(client, message_to_send, deliveries)
+                sent_to_clients.add(recipient)
             # In case, a specified user is not sent the message
-            if not sent and message_parts[2+i] not in sent_to_clients:
-                print("msg:", username, "to non-existent user",
-                      message_parts[2+i])
+            else:
+                print("msg:", username, "to non-existent user", recipient)
+
+        # Queues the message for all the recipients, so that the next command is handled while it is delivered
+        self.outbound.put(deliveries, message_to_send)
 
     def request_users_list(self, address):
         # Extracts the username from the list of clients given the address of the client
-        username = str()
-        for client in self.clients:
-            if address == client["address"]:
-                username = client["username"]
+        username = self.clients.username_of(address)
 
         # Constructs a string of online usernames from the client list
-        list_of_users = str(len(self.clients))
-        for client in self.clients:
-            list_of_users = list_of_users + " " + client["username"]
+        usernames = self.clients.usernames()
+        list_of_users = " ".join([str(len(usernames))] + usernames)
 
         # Makes the packet containing the list of users and sends it to the client who requested it
         message_to_send = util.make_message(
             msg_type="response_users_list", msg_format=3, message=list_of_users)
-        self.reliable_sock.sendto(address, message_to_send)
+        self.outbound.put([address], message_to_send)
         print("request_users_list:", username)
 
     def join(self, message_parts, address):
         # Extracts the username from the message received
         username = message_parts[1]
         # Makes a dictionary of client to add later to the list of clients
-        client = {"username": username, "address": address}
+        client = {"username": username, "address": address, "worker": self.worker}
 
         # Send a err_server_full message to the client if server is full
-        if len(self.clients) >= util.MAX_NUM_CLIENTS:
+        if not self.reserve_slot():
             print("disconnected: server full")
             message_to_send = util.make_message(
                 msg_type="err_server_full", msg_format=2)
-            self.reliable_sock.sendto(address, message_to_send)
-        # Sends a err_username_unavailable to the client if the username is already taken
-        elif client in self.clients:
+            self.outbound.put([address], message_to_send)
+        # Sends a err_username_unavailable to the client if the username is already taken, else adds the client
+        elif not self.clients.add(client):
+            self.release_slot()
             print("disconnected: username not available")
             message_to_send = util.make_message(
                 msg_type="err_username_unavailable", msg_format=2)
-            self.reliable_sock.sendto(address, message_to_send)
-        # Adds the client to the list of clients
+            self.outbound.put([address], message_to_send)
+        # The client was added to the list of clients, the other workers are told about it
         else:
-            self.clients.append(client)
+            self.announce(("join", client))
             print("join:", username)
 
+    def reserve_slot(self):
+        # Returns whether another client fits in the server. Workers share one count,
+        # as joins to other workers only reach this worker's list a moment later
+        with self.client_count.get_lock():
+            if self.client_count.value >= self.max_clients:
+                return False
+            self.client_count.value += 1
+            return True
+
+    def release_slot(self):
+        with self.client_count.get_lock():
+            self.client_count.value -= 1
+
+    def deliver(self, client, message_to_send, deliveries):
+        # Adds a client of this worker to the deliveries. The ACKs of a client only reach the
+        # worker its address is routed to, so a client of another worker is sent the message by that worker
+        if client["worker"] == self.worker:
+            deliveries.append(client["address"])
+        else:
+            self.inboxes[client["worker"]].put(("forward", client["address"], message_to_send))
+
+    def announce(self, event):
+        # Sends a join or leave event to every other worker
+        if self.inboxes is None:
+            return
+        for worker, inbox in enumerate(self.inboxes):
+            if worker != self.worker:
+                inbox.put(event)
+
+    def handle_inbox(self):
+        # Applies what the other workers send: their clients joining and leaving, and
+        # messages to forward to the clients of this worker
+        inbox = self.inboxes[self.worker]
+        while True:
+            event = inbox.get()
+            if event[0] == "join":
+                self.clients.add(event[1])
+            elif event[0] == "leave":
+                self.clients.remove(event[1]["username"], event[1]["address"])
+            elif event[0] == "forward":
+                self.outbound.put([event[1]], event[2])
+
+
+def serve(dest, port, window, worker, inboxes, client_count, max_clients, handlers, backlog):
+    # Runs one worker process of start_workers until the main process exits,
+    # so that no worker is left holding the port
+    server = Server(dest, port, window, worker, inboxes, client_count, max_clients, handlers,
+                    backlog)
+    Thread(target=server.start, daemon=True).start()
+    try:
+        multiprocessing.connection.wait([multiprocessing.parent_process().sentinel])
+    except KeyboardInterrupt:
+        pass
+
+
+def start_workers(dest, port, window, workers, max_clients=util.MAX_NUM_CLIENTS,
+                  handlers=util.NUM_OF_COMMAND_WORKERS, backlog=util.COMMAND_BACKLOG):
+    # Runs the server in several processes bound to the same port with SO_REUSEPORT.
+    # The kernel routes every client to one of them, which handles all its packets:
+    # each worker keeps a copy of the list of clients, and messages to a client of
+    # another worker are forwarded to that worker through its inbox
+    inboxes = [multiprocessing.Queue() for _ in range(workers)]
+    client_count = multiprocessing.Value("i", 0)
+    processes = [multiprocessing.Process(target=serve, daemon=True,
+                                         args=(dest, port, window, worker, inboxes, client_count,
+                                               max_clients, handlers, backlog))
+                 for worker in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
 # Do not change this part of code
 
 
@@ -201,11 +496,16 @@ if __name__ == "__main__":
         print("-p PORT | --port=PORT The server port, defaults to 15000")
         print("-a ADDRESS | --address=ADDRESS The server ip or hostname, defaults to localhost")
         print("-w WINDOW | --window=WINDOW The window size, default is 3")
+        print("--workers=WORKERS The number of processes sharing the port, default is 1")
+        print("--max-clients=MAX_CLIENTS The number of clients that can join, default is 10")
+        print("--handlers=HANDLERS The number of threads handling commands, default is 8")
+        print("--backlog=BACKLOG The number of commands each of them takes in advance, default is 256")
         print("-h | --help Print this help")
 
     try:
         OPTS, ARGS = getopt.getopt(sys.argv[1:],
-                                   "p:a:w", ["port=", "address=", "window="])
+                                   "p:a:w", ["port=", "address=", "window=", "workers=",
+                                             "max-clients=", "handlers=", "backlog="])
     except getopt.GetoptError:
         helper()
         exit()
@@ -213,6 +513,10 @@ if __name__ == "__main__":
     PORT = 15000
     DEST = "127.0.0.1"
     WINDOW = 3
+    WORKERS = 1
+    MAX_CLIENTS = util.MAX_NUM_CLIENTS
+    HANDLERS = util.NUM_OF_COMMAND_WORKERS
+    BACKLOG = util.COMMAND_BACKLOG
 
     for o, a in OPTS:
         if o in ("-p", "--port="):
@@ -221,10 +525,22 @@ if __name__ == "__main__":
             DEST = a
         elif o in ("-w", "--window="):
             WINDOW = a
+        elif o == "--workers":
+            WORKERS = int(a)
+        elif o == "--max-clients":
+            MAX_CLIENTS = int(a)
+        elif o == "--handlers":
+            HANDLERS = int(a)
+        elif o == "--backlog":
+            BACKLOG = int(a)
 
-    SERVER = Server(DEST, PORT, WINDOW)
     try:
-        SERVER.start()
+        if WORKERS > 1:
+            start_workers(DEST, PORT, WINDOW, WORKERS, MAX_CLIENTS, HANDLERS, BACKLOG)
+        else:
+            SERVER = Server(DEST, PORT, WINDOW, max_clients=MAX_CLIENTS, handlers=HANDLERS,
+                            backlog=BACKLOG)
+            SERVER.start()
     except (KeyboardInterrupt, SystemExit):
         # for i in SERVER.clients:
         #     print("disconnected:", i["username"])
@@ -3,11 +3,63 @@ This file contains basic utility functions that you can use.
 DO NOT EDIT THIS FILE.
 '''
 import binascii
+import struct
+import time
+import zlib
 
 MAX_NUM_CLIENTS = 10
-TIME_OUT = 0.5  # 500ms
+TIME_OUT = 0.5  # 500ms, initial retransmission timeout before any RTT is measured
+MIN_TIME_OUT = 0.2  # 200ms
+MAX_TIME_OUT = 4.0  # 4s
+ACK_DELAY = 0.02  # 20ms, longest a receiver holds back an ACK, well below MIN_TIME_OUT
+TIMER_TICK = 0.002  # 2ms, resolution of retransmission deadlines
 NUM_OF_RETRANSMISSIONS = 3
+NUM_OF_STALLED_TIME_OUTS = 8  # Backoffs without progress before a transmission is abandoned
 CHUNK_SIZE = 1400  # 1400 Bytes
+MAX_PACKET_SIZE = 1500  # Bytes in a datagram, unless path MTU probing found more room
+HEADER_ROOM = MAX_PACKET_SIZE - CHUNK_SIZE  # Bytes left for headers, above the longest one
+MAX_DATAGRAM_SIZE = 65507  # Largest UDP payload over IPv4
+PROBE_SIZES = (4096, 8192, 16384, 32768, MAX_DATAGRAM_SIZE)  # Datagram sizes path MTU probing tries
+MAX_SACK_BLOCKS = 4
+MAX_PREALLOCATED_SIZE = 64 * 1024 * 1024  # 64MB, largest announced message a receiver preallocates
+NUM_OF_SEND_WORKERS = 16  # Transmissions a socket runs at once for sendto_async
+NUM_OF_COMMAND_WORKERS = 8  # Threads a server handles the commands of its clients on
+COMMAND_BACKLOG = 256  # Commands a command worker takes in advance before the server waits for it
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024  # 4MB kernel receive buffer, capped by net.core.rmem_max
+TIME_WAIT = 2 * MAX_TIME_OUT  # 8s, finished transmissions still absorb late duplicates this long
+RECEIVE_IDLE_TIME_OUT = NUM_OF_STALLED_TIME_OUTS * MAX_TIME_OUT  # 32s, receivers left this long without packets are abandoned
+MAX_CONNECTIONS = 4096  # Senders or receivers a socket keeps, must stay below the 50000 msg_ids
+MSG_ID_RANGE = range(50000, 100000)
+IDLE_TIME_OUT = 5.0  # 5s, persistent connections are closed after this long without messages
+BATCH_DELAY = 0.005  # 5ms, longest a small message waits for others to the same address
+BATCH_SIZE = CHUNK_SIZE  # Messages below this many bytes are batched, until a batch reaches it
+COMPRESS_THRESHOLD = 8 * CHUNK_SIZE  # Messages below this many bytes are never compressed
+COMPRESS_SAMPLE = 16 * 1024  # Bytes compressed up front to tell whether a message compresses
+COMPRESS_RATIO = 0.9  # Messages whose sample shrinks less than this are sent uncompressed
+COMPRESS_LEVEL = 6
+RECEIVE_WINDOW_MIN = 256 * 1024  # 256KB, receive buffer space a socket starts with and never tunes below
+RECEIVE_WINDOW_CAP = 16 * 1024 * 1024  # 16MB, most receive buffer space a socket tunes up to
+RECEIVE_TUNE_INTERVAL = 0.1  # 100ms, how often receive buffer space is tuned from the drain rate
+PACING_GAIN = 1.25  # Paced senders send this much faster than a congestion window per RTT
+PACING_BURST = 0.002  # 2ms of sending, the most a pacer saves up while idle
+PACING_SPIN = 0.0002  # 200us, the end of a paced wait is spun instead of slept
+
+# Binary framing: `<type:1><seqno:4><length:2><body><check:4>`, network byte order.
+# The low nibble of the type byte is the packet type and the high nibble the
+# integrity check of the trailer, so the type byte is always a control
+# character or punctuation and a binary packet can never be mistaken for a
+# text packet, whose first byte is always a letter.
+PACKET_CODES = {"start": 1, "data": 2, "ack": 3, "end": 4, "eom": 5, "probe": 6}
+PACKET_TYPES = {code: pck_type for pck_type, code in PACKET_CODES.items()}
+BINARY_PREFIX = struct.Struct("!BIH")
+BINARY_TRAILER = struct.Struct("!I")
+BINARY_OVERHEAD = BINARY_PREFIX.size + BINARY_TRAILER.size
+
+# Integrity checks of binary packets, by the name negotiated in start packets.
+# "none" trusts the UDP checksum, which is enough on loopback.
+INTEGRITY_CHECKS = {"crc32": binascii.crc32, "adler32": zlib.adler32, "none": None}
+INTEGRITY_CODES = {"crc32": 0, "adler32": 1, "none": 2}
+INTEGRITY_NAMES = {code: name for name, code in INTEGRITY_CODES.items()}
 
 
 def validate_checksum(message):
@@ -67,3 +119,373 @@ def make_message(msg_type, msg_format, message=None):
     if msg_format in [1, 3, 4]:
         return "%s %s" % (msg_type, message)
     return ""
+
+
+def make_binary_packet(pck_type="data", seqno=0, msg=b"", integrity="crc32"):
+    '''
+    Binary counterpart of make_packet.
+    The format is `<type:1><seqno:4><length:2><body><check:4>`, where check is
+    computed by one of INTEGRITY_CHECKS over the body and then the header, so
+    the check of a body can be reused for every header it is framed with.
+    msg is any bytes-like object; it is never decoded.
+    '''
+    header, trailer = make_binary_frame(pck_type, seqno, msg, integrity)
+    return header + msg + trailer
+
+
+def make_binary_frame(pck_type="data", seqno=0, msg=b"", integrity="crc32", body_check=None):
+    '''
+    Returns only the header and the trailer that make_binary_packet would put
+    around msg, so the body can be sent straight from its own buffer with
+    send_datagram. body_check is check_body(msg, integrity) if the caller
+    already has it.
+    '''
+    header = BINARY_PREFIX.pack(PACKET_CODES[pck_type] | INTEGRITY_CODES[integrity] << 4,
+                                seqno, len(msg))
+    check = INTEGRITY_CHECKS[integrity]
+    if check is None:
+        return header, bytes(BINARY_TRAILER.size)
+    if body_check is None:
+        body_check = check(msg)
+    return header, BINARY_TRAILER.pack(check(header, body_check) & 0xffffffff)
+
+
+def check_body(msg, integrity="crc32"):
+    '''
+    Returns the part of the check of a binary packet that only depends on its
+    body, or None if integrity is "none".
+    '''
+    check = INTEGRITY_CHECKS[integrity]
+    return None if check is None else check(msg)
+
+
+def send_datagram(sock, address, parts):
+    '''
+    Sends the concatenation of the bytes-like parts as one datagram.
+    Uses scatter/gather I/O where the socket supports it, so the parts are
+    never copied into an intermediate buffer.
+    '''
+    if hasattr(sock, "sendmsg"):
+        sock.sendmsg(parts, (), 0, address)
+    else:
+        sock.sendto(b"".join(parts), address)
+
+
+def parse_binary_packet(packet):
+    '''
+    Parses a packet made by make_binary_packet.
+    Unlike parse_packet, seqno is returned as an int and the body as a
+    memoryview over the packet, so no payload bytes are copied.
+    '''
+    code, seqno, length = BINARY_PREFIX.unpack_from(packet)
+    start = BINARY_PREFIX.size
+    data = memoryview(packet)[start:start + length]
+    checksum, = BINARY_TRAILER.unpack_from(packet, start + length)
+    return PACKET_TYPES[code & 0x0f], seqno, data, checksum
+
+
+def validate_binary_checksum(packet, integrity="crc32"):
+    '''
+    Validates the trailer of a binary packet without copying its body. The
+    packet must be checked by crc32 or by integrity.
+    '''
+    try:
+        code, _, length = BINARY_PREFIX.unpack_from(packet)
+        name = INTEGRITY_NAMES[code >> 4]
+        if (code & 0x0f not in PACKET_TYPES or name not in ("crc32", integrity)
+                or len(packet) != BINARY_OVERHEAD + length):
+            return False
+        check = INTEGRITY_CHECKS[name]
+        if check is None:
+            return True
+        view = memoryview(packet)
+        end = BINARY_PREFIX.size + length
+        checksum, = BINARY_TRAILER.unpack_from(view, end)
+        computed = check(view[:BINARY_PREFIX.size], check(view[BINARY_PREFIX.size:end]))
+        return computed & 0xffffffff == checksum
+    except BaseException:
+        return False
+
+
+def is_binary_packet(packet):
+    '''
+    Tells binary packets apart from text ones by their leading type byte.
+    '''
+    return (len(packet) > 0 and packet[0] & 0x0f in PACKET_TYPES
+            and packet[0] >> 4 in INTEGRITY_NAMES)
+
+
+def read_text_packet(packet):
+    '''
+    Validates and parses a text packet that is still bytes, so its checksum
+    is computed without encoding it again. Returns what read_packet returns.
+    '''
+    try:
+        packet = bytes(packet)
+        last = packet.rindex(b"|")
+        if int(packet[last + 1:]) != binascii.crc32(memoryview(packet)[:last + 1]) & 0xffffffff:
+            return None
+        first = packet.index(b"|")
+        second = packet.index(b"|", first + 1, last)
+        return (packet[:first].decode("utf-8"), int(packet[first + 1:second]),
+                packet[second + 1:last].decode("utf-8"))
+    except ValueError:
+        return None
+
+
+def read_packet(packet, integrity="crc32"):
+    '''
+    Validates and parses either kind of packet.
+    Returns (pck_type, seqno, body) with an integer seqno, or None if the
+    packet is corrupted. Binary packets must be checked by crc32 or by
+    integrity.
+    '''
+    if isinstance(packet, str):
+        if not validate_checksum(packet):
+            return None
+        pck_type, seqno, data, _ = parse_packet(packet)
+        return pck_type, int(seqno), data
+    if not is_binary_packet(packet):
+        return read_text_packet(packet)
+    if not validate_binary_checksum(packet, integrity):
+        return None
+    pck_type, seqno, data, _ = parse_binary_packet(packet)
+    return pck_type, seqno, data
+
+
+def parse_datagram(buffer, nbytes=None):
+    '''
+    Splits a datagram `<sender_type>:<msg_id>:<packet>` into its parts without
+    copying the packet, which is returned as a memoryview over the buffer.
+    read_packet validates and decodes it.
+    '''
+    if nbytes is None:
+        nbytes = len(buffer)
+    first = buffer.find(b':', 0, nbytes)
+    second = buffer.find(b':', first + 1, nbytes)
+    packet = memoryview(buffer)[second + 1:nbytes]
+    return bytes(buffer[:first]).decode("utf-8"), int(buffer[first + 1:second]), packet
+
+
+def make_options(options):
+    '''
+    Formats negotiation options as the body of a start or ack packet,
+    e.g. {"codec": "bin"} becomes "codec=bin".
+    '''
+    return " ".join("%s=%s" % (key, value) for key, value in options.items())
+
+
+def parse_options(body):
+    '''
+    Parses a body made by make_options. Unknown tokens are ignored so older
+    peers that send an empty body negotiate nothing.
+    '''
+    if not isinstance(body, str):
+        body = bytes(body).decode("utf-8", "replace")
+    return dict(item.split("=", 1) for item in body.split() if "=" in item)
+
+
+def parse_size(value, limit=None):
+    '''
+    Parses a size a peer sent in an option, e.g. size=<bytes>. Returns None
+    unless it is a decimal number, of at most limit if one is given.
+    '''
+    if value is None or not value.isdigit() or (limit is not None and int(value) > limit):
+        return None
+    return int(value)
+
+
+def make_sack_blocks(seq_nums):
+    '''
+    Collapses out-of-order sequence numbers into at most MAX_SACK_BLOCKS
+    inclusive ranges, lowest first, formatted as "first-last,first-last".
+    '''
+    blocks = []
+    for seqno in sorted(seq_nums):
+        if blocks and blocks[-1][1] == seqno - 1:
+            blocks[-1][1] = seqno
+        elif len(blocks) == MAX_SACK_BLOCKS:
+            break
+        else:
+            blocks.append([seqno, seqno])
+    return ",".join("%d-%d" % (first, last) for first, last in blocks)
+
+
+def parse_sack_blocks(sack):
+    '''
+    Parses ranges made by make_sack_blocks into (first, last) tuples.
+    '''
+    blocks = []
+    for block in sack.split(","):
+        first, _, last = block.partition("-")
+        if first.isdigit() and last.isdigit():
+            blocks.append((int(first), int(last)))
+    return blocks
+
+
+def chunk_size_for(packet_size=MAX_PACKET_SIZE):
+    '''
+    Returns how many bytes of a message fit in a datagram of packet_size
+    bytes, leaving HEADER_ROOM for the longest header of either framing:
+    `s:<msg_id>:` plus `data|<seqno>|...|<checksum>` takes at most 35 bytes.
+    '''
+    return packet_size - HEADER_ROOM
+
+
+def iter_text_chunks(message, chunk_size=CHUNK_SIZE):
+    '''
+    Lazily splits a str into pieces of at most chunk_size bytes once encoded
+    as UTF-8, never splitting a character.
+    '''
+    if message.isascii():
+        for i in range(0, len(message), chunk_size):
+            yield message[i : i + chunk_size]
+        return
+    encoded = message.encode("utf-8")
+    start = 0
+    while start < len(encoded):
+        end = min(start + chunk_size, len(encoded))
+        # Back off to the first byte of a character: continuation bytes are 0b10xxxxxx.
+        while end < len(encoded) and encoded[end] & 0xC0 == 0x80:
+            end -= 1
+        yield encoded[start:end].decode("utf-8")
+        start = end
+
+
+def make_probe(size):
+    '''
+    Returns a binary probe packet padded so that its datagram, with the
+    `s:<msg_id>:` prefix, is size bytes long. Its seqno is the size.
+    '''
+    padding = bytes(size - len("s:%d:" % MSG_ID_RANGE[-1]) - BINARY_OVERHEAD)
+    header, trailer = make_binary_frame("probe", size, padding)
+    return header, padding, trailer
+
+
+def packet_length(packet):
+    '''
+    Returns how many bytes a packet made by make_packet or make_binary_frame
+    takes on the wire, not counting the `s:<msg_id>:` prefix.
+    '''
+    if isinstance(packet, str):
+        return len(packet)
+    return sum(len(part) for part in packet)
+
+
+def sleep_until(deadline):
+    '''
+    Sleeps until time.monotonic() reaches deadline. time.sleep wakes up
+    around a tenth of a millisecond late, so it only sleeps until PACING_SPIN
+    before the deadline and spins through the rest.
+    '''
+    remaining = deadline - time.monotonic()
+    if remaining > PACING_SPIN:
+        time.sleep(remaining - PACING_SPIN)
+    while time.monotonic() < deadline:
+        pass
+
+
+def iter_chunks(source, chunk_size=CHUNK_SIZE):
+    '''
+    Lazily splits a file object or an iterable of bytes into chunks of
+    exactly chunk_size bytes (the last one may be shorter). The source is
+    only read as chunks are consumed; str pieces are encoded as UTF-8.
+    '''
+    pieces = source
+    if hasattr(source, "read"):
+        pieces = iter(lambda: source.read(chunk_size), source.read(0))
+    pending = bytearray()
+    for piece in pieces:
+        if isinstance(piece, str):
+            piece = piece.encode("utf-8")
+        if not pending and len(piece) == chunk_size:
+            yield bytes(piece)
+            continue
+        pending += piece
+        while len(pending) >= chunk_size:
+            yield bytes(pending[:chunk_size])
+            del pending[:chunk_size]
+    if pending:
+        yield bytes(pending)
+
+
+def make_batch(messages):
+    '''
+    Packs several messages into one payload, each prefixed with its length as
+    `<length>:`, so split_batch can recover them. str messages are encoded as
+    UTF-8.
+    '''
+    parts = []
+    for message in messages:
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        parts.append(b"%d:" % len(message))
+        parts.append(message)
+    return b"".join(parts)
+
+
+def split_batch(payload):
+    '''
+    Splits a payload made by make_batch back into its messages, as bytes and
+    in the order they were packed.
+    '''
+    payload = bytes(payload)
+    messages = []
+    offset = 0
+    while offset < len(payload):
+        colon = payload.index(b":", offset)
+        end = colon + 1 + int(payload[offset:colon])
+        messages.append(payload[colon + 1 : end])
+        offset = end
+    return messages
+
+
+def compress(message):
+    '''
+    Returns a message (str messages are encoded as UTF-8) compressed with
+    zlib, or None if its first COMPRESS_SAMPLE bytes show it barely
+    compresses, e.g. because it is already compressed.
+    '''
+    if isinstance(message, str):
+        message = message.encode("utf-8")
+    sample = bytes(message[:COMPRESS_SAMPLE])
+    if len(zlib.compress(sample, 1)) > COMPRESS_RATIO * len(sample):
+        return None
+    return zlib.compress(message, COMPRESS_LEVEL)
+
+
+def decompress(payload, limit):
+    '''
+    Restores a message compressed by compress, as bytes. Raises ValueError
+    if it is incomplete or restores to more than limit bytes, without ever
+    inflating more than that.
+    '''
+    decompressor = zlib.decompressobj()
+    message = decompressor.decompress(payload, limit + 1)
+    if len(message) > limit or not decompressor.eof:
+        raise ValueError("compressed message does not restore to at most %d bytes" % limit)
+    return message
+
+
+class Decompressor:
+    '''
+    Restores a message compressed by compress that is received in pieces:
+    decompress(piece) for each of them in order, then flush(). Raises
+    ValueError as soon as more than limit bytes would be restored.
+    '''
+
+    def __init__(self, limit):
+        self.__zlib = zlib.decompressobj()
+        self.__left = limit
+
+    def decompress(self, piece):
+        return self.__restored(self.__zlib.decompress(piece, self.__left + 1))
+
+    def flush(self):
+        return self.__restored(self.__zlib.flush())
+
+    def __restored(self, data):
+        if len(data) > self.__left:
+            raise ValueError("compressed message restores to more than it announced")
+        self.__left -= len(data)
+        return data